@@ -66,17 +66,19 @@ def latest(request, listname):
 
     # Restrict by full text search
     if 's' in request.GET and request.GET['s']:
-        extrawhere.append("fti @@ plainto_tsquery('public.pg', %s)")
-        extraparams.append(request.GET['s'])
+        # Also match messages still pending full text indexing, see search()
+        extrawhere.append("(fti @@ plainto_tsquery('public.pg', %s) OR (fti_pending AND archives_message_fti(subject, bodytxt) @@ plainto_tsquery('public.pg', %s)))")
+        extraparams.extend([request.GET['s'], request.GET['s']])
 
     if listname != '*':
         list = get_object_or_404(List, listname=listname)
-        extrawhere.append("threadid IN (SELECT threadid FROM list_threads WHERE listid=%s)" % list.listid)
+        # The visible messages of the list, newest first by list_messages
+        extrawhere.extend(["list_messages.message=messages.id", "list_messages.listid=%s" % list.listid])
+        mlist = Message.objects.defer('bodytxt', 'cc', 'to').select_related().extra(tables=['list_messages'], where=extrawhere, params=extraparams, order_by=['-list_messages.date'])[:limit]
     else:
         list = None
         extrawhere = ''
-
-    mlist = Message.objects.defer('bodytxt', 'cc', 'to').select_related().extra(where=extrawhere, params=extraparams).order_by('-date')[:limit]
+        mlist = Message.objects.defer('bodytxt', 'cc', 'to').select_related().extra(where=extrawhere, params=extraparams).order_by('-date')[:limit]
     allyearmonths = set([(m.date.year, m.date.month) for m in mlist])
 
     resp = HttpResponse(content_type='application/json')
@@ -108,7 +110,7 @@ def thread(request, msgid):
     # Return metadata about a single thread. A list of all the emails
     # that are in the thread with their basic attributes are included.
     msg = get_object_or_404(Message, messageid=msgid)
-    mlist = Message.objects.defer('bodytxt', 'cc', 'to').filter(threadid=msg.threadid)
+    mlist = Message.objects.defer('bodytxt', 'cc', 'to').filter(threadid__in=msg.threadids)
 
     resp = HttpResponse(content_type='application/json')
     json.dump([
@@ -121,5 +123,5 @@ def thread(request, msgid):
         }
         for m in mlist], resp)
     if settings.PUBLIC_ARCHIVES:
-        resp['xkey'] = 'pgat_{0}'.format(msg.threadid)
+        resp['xkey'] = 'pgat_{0} pgatt_{0} pgatm_{1}/{2}'.format(msg.canonical_threadid, msg.date.year, msg.date.month)
     return resp
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, connection
 from django.contrib.auth.models import User
 
 from email.utils import parseaddr
@@ -62,6 +62,30 @@ class Message(models.Model):
             self._attachments = self.attachment_set.extra(select={'len': 'length(attachment)'}).all()
         return self._attachments
 
+    # The loader merges threads by recording the merged ones in
+    # thread_aliases, and moves their messages over later, so threadid
+    # can be that of a thread that is now part of another one. We look
+    # up the thread the message is actually in, and all the threadids
+    # the messages in it can have, once.
+    _thread = None
+
+    def _lookup_thread(self):
+        if not self._thread:
+            curs = connection.cursor()
+            curs.execute("SELECT c.t, ARRAY(SELECT c.t UNION ALL SELECT threadid FROM thread_aliases WHERE canonical=c.t) FROM (SELECT COALESCE((SELECT canonical FROM thread_aliases WHERE threadid=%(threadid)s), %(threadid)s) AS t) c", {
+                'threadid': self.threadid,
+            })
+            self._thread = curs.fetchone()
+        return self._thread
+
+    @property
+    def canonical_threadid(self):
+        return self._lookup_thread()[0]
+
+    @property
+    def threadids(self):
+        return self._lookup_thread()[1]
+
     @property
     def hiddenreason(self):
         if not self.hiddenstatus:
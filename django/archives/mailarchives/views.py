@@ -7,7 +7,6 @@ from django.shortcuts import render, get_object_or_404
 from django.utils.http import http_date, parse_http_date_safe
 from django.views.decorators.csrf import csrf_exempt
 from django.db import connection, transaction
-from django.db.models import Q
 from django.conf import settings
 
 import copy
@@ -231,7 +230,7 @@ def monthlist(request, listname):
     ensure_list_permissions(request, l)
 
     curs = connection.cursor()
-    curs.execute("SELECT year, month FROM list_months WHERE listid=%(listid)s ORDER BY year DESC, month DESC", {'listid': l.listid})
+    curs.execute("SELECT DISTINCT extract(year FROM day)::int, extract(month FROM day)::int FROM list_days WHERE listid=%(listid)s ORDER BY 1 DESC, 2 DESC", {'listid': l.listid})
     months = [{'year': r[0], 'month': r[1], 'date': datetime(r[0], r[1], 1)} for r in curs.fetchall()]
 
     return render_nav(NavContext(request, l.listid, l.listname), 'monthlist.html', {
@@ -253,9 +252,9 @@ def get_monthday_info(mlist, l, d):
 
     if monthdate:
         curs = connection.cursor()
-        curs.execute("SELECT DISTINCT extract(day FROM date) FROM messages WHERE date >= %(startdate)s AND date < %(enddate)s AND threadid IN (SELECT threadid FROM list_threads WHERE listid=%(listid)s) ORDER BY 1", {
-            'startdate': datetime(year=monthdate.year, month=monthdate.month, day=1),
-            'enddate': monthdate + timedelta(days=calendar.monthrange(monthdate.year, monthdate.month)[1]),
+        curs.execute("SELECT extract(day FROM day) FROM list_days WHERE listid=%(listid)s AND day >= %(startdate)s AND day < %(enddate)s ORDER BY 1", {
+            'startdate': date(monthdate.year, monthdate.month, 1),
+            'enddate': date(monthdate.year, monthdate.month, 1) + timedelta(days=calendar.monthrange(monthdate.year, monthdate.month)[1]),
             'listid': l.listid,
         })
         daysinmonth = [int(r[0]) for r in curs.fetchall()]
@@ -266,20 +265,46 @@ def get_monthday_info(mlist, l, d):
     return (yearmonth, daysinmonth)
 
 
-def _render_datelist(request, l, d, datefilter, title, queryproc):
+def _datelist_range_keys(l, start, end, atstart, atend):
+    # Keys for a date list showing the messages of l from start to end.
+    # Every day in between is tagged, so the page is purged when a message
+    # is added on one of them, but if there are too many it's tagged with
+    # the months instead. atstart and atend are set if the page shows all
+    # messages up to the start or end of the list, where new ones will
+    # show up too.
+    keys = []
+    if (end.date() - start.date()).days > 62:
+        year, month = start.year, start.month
+        while (year, month) <= (end.year, end.month):
+            keys.append('pgam_{0}/{1}/{2}'.format(l.listid, year, month))
+            year, month = month == 12 and (year + 1, 1) or (year, month + 1)
+    else:
+        day = start.date()
+        while day <= end.date():
+            keys.append('pgad_{0}/{1}/{2}/{3}'.format(l.listid, day.year, day.month, day.day))
+            day += timedelta(days=1)
+    if atstart:
+        keys.append('pgals_{0}'.format(l.listid))
+    if atend:
+        keys.append('pgale_{0}'.format(l.listid))
+    return keys
+
+
+def _render_datelist(request, l, d, datefilter, title, queryproc, keyproc):
     # NOTE! Basic permissions checks must be done before calling this function!
+    # datefilter is the conditions on list_messages.date, and their
+    # parameters. keyproc returns the xkeys for the messages shown.
 
+    # The visible messages of the list are found through list_messages,
+    # which queryproc sorts by date as well.
+    where = ["list_messages.message=messages.id", "list_messages.listid=%s"] + datefilter[0]
+    params = [l.listid] + datefilter[1]
     if not settings.PUBLIC_ARCHIVES and not request.user.is_superuser:
-        mlist = Message.objects.defer('bodytxt', 'cc', 'to').select_related().filter(datefilter, hiddenstatus__isnull=True).extra(
-            where=["threadid IN (SELECT threadid FROM list_threads t WHERE listid=%s AND NOT EXISTS (SELECT 1 FROM list_threads t2 WHERE t2.threadid=t.threadid AND listid NOT IN (SELECT list_id FROM listsubscribers WHERE username=%s)))"],
-            params=(l.listid, request.user.username),
-        )
-    else:
-        # Else we return everything
-        mlist = Message.objects.defer('bodytxt', 'cc', 'to').select_related().filter(datefilter, hiddenstatus__isnull=True).extra(where=["threadid IN (SELECT threadid FROM list_threads WHERE listid=%s)" % l.listid])
+        where.append("NOT EXISTS (SELECT 1 FROM list_threads t2 WHERE t2.threadid=messages.threadid AND t2.listid NOT IN (SELECT list_id FROM listsubscribers WHERE username=%s))")
+        params.append(request.user.username)
+    mlist = Message.objects.defer('bodytxt', 'cc', 'to').select_related().extra(tables=['list_messages'], where=where, params=params)
     mlist = queryproc(mlist)
 
-    allyearmonths = set([(m.date.year, m.date.month) for m in mlist])
     (yearmonth, daysinmonth) = get_monthday_info(mlist, l, d)
 
     r = render_nav(NavContext(request, l.listid, l.listname), 'datelist.html', {
@@ -290,18 +315,29 @@ def _render_datelist(request, l, d, datefilter, title, queryproc):
         'yearmonth': yearmonth,
     })
     if settings.PUBLIC_ARCHIVES:
-        r['xkey'] = ' '.join(['pgam_{0}/{1}/{2}'.format(l.listid, year, month) for year, month in allyearmonths])
+        keys = set(keyproc(mlist))
+        if daysinmonth:
+            # The links to the days of the month
+            keys.add('pgamd_{0}/{1}/{2}'.format(l.listid, int(yearmonth[:4]), int(yearmonth[4:])))
+        r['xkey'] = ' '.join(sorted(keys))
     return r
 
 
 def render_datelist_from(request, l, d, title, to=None):
     # NOTE! Basic permissions checks must be done before calling this function!
-    datefilter = Q(date__gte=d)
+    datefilter = (["list_messages.date >= %s"], [d])
     if to:
-        datefilter.add(Q(date__lt=to), Q.AND)
+        datefilter[0].append("list_messages.date < %s")
+        datefilter[1].append(to)
+
+    def _keys(mlist):
+        if to:
+            # A whole month
+            return ['pgam_{0}/{1}/{2}'.format(l.listid, d.year, d.month)]
+        return _datelist_range_keys(l, d, mlist and mlist[-1].date or d, False, len(mlist) < 200)
 
     return _render_datelist(request, l, d, datefilter, title,
-                            lambda x: list(x.order_by('date')[:200]))
+                            lambda x: list(x.extra(order_by=['list_messages.date'])[:200]), _keys)
 
 
 def render_datelist_to(request, l, d, title):
@@ -311,8 +347,9 @@ def render_datelist_to(request, l, d, title):
     # properly, and then manually resort it in the correct order. We can do
     # the second sort safely in python since it's not a lot of items..
 
-    return _render_datelist(request, l, d, Q(date__lte=d), title,
-                            lambda x: sorted(x.order_by('-date')[:200], key=lambda m: m.date))
+    return _render_datelist(request, l, d, (["list_messages.date <= %s"], [d]), title,
+                            lambda x: sorted(x.extra(order_by=['-list_messages.date'])[:200], key=lambda m: m.date),
+                            lambda mlist: _datelist_range_keys(l, mlist and mlist[0].date or d, d, len(mlist) < 200, False))
 
 
 @cache(hours=2)
@@ -399,16 +436,18 @@ def attachment(request, attid):
     })
 
 
-def _build_thread_structure(threadid):
-    # Yeah, this is *way* too complicated for the django ORM
+def _build_thread_structure(threadids):
+    # Yeah, this is *way* too complicated for the django ORM. threadids
+    # are all the ids the messages of the thread can have, see
+    # Message.threadids.
     curs = connection.cursor()
     curs.execute("""WITH RECURSIVE t(id, _from, subject, date, messageid, has_attachment, parentid, datepath) AS(
-  SELECT id,_from,subject,date,messageid,has_attachment,parentid,array[]::timestamptz[] FROM messages m WHERE m.threadid=%(threadid)s AND parentid IS NULL
+  SELECT id,_from,subject,date,messageid,has_attachment,parentid,array[]::timestamptz[] FROM messages m WHERE m.threadid=ANY(%(threadids)s) AND parentid IS NULL
  UNION ALL
-  SELECT m.id,m._from,m.subject,m.date,m.messageid,m.has_attachment,m.parentid,t.datepath||t.date FROM messages m INNER JOIN t ON t.id=m.parentid WHERE m.threadid=%(threadid)s
+  SELECT m.id,m._from,m.subject,m.date,m.messageid,m.has_attachment,m.parentid,t.datepath||t.date FROM messages m INNER JOIN t ON t.id=m.parentid WHERE m.threadid=ANY(%(threadids)s)
 )
 SELECT id,_from,subject,date,messageid,has_attachment,parentid,datepath FROM t ORDER BY datepath||date
-""", {'threadid': threadid})
+""", {'threadids': threadids})
 
     for id, _from, subject, date, messageid, has_attachment, parentid, parentpath in curs.fetchall():
         yield {
@@ -431,17 +470,17 @@ WITH l(listid) AS (
    SELECT unnest(%(lists)s)
 )
 SELECT l.listid,1,
- (SELECT ARRAY[messageid,to_char(date, 'yyyy-mm-dd hh24:mi:ss'),subject,_from] FROM messages m
-     INNER JOIN list_threads lt ON lt.threadid=m.threadid
-     WHERE m.date>%(time)s AND lt.listid=l.listid
-     ORDER BY m.date LIMIT 1
+ (SELECT ARRAY[messageid,to_char(m.date, 'yyyy-mm-dd hh24:mi:ss'),subject,_from] FROM list_messages lm
+     INNER JOIN messages m ON m.id=lm.message
+     WHERE lm.date>%(time)s AND lm.listid=l.listid
+     ORDER BY lm.date LIMIT 1
   ) FROM l
 UNION ALL
 SELECT l.listid,0,
- (SELECT ARRAY[messageid,to_char(date, 'yyyy-mm-dd hh24:mi:ss'),subject,_from] FROM messages m
-     INNER JOIN list_threads lt ON lt.threadid=m.threadid
-     WHERE m.date<%(time)s AND lt.listid=l.listid
-     ORDER BY m.date DESC LIMIT 1
+ (SELECT ARRAY[messageid,to_char(m.date, 'yyyy-mm-dd hh24:mi:ss'),subject,_from] FROM list_messages lm
+     INNER JOIN messages m ON m.id=lm.message
+     WHERE lm.date<%(time)s AND lm.listid=l.listid
+     ORDER BY lm.date DESC LIMIT 1
  ) FROM l""",
                  {
                      'lists': list(listmap.keys()),
@@ -478,7 +517,7 @@ def message(request, msgid):
 
     lists = List.objects.extra(where=["listid IN (SELECT listid FROM list_threads WHERE threadid=%s)" % m.threadid]).order_by('listname')
     listmap = dict([(l.listid, l.listname) for l in lists])
-    threadstruct = list(_build_thread_structure(m.threadid))
+    threadstruct = list(_build_thread_structure(m.threadids))
     newest = calendar.timegm(max(threadstruct, key=lambda x: x['date'])['date'].utctimetuple())
     if 'HTTP_IF_MODIFIED_SINCE' in request.META and not settings.DEBUG:
         ims = parse_http_date_safe(request.META.get("HTTP_IF_MODIFIED_SINCE"))
@@ -503,6 +542,7 @@ def message(request, msgid):
         'parent': parent,
         'lists': lists,
         'nextprev': nextprev,
+        'esi_threadtree': settings.THREAD_TREE_ESI,
         'og': {
             'url': 'message-id/{}'.format(quote(m.messageid)),
             'author': m.from_name_only(),
@@ -512,11 +552,36 @@ def message(request, msgid):
         },
     })
     if settings.PUBLIC_ARCHIVES:
-        r['xkey'] = 'pgat_{0}'.format(m.threadid)
+        # The month key lets the purge daemon purge many threads at once.
+        # Unless the thread tree is included with ESI, the page changes
+        # with every message added to the thread.
+        r['xkey'] = 'pgat_{0} pgamsg_{1} pgatm_{2}/{3}'.format(m.canonical_threadid, m.id, m.date.year, m.date.month)
+        if not settings.THREAD_TREE_ESI:
+            r['xkey'] += ' pgatt_{0}'.format(m.canonical_threadid)
     r['Last-Modified'] = http_date(newest)
     return r
 
 
+@cache(hours=4)
+def message_tree(request, msgid):
+    # The thread tree of a message page, included in it with ESI when
+    # THREAD_TREE_ESI is set.
+    ensure_message_permissions(request, msgid)
+
+    try:
+        m = Message.objects.get(messageid=msgid)
+    except Message.DoesNotExist:
+        raise Http404('Message does not exist')
+
+    r = render(request, '_threadtree.html', {
+        'msg': m,
+        'threadstruct': list(_build_thread_structure(m.threadids)),
+    })
+    if settings.PUBLIC_ARCHIVES:
+        r['xkey'] = 'pgat_{0} pgatt_{0} pgatm_{1}/{2}'.format(m.canonical_threadid, m.date.year, m.date.month)
+    return r
+
+
 @cache(hours=4)
 def message_flat(request, msgid):
     ensure_message_permissions(request, msgid)
@@ -525,7 +590,7 @@ def message_flat(request, msgid):
         msg = Message.objects.get(messageid=msgid)
     except Message.DoesNotExist:
         raise Http404('Message does not exist')
-    allmsg = list(Message.objects.filter(threadid=msg.threadid).order_by('date'))
+    allmsg = list(Message.objects.filter(threadid__in=msg.threadids).order_by('date'))
     lists = List.objects.extra(where=["listid IN (SELECT listid FROM list_threads WHERE threadid=%s)" % msg.threadid]).order_by('listname')
 
     isfirst = (msg == allmsg[0])
@@ -549,7 +614,7 @@ def message_flat(request, msgid):
         },
     })
     if settings.PUBLIC_ARCHIVES:
-        r['xkey'] = 'pgat_{0}'.format(msg.threadid)
+        r['xkey'] = 'pgat_{0} pgatt_{0} pgatm_{1}/{2}'.format(msg.canonical_threadid, msg.date.year, msg.date.month)
     r['Last-Modified'] = http_date(newest)
     return r
 
@@ -561,7 +626,7 @@ def message_raw(request, msgid):
     ensure_message_permissions(request, msgid)
 
     curs = connection.cursor()
-    curs.execute("SELECT threadid, hiddenstatus, rawtxt FROM messages WHERE messageid=%(messageid)s", {
+    curs.execute("SELECT COALESCE(a.canonical, m.threadid), hiddenstatus, rawtxt FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE messageid=%(messageid)s", {
         'messageid': msgid,
     })
     row = curs.fetchall()
@@ -623,9 +688,9 @@ def message_mbox(request, msgid):
     msg = get_object_or_404(Message, messageid=msgid)
 
     return _build_mbox(
-        "SELECT messageid, rawtxt FROM messages WHERE threadid=%(thread)s AND hiddenstatus IS NULL ORDER BY date",
+        "SELECT messageid, rawtxt FROM messages WHERE threadid=ANY(%(threads)s) AND hiddenstatus IS NULL ORDER BY date",
         {
-            'thread': msg.threadid,
+            'threads': msg.threadids,
         },
         msgid)
 
@@ -795,8 +860,18 @@ def search(request):
             return resp
         # If not found, fall through to a regular search
 
+    # Messages loaded with deferred full text indexing have no fti until
+    # fill_fti.py gets to them, so match those on the text instead.
+    curs.execute("SELECT EXISTS (SELECT 1 FROM messages WHERE fti_pending)")
+    if curs.fetchone()[0]:
+        fti = "(CASE WHEN fti_pending THEN archives_message_fti(subject, bodytxt) ELSE fti END)"
+        ftimatch = "(fti @@ plainto_tsquery('public.pg', %(q)s) OR (fti_pending AND archives_message_fti(subject, bodytxt) @@ plainto_tsquery('public.pg', %(q)s)))"
+    else:
+        fti = "fti"
+        ftimatch = "fti @@ plainto_tsquery('public.pg', %(q)s)"
+
     curs.execute("SET gin_fuzzy_search_limit=10000")
-    qstr = "SELECT messageid, date, subject, _from, ts_rank_cd(fti, plainto_tsquery('public.pg', %(q)s)), ts_headline(bodytxt, plainto_tsquery('public.pg', %(q)s),'StartSel=\"[[[[[[\",StopSel=\"]]]]]]\"') FROM messages m WHERE fti @@ plainto_tsquery('public.pg', %(q)s)"
+    qstr = "SELECT messageid, date, subject, _from, ts_rank_cd(" + fti + ", plainto_tsquery('public.pg', %(q)s)), ts_headline(bodytxt, plainto_tsquery('public.pg', %(q)s),'StartSel=\"[[[[[[\",StopSel=\"]]]]]]\"') FROM messages m WHERE " + ftimatch
     params = {
         'q': query,
     }
@@ -807,7 +882,7 @@ def search(request):
         qstr += " AND m.date > %(date)s"
         params['date'] = firstdate
     if list_sort == 'r':
-        qstr += " ORDER BY ts_rank_cd(fti, plainto_tsquery(%(q)s)) DESC LIMIT 1000"
+        qstr += " ORDER BY ts_rank_cd(" + fti + ", plainto_tsquery(%(q)s)) DESC LIMIT 1000"
     elif list_sort == 'd':
         qstr += " ORDER BY date DESC LIMIT 1000"
     else:
@@ -150,6 +150,11 @@ ALLOW_RESEND = False
 
 PGWEB_ADDRESS = 'https://www.postgresql.org'
 
+# Set if the frontends process ESI, to include the thread tree in the
+# message pages as a fragment that is cached on its own. The pages then
+# don't need to be purged when a message is added to their thread.
+THREAD_TREE_ESI = False
+
 try:
     from .settings_local import *
 except ImportError:
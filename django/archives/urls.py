@@ -33,6 +33,7 @@ urlpatterns = [
     # Match regular messages
     re_path(r'^message-id/flat/(.+)$', archives.mailarchives.views.message_flat),
     re_path(r'^message-id/raw/(.+)$', archives.mailarchives.views.message_raw),
+    re_path(r'^message-id/tree/(.+)$', archives.mailarchives.views.message_tree),
     re_path(r'^message-id/mbox/(.+)$', archives.mailarchives.views.message_mbox),
     re_path(r'^message-id/resend/(.+)/complete$', archives.mailarchives.views.resend_complete),
     re_path(r'^message-id/resend/(.+)$', archives.mailarchives.views.resend),
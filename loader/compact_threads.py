@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#
+# compact_threads.py - move the messages of threads that have been merged
+# into other threads over to their new thread, in small batches, and
+# remove the thread aliases once nothing uses them. Meant to be run
+# off-peak, see thread_aliases in sql/schema.sql.
+#
+
+import os
+import sys
+import time
+
+from optparse import OptionParser
+from configparser import ConfigParser
+
+import psycopg2
+
+from lib.log import log
+from lib.locks import lock_loader
+
+
+if __name__ == "__main__":
+    optparser = OptionParser()
+    optparser.add_option('--batch-size', dest='batchsize', type='int', default=500, help='Number of messages to move in each transaction (default 500)')
+    optparser.add_option('--sleep', dest='sleep', type='float', default=1, help='Seconds to sleep between batches (default 1)')
+    optparser.add_option('--max-batches', dest='maxbatches', type='int', help='Stop after this many batches, even if not done')
+    optparser.add_option('-v', '--verbose', dest='verbose', action='store_true', help='Verbose output')
+
+    (opt, args) = optparser.parse_args()
+
+    if (len(args)):
+        print("No bare arguments accepted")
+        optparser.print_usage()
+        sys.exit(1)
+
+    log.set(opt.verbose)
+
+    cfg = ConfigParser()
+    cfg.read('%s/archives.ini' % os.path.realpath(os.path.dirname(sys.argv[0])))
+    try:
+        connstr = cfg.get('db', 'connstr')
+    except Exception:
+        connstr = 'need_connstr'
+
+    conn = psycopg2.connect(connstr)
+    curs = conn.cursor()
+    curs.execute("SET statement_timeout='30s'")
+
+    moved = 0
+    removed = 0
+    batches = 0
+    while True:
+        # Merges only happen under the loader lock, so take it to not
+        # have threads merged while we move their messages. Each batch
+        # is small, so loaders aren't held up for long.
+        lock_loader(curs)
+        curs.execute("UPDATE messages m SET threadid=a.canonical FROM thread_aliases a WHERE a.threadid=m.threadid AND m.id IN (SELECT m2.id FROM thread_aliases a2 INNER JOIN messages m2 ON m2.threadid=a2.threadid LIMIT %(batchsize)s)", {
+            'batchsize': opt.batchsize,
+        })
+        n = curs.rowcount
+
+        # Aliases without messages are no longer needed, and neither are
+        # their copies of the list tags. The pages of the messages are
+        # already tagged with the new thread, so there is nothing to purge.
+        curs.execute("DELETE FROM thread_aliases a WHERE NOT EXISTS (SELECT 1 FROM messages m WHERE m.threadid=a.threadid) RETURNING threadid")
+        done = [r[0] for r in curs.fetchall()]
+        if done:
+            curs.execute("DELETE FROM list_threads WHERE threadid=ANY(%(threads)s)", {
+                'threads': done,
+            })
+        conn.commit()
+
+        moved += n
+        removed += len(done)
+        batches += 1
+        log.status("Moved %s messages, removed %s thread aliases" % (n, len(done)))
+        if n < opt.batchsize or (opt.maxbatches and batches >= opt.maxbatches):
+            break
+        time.sleep(opt.sleep)
+
+    curs.execute("SELECT count(*) FROM thread_aliases")
+    left = curs.fetchone()[0]
+    conn.close()
+    log.log("Moved %s messages to their new thread and removed %s thread aliases in %s batches, %s aliases left" % (moved, removed, batches, left))
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#
+# fill_fti.py - fill in the full text index of messages that were loaded
+# or reparsed with --defer-fti, in id order, using a pool of workers.
+#
+
+import os
+import sys
+
+from optparse import OptionParser
+from configparser import ConfigParser
+from datetime import datetime
+
+import psycopg2
+
+from lib.log import log
+from lib.fti import FtiFiller
+
+
+if __name__ == "__main__":
+    optparser = OptionParser()
+    optparser.add_option('--workers', dest='workers', type='int', default=4, help='Number of worker processes (default 4)')
+    optparser.add_option('--batch-size', dest='batchsize', type='int', default=1000, help='Number of messages to index in each transaction (default 1000)')
+    optparser.add_option('-v', '--verbose', dest='verbose', action='store_true', help='Verbose output')
+
+    (opt, args) = optparser.parse_args()
+
+    if (len(args)):
+        print("No bare arguments accepted")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if opt.workers < 1 or opt.batchsize < 1:
+        print("Workers and batch size must be at least 1")
+        sys.exit(1)
+
+    log.set(opt.verbose)
+
+    cfg = ConfigParser()
+    cfg.read('%s/archives.ini' % os.path.realpath(os.path.dirname(sys.argv[0])))
+    try:
+        connstr = cfg.get('db', 'connstr')
+    except Exception:
+        connstr = 'need_connstr'
+
+    conn = psycopg2.connect(connstr)
+
+    filler = FtiFiller(conn, connstr, opt.workers, opt.batchsize)
+    totalcount = filler.pending()
+    firststatus = datetime.now()
+
+    def _status():
+        left = filler.pending()
+        num = max(totalcount - left, 0)
+        elapsed = (datetime.now() - firststatus).seconds
+        sys.stdout.write("%s messages indexed (%s%%, %s / second), %s left\r" % (
+            num, totalcount and num * 100 // totalcount or 0, elapsed and num // elapsed or 0, left))
+        sys.stdout.flush()
+
+    num = filler.fill(_status)
+    print("")
+    print("%s messages indexed, %s still pending" % (num, filler.pending()))
+    conn.close()
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 #
 # hide_message.py - hide a message (spam etc) in the archives, including
-# frontend expiry.
+# frontend expiry (sent by purge_daemon.py).
 #
 
 import os
@@ -12,7 +12,8 @@ from configparser import ConfigParser
 
 import psycopg2
 
-from lib.varnish import VarnishPurger
+from lib.varnish import queue_purges
+from lib.storage import list_change_purges
 
 reasons = [
     None,  # Placeholder for 0
@@ -48,14 +49,14 @@ if __name__ == "__main__":
     conn = psycopg2.connect(connstr)
     curs = conn.cursor()
 
-    curs.execute("SELECT id, threadid, hiddenstatus FROM messages WHERE messageid=%(msgid)s", {
+    curs.execute("SELECT id, COALESCE(a.canonical, m.threadid), hiddenstatus, m.date, ARRAY(SELECT listid FROM list_threads lt WHERE lt.threadid=m.threadid) FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE messageid=%(msgid)s", {
         'msgid': opt.msgid,
     })
     if curs.rowcount <= 0:
         print("Message not found.")
         sys.exit(1)
 
-    id, threadid, previous = curs.fetchone()
+    id, threadid, previous, date, lists = curs.fetchone()
 
     # Message found, ask for reason
     reason = 0
@@ -83,6 +84,15 @@ if __name__ == "__main__":
         conn.close()
         sys.exit(0)
 
+    # The date lists of the day, and the pages of the messages before
+    # and after it on its lists, only show visible messages.
+    purges = set([int(threadid)])
+    purges.update(list_change_purges(curs, [(id, listid, date) for listid in lists]))
+
+    # Only visible messages are in list_messages and list_days
+    curs.execute("SELECT archives_remove_messages(%(ids)s)", {
+        'ids': [id],
+    })
     curs.execute("UPDATE messages SET hiddenstatus=%(new)s WHERE id=%(id)s", {
         'new': reason,
         'id': id,
@@ -91,9 +101,12 @@ if __name__ == "__main__":
         print("Failed to update! Not hiding!")
         conn.rollback()
         sys.exit(0)
-    conn.commit()
+    curs.execute("SELECT archives_add_messages(%(ids)s)", {
+        'ids': [id],
+    })
 
-    VarnishPurger(cfg).purge([int(threadid), ])
+    queue_purges(curs, purges)
+    conn.commit()
     conn.close()
 
-    print("Message hidden and varnish purge triggered.")
+    print("Message hidden and varnish purge queued.")
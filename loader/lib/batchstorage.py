@@ -0,0 +1,263 @@
+import datetime
+import io
+
+from lib.parser import PARSER_VERSION
+from lib.storage import purge_affected
+from lib.threadresolver import ThreadResolver
+from lib.log import log, opstatus
+
+# Ids handed out while resolving a batch, before we know how many real
+# ones we need. They sort after all real ids, in the order they were
+# handed out, just like values coming out of the sequences would.
+_TEMPID_BASE = 2 ** 62
+
+
+def _copy_value(v):
+    # Format a value for COPY in text format
+    if v is None:
+        return '\\N'
+    if isinstance(v, bool):
+        return v and 't' or 'f'
+    if isinstance(v, (bytes, bytearray)):
+        return '\\\\x' + v.hex()
+    if isinstance(v, datetime.datetime):
+        return v.isoformat()
+    if isinstance(v, list):
+        # Array of text
+        v = '{%s}' % ','.join(['"%s"' % e.replace('\\', '\\\\').replace('"', '\\"') for e in v])
+    return str(v).replace('\\', '\\\\').replace('\n', '\\n').replace('\r', '\\r').replace('\t', '\\t')
+
+
+def copy_rows(curs, table, columns, rows):
+    if not rows:
+        return
+    f = io.StringIO()
+    for r in rows:
+        f.write('\t'.join([_copy_value(v) for v in r]))
+        f.write('\n')
+    f.seek(0)
+    curs.copy_expert("COPY %s (%s) FROM STDIN" % (table, ", ".join(columns)), f)
+
+
+class _TempIds(object):
+    def __init__(self):
+        self.ids = []
+
+    def __call__(self):
+        self.ids.append(_TEMPID_BASE + len(self.ids))
+        return self.ids[-1]
+
+    def allocate(self, curs, sequence):
+        # Get real values from the sequence for all the temporary ids that
+        # we handed out, and return a map from temporary to real.
+        if not self.ids:
+            return {}
+        curs.execute("SELECT nextval(%(seq)s) FROM generate_series(1, %(num)s)", {
+            'seq': sequence,
+            'num': len(self.ids),
+        })
+        return dict(zip(self.ids, sorted([r[0] for r in curs.fetchall()])))
+
+
+class ArchivesBatchStorage(object):
+    # Store analyzed messages for one list in batches, with a fixed number
+    # of statements per batch instead of per message. The threading is
+    # resolved in memory by ThreadResolver, using the same rules as
+    # ArchivesParserStorage.store(), after which all changes are written
+    # using set based statements and COPY. Only plain loads are supported,
+    # not overwriting existing messages.
+    def __init__(self, conn, listid, batchsize=1000):
+        self.conn = conn
+        self.listid = listid
+        self.batchsize = batchsize
+        self.pending = []
+        self.purges = set()
+
+    def add(self, ap):
+        self.pending.append(ap)
+        if len(self.pending) >= self.batchsize:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            with opstatus.phase('store'):
+                self.store(self.pending)
+            for ap in self.pending:
+                self.purges.update(ap.purges)
+            self.pending = []
+
+    def store(self, parsers):
+        curs = self.conn.cursor()
+        listid = self.listid
+
+        tempids = _TempIds()
+        tempthreads = _TempIds()
+        resolver = ThreadResolver(tempids, tempthreads)
+
+        # Load everything the resolution of this batch can depend on: the
+        # messages themselves (if they already exist) and all their
+        # potential parents, any unresolved messages waiting for one of
+        # them, and which of those threads are already on our list.
+        timer = opstatus.start()
+        msgids = list(set([ap.msgid for ap in parsers]))
+        wanted = set(msgids)
+        for ap in parsers:
+            wanted.update(ap.parents)
+        curs.execute("SELECT id, messageid, COALESCE(a.canonical, m.threadid) FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE messageid=ANY(%(msgids)s)", {
+            'msgids': list(wanted),
+        })
+        for id, messageid, threadid in curs.fetchall():
+            resolver.add_existing(messageid, id, threadid)
+        curs.execute("SELECT u.message, u.priority, u.msgid, m.messageid, COALESCE(a.canonical, m.threadid) FROM unresolved_messages u INNER JOIN messages m ON m.id=u.message LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE u.msgid=ANY(%(msgids)s)", {
+            'msgids': msgids,
+        })
+        for message, priority, msgid, messageid, threadid in curs.fetchall():
+            resolver.add_existing(messageid, message, threadid)
+            resolver.add_unresolved(message, priority, msgid)
+        curs.execute("SELECT threadid FROM list_threads WHERE listid=%(listid)s AND threadid=ANY(%(threads)s)", {
+            'listid': listid,
+            'threads': list(set(resolver.threads.values())),
+        })
+        for threadid, in curs.fetchall():
+            resolver.add_tag(threadid)
+        opstatus.stop('lookup', timer)
+
+        months = set()
+        stored = []
+        threadpurges = []
+        newtags = set()
+        newparents = {}
+        removed_unresolved = {}
+        for ap in parsers:
+            months.add((ap.date.year, ap.date.month))
+            r = resolver.resolve(ap.msgid, ap.parents)
+            if r.newtag:
+                newtags.add(r.threadid)
+
+            if r.status == 'tagged':
+                log.status("Tagging message %s with list %s" % (ap.msgid, listid))
+                opstatus.tagged += 1
+                ap.purge_list_date(listid, ap.date)
+                threadpurges.append((ap, r.threadid))
+                continue
+            elif r.status == 'dupe':
+                log.status("Message %s already stored" % ap.msgid)
+                opstatus.dupes += 1
+                continue
+
+            for t in r.mergethreads:
+                log.status("Merging thread %s into thread %s" % (t, r.threadid))
+                threadpurges.append((ap, t))
+            if not r.newthread and (r.newtag or r.mergethreads):
+                # Every page of the thread shows the lists it is on
+                threadpurges.append((ap, r.threadid))
+            for c in r.children:
+                newparents[c] = r.id
+            for message, priority in r.removed_unresolved:
+                if message < _TEMPID_BASE:
+                    removed_unresolved[message] = min(priority, removed_unresolved.get(message, priority))
+            ap.parents = [p for i, p in r.unresolved]
+            stored.append((ap, r))
+            opstatus.stored += 1
+
+        timer = opstatus.start()
+
+        # Now that we know how many we need, get the real ids
+        idmap = tempids.allocate(curs, 'messages_id_seq')
+        threadmap = tempthreads.allocate(curs, 'threadid_seq')
+
+        def _id(id):
+            return idmap.get(id, id)
+
+        def _thread(threadid):
+            threadid = resolver.thread(threadid)
+            return threadmap.get(threadid, threadid)
+
+        for ap, t in threadpurges:
+            ap.purge_thread(_thread(t))
+
+        curs.execute("INSERT INTO list_months (listid, year, month) SELECT %(listid)s, y, m FROM unnest(%(years)s::int[], %(months)s::int[]) t(y, m) ON CONFLICT DO NOTHING", {
+            'listid': listid,
+            'years': [y for y, m in months],
+            'months': [m for y, m in months],
+        })
+
+        # Merge threads that already existed into their new threads (see
+        # thread_aliases).
+        merges = [(t, _thread(t)) for t in resolver.merged if t < _TEMPID_BASE]
+        if merges:
+            curs.execute("SELECT archives_merge_threads(array_agg(m.old), m.new) FROM unnest(%(old)s::int[], %(new)s::int[]) m(old, new) GROUP BY m.new", {
+                'old': [o for o, n in merges],
+                'new': [n for o, n in merges],
+            })
+
+        if newtags:
+            curs.execute("INSERT INTO list_threads (threadid, listid) SELECT DISTINCT t, %(listid)s FROM unnest(%(threads)s::int[]) t ON CONFLICT DO NOTHING RETURNING threadid", {
+                'listid': listid,
+                'threads': [_thread(t) for t in newtags],
+            })
+            curs.execute("SELECT archives_add_threads(%(threads)s, %(listid)s)", {
+                'threads': [r[0] for r in curs.fetchall()],
+                'listid': listid,
+            })
+
+        for ap, r in stored:
+            ap.id = _id(r.id)
+            ap.parentid = newparents.get(r.id, r.parentid)
+            if ap.parentid:
+                ap.parentid = _id(ap.parentid)
+            ap.threadid = _thread(r.threadid)
+            ap.children = [_id(c) for c in r.children]
+            log.status("Message %s, got id %s, set thread %s, parent %s" % (
+                ap.msgid, ap.id, ap.threadid, ap.parentid))
+
+        copy_rows(curs, 'messages', ('id', 'parentid', 'threadid', '_from', '_to', 'cc', 'subject', 'date', 'has_attachment', 'messageid', 'bodytxt', 'rawtxt', 'parserversion', 'charsets'), [(
+            ap.id,
+            ap.parentid,
+            ap.threadid,
+            ap._from,
+            ap.to or '',
+            ap.cc or '',
+            ap.subject or '',
+            ap.date,
+            len(ap.attachments) > 0,
+            ap.msgid,
+            ap.bodytxt,
+            ap.rawtxt,
+            PARSER_VERSION,
+            sorted(ap.charsets),
+        ) for ap, r in stored])
+        curs.execute("SELECT archives_add_messages(%(ids)s)", {
+            'ids': [ap.id for ap, r in stored],
+        })
+
+        copy_rows(curs, 'attachments', ('message', 'filename', 'contenttype', 'attachment'), [(
+            ap.id,
+            a[0] or 'unknown_filename',
+            a[1],
+            a[2],
+        ) for ap, r in stored for a in ap.attachments])
+
+        # Messages from before this batch that got a new parent
+        repointed = [(c, _id(p)) for c, p in newparents.items() if c < _TEMPID_BASE]
+        if repointed:
+            log.status("Setting %s other messages to children" % len(repointed))
+            curs.execute("UPDATE messages SET parentid=c.parent FROM unnest(%(ids)s::int[], %(parents)s::int[]) c(id, parent) WHERE messages.id=c.id", {
+                'ids': [c for c, p in repointed],
+                'parents': [p for c, p in repointed],
+            })
+
+        if removed_unresolved:
+            curs.execute("DELETE FROM unresolved_messages u USING unnest(%(messages)s::int[], %(priorities)s::int[]) d(message, priority) WHERE u.message=d.message AND u.priority >= d.priority", {
+                'messages': list(removed_unresolved.keys()),
+                'priorities': list(removed_unresolved.values()),
+            })
+
+        copy_rows(curs, 'unresolved_messages', ('message', 'priority', 'msgid'), [
+            (_id(message), priority, msgid)
+            for message, entries in resolver.unresolved_by_message.items() if message >= _TEMPID_BASE
+            for priority, msgid in entries.items()
+        ])
+        opstatus.stop('write', timer)
+
+        purge_affected(curs, [ap for ap, r in stored])
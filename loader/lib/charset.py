@@ -0,0 +1,85 @@
+import codecs
+
+# Charset names found in the wild that python doesn't know, or knows as
+# something else, mapped to what we decode them as. Keys are lowercase.
+# More can be added in the [charsets] section of archives.ini.
+aliases = {
+    # Special case where we don't know... We'll assume us-ascii and use
+    # replacements
+    'unknown-8bit': 'us-ascii',
+    'x-unknown': 'us-ascii',
+    'unknown': 'us-ascii',
+    # Seriously broken charset definitions, map to us-ascii and throw
+    # away the rest with replacements
+    '0': 'us-ascii',
+    'x-user-defined': 'us-ascii',
+    '_autodetect_all': 'us-ascii',
+    'default_charset': 'us-ascii',
+    # Some MUAs set it to x-gbk, but there is a valid declaratoin as gbk...
+    'x-gbk': 'gbk',
+    # -I is a special logical version, but should be the same charset
+    'iso-8859-8-i': 'iso-8859-8',
+    # This is an alias for iso-8859-11
+    'windows-874': 'iso-8859-11',
+    # Strange way of saying 8859....
+    'iso-88-59-1': 'iso-8859-1',
+    'iso-8858-1': 'iso-8859-1',
+    'iso885915': 'iso-8859-15',
+    'iso-latin-2': 'iso-8859-2',
+    # Strange spelling of cp850 (windows charset)
+    'iso-850': 'cp850',
+    'koi8r': 'koi8-r',
+    'cp 1252': 'cp1252',
+    # Why did this show up more than once?!
+    'iso-8859-1,iso-8859-2': 'iso-8859-1',
+    'iso-8859-1:utf8:us-ascii': 'iso-8859-1',
+    'x-windows-949': 'ms949',
+    # This is a locale, and not a charset, but most likely it's this one
+    'pt_pt': 'iso-8859-1',
+    'de_latin': 'iso-8859-1',
+    'de': 'iso-8859-1',
+    # How is this a *common* mistake?
+    'iso-8858-15': 'iso-8859-15',
+    'macintosh': 'mac_roman',
+    'cn-big5': 'big5',
+    'x-unicode-2-0-utf-7': 'utf-7',
+    'shift-jis': 'shift_jisx0213',
+    'jis': 'shift_jisx0213',
+    # No support for this charset :S Map it down to ascii and throw away
+    # all the rest. sucks, but we have to
+    'tscii': 'us-ascii',
+}
+
+# Charset as found in the message -> codec, or None if unknown
+_codecs = {}
+
+
+def add_aliases(newaliases):
+    aliases.update(dict([(k.lower(), v) for k, v in newaliases.items()]))
+    _codecs.clear()
+
+
+def load_aliases(cfg):
+    # Add any aliases from the [charsets] section of archives.ini
+    if cfg.has_section('charsets'):
+        add_aliases(dict(cfg.items('charsets')))
+
+
+def clean_charset(charset):
+    return aliases.get(charset.lower(), charset)
+
+
+def lookup_codec(charset):
+    # Return the codec to decode charset with, or None if there is none.
+    # The result is cached, so each distinct charset string is only
+    # looked up once.
+    if charset not in _codecs:
+        try:
+            codec = codecs.lookup(clean_charset(charset))
+            # Things like base64 are codecs, but not charsets
+            if not getattr(codec, '_is_text_encoding', True):
+                codec = None
+        except LookupError:
+            codec = None
+        _codecs[charset] = codec
+    return _codecs[charset]
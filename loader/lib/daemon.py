@@ -0,0 +1,314 @@
+import os
+import queue
+import socket
+import threading
+import time
+
+import psycopg2
+
+from lib.storage import ArchivesParserStorage
+from lib.log import log, opstatus
+from lib.varnish import queue_purges
+from lib.locks import lock_loader
+
+
+class Delivery(object):
+    # A message handed to the daemon, and how to tell whoever handed it
+    # over how it went. done is called with the delivery once the result
+    # is committed, with code set to what load_message.py would have
+    # exited with, and temporary set if the failure was not caused by the
+    # message itself.
+    def __init__(self, listname, rawtxt, src, done):
+        self.listname = listname
+        self.rawtxt = rawtxt
+        self.src = src
+        self.done = done
+        self.code = 1
+        self.message = None
+        self.temporary = False
+        self.finished = False
+
+    def finish(self):
+        # Only report once, whatever happens to the batch afterwards
+        if self.finished:
+            return
+        self.finished = True
+        try:
+            self.done(self)
+        except Exception as e:
+            log.error("Failed to report result for %s: %s" % (self.src, e))
+
+
+class LoaderDaemon(object):
+    # Loads messages handed to submit() using one long lived connection.
+    # Messages that arrive within window seconds of each other are loaded
+    # in the same transaction (with a savepoint around each of them, so
+    # one failing message doesn't take the others with it), and the
+    # varnish purges of them all are queued together.
+    def __init__(self, cfg, connstr, window=0.2, maxbatch=100, statsprom=None, function=False):
+        self.cfg = cfg
+        self.connstr = connstr
+        self.window = window
+        self.maxbatch = maxbatch
+        self.statsprom = statsprom
+        self.function = function
+        self.queue = queue.Queue()
+        self.stopping = False
+        self.conn = None
+
+    def submit(self, delivery):
+        self.queue.put(delivery)
+
+    def stop(self):
+        self.stopping = True
+
+    def connect(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(self.connstr)
+            self.conn.cursor().execute("SET statement_timeout='30s'")
+            self.conn.commit()
+        return self.conn
+
+    def run(self):
+        # Process batches until stopped, and then whatever is left
+        while True:
+            try:
+                first = self.queue.get(timeout=1)
+            except queue.Empty:
+                if self.stopping:
+                    break
+                continue
+            batch = [first]
+            deadline = time.time() + self.window
+            while len(batch) < self.maxbatch:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.process(batch)
+            except Exception as e:
+                # Don't let one batch stop the daemon, and don't leave
+                # whoever handed its messages over waiting for ever.
+                log.error("Failed to process batch of %s messages: %s" % (len(batch), e))
+                if self.conn:
+                    try:
+                        self.conn.rollback()
+                    except Exception:
+                        self.conn = None
+                for d in batch:
+                    if not d.finished:
+                        d.code = 1
+                        d.message = "Failed to load message: %s" % e
+                        d.temporary = True
+                        d.finish()
+        if self.conn:
+            self.conn.close()
+
+    def _parse(self, d):
+        # Parsing is done before taking the lock, so others are held up
+        # for as short a time as possible.
+        opstatus.bytes += len(d.rawtxt)
+        # Any error here is caused by the message itself, so it fails
+        # just this delivery, for good, and not the whole batch.
+        ap = ArchivesParserStorage()
+        try:
+            with opstatus.phase('parse'):
+                ap.parse_bytes(d.rawtxt)
+            with opstatus.phase('analyze'):
+                ap.analyze()
+        except Exception as e:
+            return (ap, e)
+        return (ap, None)
+
+    def _log_failed(self, curs, listid, d, ap, err):
+        try:
+            msgid = ap.msgid
+        except Exception:
+            msgid = "<unknown>"
+        log.error("Failed to load message (msgid %s) from %s: %s" % (msgid, d.src, err))
+        curs.execute("INSERT INTO loaderrors (listid, msgid, srctype, src, err) VALUES (%(listid)s, %(msgid)s, 'daemon', %(src)s, %(err)s)", {
+            'listid': listid,
+            'msgid': msgid,
+            'src': d.src,
+            'err': str(err),
+        })
+
+    def process(self, batch):
+        parsed = [(d, self._parse(d)) for d in batch]
+        purges = set()
+        try:
+            conn = self.connect()
+            curs = conn.cursor()
+            # Only lock the messages and threads we load, so other loaders
+            # can run at the same time, except those that need to be alone.
+            lock_loader(curs, False)
+            curs.execute("SELECT listname, listid FROM lists WHERE listname=ANY(%(lists)s)", {
+                'lists': list(set([d.listname for d in batch])),
+            })
+            listids = dict(curs.fetchall())
+
+            for d, (ap, err) in parsed:
+                if d.listname not in listids:
+                    d.message = "List %s not found" % d.listname
+                    log.error(d.message)
+                    continue
+                listid = listids[d.listname]
+                if err:
+                    self._log_failed(curs, listid, d, ap, err)
+                    opstatus.failed += 1
+                    d.message = "Failed to load message: %s" % err
+                    continue
+                stored = opstatus.stored
+                curs.execute("SAVEPOINT message")
+                try:
+                    with opstatus.phase('store'):
+                        ap.store(conn, listid, keyedlocks=True, function=self.function)
+                except Exception as e:
+                    curs.execute("ROLLBACK TO SAVEPOINT message")
+                    log.error("Failed to store message %s from %s: %s" % (ap.msgid, d.src, e))
+                    opstatus.failed += 1
+                    d.message = "Failed to store message: %s" % e
+                    # Timeouts waiting for locks, deadlocks and the like
+                    # aren't caused by the message, so it can be tried
+                    # again later.
+                    d.temporary = isinstance(e, psycopg2.OperationalError)
+                    continue
+                curs.execute("RELEASE SAVEPOINT message")
+                purges.update(ap.purges)
+                d.code = 0
+                if opstatus.stored != stored:
+                    d.message = "Stored message with message-id %s" % ap.msgid
+                else:
+                    d.message = "Message with message-id %s already stored" % ap.msgid
+
+            queue_purges(curs, purges)
+            with opstatus.phase('commit'):
+                conn.commit()
+        except Exception as e:
+            # Nothing in the batch got committed
+            log.error("Failed to load batch of %s messages: %s" % (len(batch), e))
+            for d in batch:
+                d.code = 1
+                d.message = "Failed to load message: %s" % e
+                d.temporary = True
+            try:
+                self.conn.rollback()
+            except Exception:
+                # Connection is broken, so reconnect for the next batch
+                self.conn = None
+
+        log.status("Loaded batch of %s messages" % len(batch))
+        for d in batch:
+            d.finish()
+
+        if self.statsprom:
+            opstatus.write_prometheus(self.statsprom, 'load_daemon')
+
+
+class SocketListener(object):
+    # Accept messages on a UNIX socket. The client sends the name of the
+    # list on the first line, followed by the message, and closes its end
+    # for writing. It then gets a line back with the exit code and a
+    # message, once the message has been committed.
+    def __init__(self, daemon, path, mode=0o660):
+        self.daemon = daemon
+        self.path = path
+        if os.path.exists(path):
+            os.unlink(path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, mode)
+        self.sock.listen(64)
+        self.sock.settimeout(1)
+
+    def run(self):
+        while not self.daemon.stopping:
+            try:
+                s, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            threading.Thread(target=self._receive, args=(s, ), daemon=True).start()
+        self.sock.close()
+        os.unlink(self.path)
+
+    def _receive(self, s):
+        try:
+            s.settimeout(60)
+            chunks = []
+            while True:
+                b = s.recv(65536)
+                if not b:
+                    break
+                chunks.append(b)
+            data = b''.join(chunks)
+            (listname, sep, rawtxt) = data.partition(b'\n')
+            if not sep or not rawtxt:
+                self._reply(s, 1, "Incomplete message received")
+                return
+        except Exception as e:
+            log.error("Failed to receive message: %s" % e)
+            s.close()
+            return
+        self.daemon.submit(Delivery(listname.decode('utf8', errors='ignore').strip(), rawtxt, "socket",
+                                    lambda d: self._reply(s, d.code, d.message)))
+
+    def _reply(self, s, code, message):
+        try:
+            s.sendall(("%s %s\n" % (code, message or '')).encode('utf8', errors='ignore'))
+        finally:
+            s.close()
+
+
+class SpoolWatcher(object):
+    # Pick up messages from files in a spool directory, with one
+    # subdirectory per list. Files starting with a period are ignored, so
+    # whoever writes them can write to a temporary name and rename it when
+    # it's complete. Loaded messages are removed, and those that fail are
+    # moved to the .failed subdirectory of their list, unless the failure
+    # was temporary in which case they are retried.
+    def __init__(self, daemon, path, interval=1):
+        self.daemon = daemon
+        self.path = path
+        self.interval = interval
+        self.inflight = set()
+        self.lock = threading.Lock()
+
+    def run(self):
+        while not self.daemon.stopping:
+            self.scan()
+            time.sleep(self.interval)
+
+    def scan(self):
+        for listname in sorted(os.listdir(self.path)):
+            listdir = os.path.join(self.path, listname)
+            if listname.startswith('.') or not os.path.isdir(listdir):
+                continue
+            for fn in sorted(os.listdir(listdir)):
+                full = os.path.join(listdir, fn)
+                if fn.startswith('.') or not os.path.isfile(full):
+                    continue
+                with self.lock:
+                    if full in self.inflight:
+                        continue
+                    self.inflight.add(full)
+                with open(full, 'rb') as f:
+                    rawtxt = f.read()
+                self.daemon.submit(Delivery(listname, rawtxt, full, self._done))
+
+    def _done(self, d):
+        full = d.src
+        try:
+            if d.code == 0:
+                os.unlink(full)
+            elif not d.temporary:
+                faileddir = os.path.join(os.path.dirname(full), '.failed')
+                if not os.path.isdir(faileddir):
+                    os.mkdir(faileddir)
+                os.rename(full, os.path.join(faileddir, os.path.basename(full)))
+        finally:
+            with self.lock:
+                self.inflight.discard(full)
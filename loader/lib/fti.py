@@ -0,0 +1,67 @@
+from multiprocessing import Pool
+
+import psycopg2
+
+from lib.log import log
+
+
+def defer_fti(curs):
+    # Have messages stored or updated on this connection marked as pending
+    # full text indexing, instead of indexed right away. See
+    # messages_fti_trigger_func() in sql/schema.sql.
+    curs.execute("SELECT set_config('archives.defer_fti', 'on', false)")
+
+
+def _init_worker(verbose):
+    log.set(verbose)
+
+
+def _fill_worker(connstr, batchsize):
+    # Runs in the worker process, with a connection of its own. Each batch
+    # is the lowest ids that are pending and that no other worker has
+    # claimed, committed on its own. Returns the number of messages filled.
+    conn = psycopg2.connect(connstr)
+    curs = conn.cursor()
+    filled = 0
+    while True:
+        curs.execute("UPDATE messages SET fti=archives_message_fti(subject, bodytxt), fti_pending=false WHERE id IN (SELECT id FROM messages WHERE fti_pending ORDER BY id LIMIT %(num)s FOR UPDATE SKIP LOCKED)", {
+            'num': batchsize,
+        })
+        n = curs.rowcount
+        conn.commit()
+        if n == 0:
+            break
+        filled += n
+        log.status("Filled fti of %s messages" % n)
+    conn.close()
+    return filled
+
+
+class FtiFiller(object):
+    # Fill in the fti of all messages that are pending, using a pool of
+    # worker processes. This can run while messages are being loaded,
+    # including with deferred indexing, and be stopped and started again
+    # at any time.
+    def __init__(self, conn, connstr, workers, batchsize):
+        self.conn = conn
+        self.connstr = connstr
+        self.workers = workers
+        self.batchsize = batchsize
+
+    def pending(self):
+        curs = self.conn.cursor()
+        curs.execute("SELECT count(*) FROM messages WHERE fti_pending")
+        r = curs.fetchone()[0]
+        self.conn.commit()
+        return r
+
+    def fill(self, status=None):
+        # Returns the number of messages filled in. status, if given, is
+        # called every few seconds while the workers are running.
+        with Pool(self.workers, initializer=_init_worker, initargs=(log.verbose, )) as pool:
+            result = pool.starmap_async(_fill_worker, [(self.connstr, self.batchsize)] * self.workers)
+            while not result.ready():
+                result.wait(5)
+                if status:
+                    status()
+            return sum(result.get())
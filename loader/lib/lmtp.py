@@ -0,0 +1,194 @@
+import asyncio
+import socket
+
+from lib.daemon import Delivery
+from lib.log import log
+
+
+class LmtpListener(object):
+    # Accept messages over LMTP (RFC 2033), for recipients named
+    # <listname>@<anything>, and hand them to the loader daemon. Since
+    # LMTP gives a status for each recipient after DATA, each recipient
+    # is loaded as a separate delivery of the message, and gets the
+    # result of that.
+    #
+    # At most maxconnections clients are served at the same time, and
+    # at most maxpending messages are waiting for the loader. A message
+    # that can't be queued within queuetimeout seconds is rejected with
+    # a temporary error, so the MTA tries again later, and so is one the
+    # loader hasn't finished within loadtimeout seconds.
+    def __init__(self, daemon, host, port, maxconnections=20, maxpending=100, queuetimeout=60, maxsize=50 * 1024 * 1024, loadtimeout=300):
+        self.daemon = daemon
+        self.host = host
+        self.port = port
+        self.maxconnections = maxconnections
+        self.maxpending = maxpending
+        self.queuetimeout = queuetimeout
+        self.maxsize = maxsize
+        self.loadtimeout = loadtimeout
+        self.hostname = socket.gethostname()
+        self.connections = 0
+
+    def run(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.pending = asyncio.Semaphore(self.maxpending)
+        server = await asyncio.start_server(self._handle, self.host, self.port, limit=1024 * 1024)
+        async with server:
+            while not self.daemon.stopping:
+                await asyncio.sleep(1)
+
+    async def _handle(self, reader, writer):
+        if self.connections >= self.maxconnections:
+            writer.write(b"421 4.3.2 Too many connections, try again later\r\n")
+            await self._close(writer)
+            return
+        self.connections += 1
+        try:
+            await self._session(reader, writer)
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, asyncio.TimeoutError) as e:
+            log.status("LMTP connection closed: %s" % e)
+        finally:
+            self.connections -= 1
+            await self._close(writer)
+
+    async def _close(self, writer):
+        try:
+            await writer.drain()
+            writer.close()
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+    def _reply(self, writer, *lines):
+        writer.write(b''.join([(l + "\r\n").encode('utf8', errors='ignore') for l in lines]))
+
+    async def _session(self, reader, writer):
+        self._reply(writer, "220 %s LMTP pgarchives loader ready" % self.hostname)
+        mailfrom = None
+        recipients = []
+        while True:
+            await writer.drain()
+            line = await asyncio.wait_for(reader.readline(), 300)
+            if not line:
+                return
+            (cmd, sep, arg) = line.decode('utf8', errors='ignore').strip().partition(' ')
+            cmd = cmd.upper()
+            if cmd == 'LHLO':
+                self._reply(writer,
+                            "250-%s" % self.hostname,
+                            "250-PIPELINING",
+                            "250-ENHANCEDSTATUSCODES",
+                            "250-8BITMIME",
+                            "250 SIZE %s" % self.maxsize)
+            elif cmd == 'MAIL':
+                if not arg.upper().startswith('FROM:'):
+                    self._reply(writer, "501 5.5.4 Syntax: MAIL FROM:<address>")
+                    continue
+                mailfrom = arg[5:].strip()
+                recipients = []
+                self._reply(writer, "250 2.1.0 OK")
+            elif cmd == 'RCPT':
+                if mailfrom is None:
+                    self._reply(writer, "503 5.5.1 Need MAIL first")
+                    continue
+                if not arg.upper().startswith('TO:'):
+                    self._reply(writer, "501 5.5.4 Syntax: RCPT TO:<address>")
+                    continue
+                address = arg[3:].strip().split(' ')[0].strip('<>')
+                listname = address.split('@')[0].lower()
+                if not listname:
+                    self._reply(writer, "550 5.1.3 Bad recipient address")
+                    continue
+                recipients.append((address, listname))
+                self._reply(writer, "250 2.1.5 OK")
+            elif cmd == 'DATA':
+                if not recipients:
+                    self._reply(writer, "503 5.5.1 Need RCPT first")
+                    continue
+                self._reply(writer, "354 End data with <CR><LF>.<CR><LF>")
+                await writer.drain()
+                rawtxt = await self._read_data(reader)
+                if rawtxt is None:
+                    self._reply(writer, *["552 5.3.4 Message too big"] * len(recipients))
+                else:
+                    self._reply(writer, *(await self._deliver(rawtxt, recipients)))
+                mailfrom = None
+                recipients = []
+            elif cmd == 'RSET':
+                mailfrom = None
+                recipients = []
+                self._reply(writer, "250 2.0.0 OK")
+            elif cmd == 'NOOP':
+                self._reply(writer, "250 2.0.0 OK")
+            elif cmd == 'QUIT':
+                self._reply(writer, "221 2.0.0 Bye")
+                return
+            elif cmd in ('HELO', 'EHLO'):
+                self._reply(writer, "500 5.5.1 This is LMTP, use LHLO")
+            else:
+                self._reply(writer, "502 5.5.2 Command not recognized")
+
+    async def _read_data(self, reader):
+        # Read the message up to the terminating period, undoing the dot
+        # stuffing, and with newlines the way they would be when piped to
+        # load_message.py. Returns None if the message is too big, after
+        # reading all of it.
+        lines = []
+        size = 0
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 300)
+            if not line:
+                raise ConnectionError("Connection closed during DATA")
+            if line in (b".\r\n", b".\n"):
+                break
+            if line.startswith(b'.'):
+                line = line[1:]
+            if line.endswith(b"\r\n"):
+                line = line[:-2] + b"\n"
+            size += len(line)
+            if size <= self.maxsize:
+                lines.append(line)
+        if size > self.maxsize:
+            return None
+        return b''.join(lines)
+
+    async def _deliver(self, rawtxt, recipients):
+        # Returns the status lines, one for each recipient
+        try:
+            await asyncio.wait_for(self.pending.acquire(), self.queuetimeout)
+        except asyncio.TimeoutError:
+            return ["451 4.3.2 <%s> Archive loader busy, try again later" % address for address, listname in recipients]
+        try:
+            futures = []
+            for address, listname in recipients:
+                future = self.loop.create_future()
+                self.daemon.submit(Delivery(listname, rawtxt, "lmtp",
+                                            lambda d, future=future: self.loop.call_soon_threadsafe(self._resolve, future, d)))
+                futures.append(future)
+            try:
+                results = await asyncio.wait_for(asyncio.gather(*futures), self.loadtimeout)
+            except asyncio.TimeoutError:
+                log.error("Loader did not finish %s deliveries within %s seconds" % (len(recipients), self.loadtimeout))
+                return ["451 4.3.0 <%s> Archive loader did not respond, try again later" % address for address, listname in recipients]
+        finally:
+            self.pending.release()
+
+        status = []
+        for (address, listname), d in zip(recipients, results):
+            # Errors from the database can span several lines
+            message = " ".join((d.message or '').split())
+            if d.code == 0:
+                status.append("250 2.0.0 <%s> %s" % (address, message))
+            elif d.temporary:
+                status.append("451 4.3.0 <%s> %s" % (address, message))
+            else:
+                status.append("550 5.6.0 <%s> %s" % (address, message))
+        return status
+
+    def _resolve(self, future, d):
+        # The future is cancelled if we stopped waiting for the loader
+        if not future.done():
+            future.set_result(d)
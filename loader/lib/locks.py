@@ -0,0 +1,50 @@
+# Locking between concurrent loaders.
+#
+# Every loader takes the global loader lock. Loaders that depend on being
+# alone, because they cache what they have looked up or store messages in
+# batches, take it exclusively, and everything else waits for them. Other
+# loaders take it shared, and then only lock the messageids and threads
+# each message they store can affect, so messages in unrelated threads
+# can be loaded at the same time.
+#
+# Keyed locks are transaction level advisory locks, using the two-key
+# form so they can never collide with the global lock. Messageids are
+# hashed, and a collision only means some unneeded waiting. Each set of
+# locks is taken in order of the keys, so that one set can't deadlock
+# with another.
+#
+# That doesn't hold across messages stored in the same transaction (the
+# batches of the loader daemon, and directory or mbox loads with keyed
+# locks), which keep the locks of the earlier messages while taking
+# those of the next one. Deadlocks between such loaders are expected:
+# store() undoes the message it was storing and retries a few times, but
+# that only releases the locks of that message, so the same deadlock can
+# come back. Once the retries run out the error is raised, and the
+# daemon reports the message as a temporary failure to be delivered
+# again later.
+
+LOADER_LOCK = 8059944559669076
+
+_MSGID_LOCK = 1
+_THREAD_LOCK = 2
+
+
+def lock_loader(curs, exclusive=True):
+    if exclusive:
+        curs.execute("SELECT pg_advisory_xact_lock(%(key)s)", {'key': LOADER_LOCK})
+    else:
+        curs.execute("SELECT pg_advisory_xact_lock_shared(%(key)s)", {'key': LOADER_LOCK})
+
+
+def lock_messageids(curs, msgids):
+    curs.execute("SELECT pg_advisory_xact_lock(%(class)s, h) FROM (SELECT DISTINCT hashtext(m) AS h FROM unnest(%(msgids)s::text[]) m ORDER BY 1) s", {
+        'class': _MSGID_LOCK,
+        'msgids': list(msgids),
+    })
+
+
+def lock_threads(curs, threadids):
+    curs.execute("SELECT pg_advisory_xact_lock(%(class)s, t) FROM (SELECT DISTINCT t FROM unnest(%(threads)s::int[]) t ORDER BY 1) s", {
+        'class': _THREAD_LOCK,
+        'threads': list(threadids),
+    })
@@ -1,3 +1,9 @@
+import json
+import os
+import time
+from collections import Counter
+
+
 class Log(object):
     def __init__(self):
         self.verbose = False
@@ -19,16 +25,144 @@ class Log(object):
         opstatus.print_status()
 
 
+class _NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *args):
+        pass
+
+
+class _Phase(object):
+    def __init__(self, opstatus, name):
+        self.opstatus = opstatus
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *args):
+        self.opstatus.add_time(self.name, time.time() - self.start)
+
+
+_nophase = _NoPhase()
+
+
 class OpStatus(object):
+    # Counters kept are always printed. Timing of the different phases of
+    # processing (which can nest, for example "html" is part of "analyze")
+    # is only collected when enabled with set_timing(), and costs next to
+    # nothing otherwise.
     def __init__(self):
+        self.starttime = time.time()
+        self.timing = False
+        # phase -> [calls, seconds]
+        self.phases = {}
+        # Size of the raw messages processed
+        self.bytes = 0
         self.stored = 0
         self.dupes = 0
         self.tagged = 0
         self.failed = 0
         self.overwritten = 0
+        self.cachehits = 0
+        self.cachemisses = 0
+        self.headeronly = 0
+        # charset -> number of messages it was found in
+        self.unknown_charsets = Counter()
+
+    def set_timing(self, timing):
+        self.timing = timing
+
+    def phase(self, name):
+        # Context manager timing a phase
+        if self.timing:
+            return _Phase(self, name)
+        return _nophase
+
+    def start(self):
+        # For timing a phase without a context manager. Pass the returned
+        # value to stop().
+        if self.timing:
+            return time.time()
+        return None
+
+    def stop(self, name, start):
+        if start is not None:
+            self.add_time(name, time.time() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        if name not in self.phases:
+            self.phases[name] = [0, 0.0]
+        self.phases[name][0] += calls
+        self.phases[name][1] += seconds
+
+    def messages(self):
+        return self.stored + self.dupes + self.tagged + self.failed + self.overwritten
+
+    def summary(self):
+        elapsed = time.time() - self.starttime
+        return {
+            'stored': self.stored,
+            'tagged': self.tagged,
+            'dupes': self.dupes,
+            'failed': self.failed,
+            'overwritten': self.overwritten,
+            'headeronly': self.headeronly,
+            'cachehits': self.cachehits,
+            'cachemisses': self.cachemisses,
+            'unknown_charsets': dict(self.unknown_charsets),
+            'bytes': self.bytes,
+            'elapsed': elapsed,
+            'messages_per_second': elapsed and self.messages() / elapsed or 0,
+            'bytes_per_second': elapsed and self.bytes / elapsed or 0,
+            'phases': dict([(k, {'calls': c, 'seconds': t}) for k, (c, t) in self.phases.items()]),
+        }
+
+    def print_timing(self):
+        if not self.phases:
+            return
+        elapsed = time.time() - self.starttime
+        print("%s messages (%s bytes) in %.1fs, %.1f messages/second" % (self.messages(), self.bytes, elapsed, elapsed and self.messages() / elapsed or 0))
+        for name, (calls, seconds) in sorted(self.phases.items(), key=lambda p: -p[1][1]):
+            print("  %-12s %8s calls %9.2fs %5.1f%%" % (name, calls, seconds, elapsed and 100 * seconds / elapsed or 0))
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.summary(), f, indent=2, sort_keys=True)
+            f.write("\n")
+
+    def write_prometheus(self, filename, job):
+        # Write in the format of the node_exporter textfile collector. We
+        # write to a temporary file and rename it, so the collector never
+        # sees a half written file.
+        s = self.summary()
+        labels = 'job="%s"' % job
+        lines = []
+        for k in ('stored', 'tagged', 'dupes', 'failed', 'overwritten', 'headeronly', 'cachehits', 'cachemisses', 'bytes'):
+            lines.append('pgarchives_loader_%s{%s} %s' % (k, labels, s[k]))
+        for c, n in sorted(s['unknown_charsets'].items()):
+            lines.append('pgarchives_loader_unknown_charset_messages{%s,charset="%s"} %s' % (labels, c.replace('\\', '\\\\').replace('"', '\\"'), n))
+        lines.append('pgarchives_loader_elapsed_seconds{%s} %s' % (labels, s['elapsed']))
+        lines.append('pgarchives_loader_messages_per_second{%s} %s' % (labels, s['messages_per_second']))
+        for name, p in sorted(s['phases'].items()):
+            lines.append('pgarchives_loader_phase_calls{%s,phase="%s"} %s' % (labels, name, p['calls']))
+            lines.append('pgarchives_loader_phase_seconds{%s,phase="%s"} %s' % (labels, name, p['seconds']))
+        lines.append('pgarchives_loader_last_run_timestamp{%s} %s' % (labels, int(time.time())))
+        with open(filename + '.tmp', 'w') as f:
+            f.write("\n".join(lines))
+            f.write("\n")
+        os.rename(filename + '.tmp', filename)
 
     def print_status(self):
         print("%s stored, %s new-list tagged, %s dupes, %s failed, %s overwritten" % (self.stored, self.tagged, self.dupes, self.failed, self.overwritten))
+        if self.headeronly:
+            print("%s already stored messages handled using only their headers" % self.headeronly)
+        if self.unknown_charsets:
+            print("Unknown charsets, decoded as us-ascii: %s" % ", ".join(["%s (%s messages)" % (c, n) for c, n in self.unknown_charsets.most_common()]))
+        lookups = self.cachehits + self.cachemisses
+        if lookups:
+            print("Message cache: %s hits, %s misses, %.1f%% hit rate" % (self.cachehits, self.cachemisses, 100.0 * self.cachehits / lookups))
 
 
 log = Log()
@@ -1,54 +1,86 @@
-from subprocess import Popen, PIPE
-from io import BytesIO
+import gzip
+import mmap
+import re
 
-# The hack of all hacks...
 # The python mbox parser fails to split some messages from mj2
-# correctly - they appear to be too far out of spec. However,
-# formail does it right. So open a formail pipe on the mbox,
-# reassemble it to one long stream with a unique separator,
-# and then split it apart again in python.. Isn't it cute?
-SEPARATOR = "ABCARCHBREAK123" * 50
-bSEPARATOR = bytes(SEPARATOR, 'ascii')
+# correctly - they appear to be too far out of spec. formail does it
+# right, and we used to run the mbox through a formail pipe. Instead, we
+# now apply the same rules as formail directly on a memory mapped copy
+# of the file:
+#
+# * A message starts with a "From " line, at the start of the file or
+#   directly following an empty line.
+# * The "From " line must be followed by at least two consecutive valid
+#   header fields (formail's default -m 2). This is what keeps us from
+#   splitting on unescaped "From " lines in the body of a message.
+#
+# Each message is returned as a memoryview slice of the file, from the
+# "From " line up to (and including) the empty line preceding the next
+# message, so nothing is copied until the message is actually parsed.
+_re_candidate = re.compile(rb'\n\nFrom ')
+_re_start = re.compile(rb'From [^\n]*\n(?:[!-9;-~]+[ \t]*:[^\n]*\n(?:[ \t][^\n]*\n)*){2}')
 
 
 class MailboxBreakupParser(object):
-    def __init__(self, fn):
+    def __init__(self, fn, offset=0):
         self.EOF = False
+        self._file = None
+        self._mmap = None
 
         if fn.endswith(".gz"):
-            file_stream = Popen(['zcat', fn], stdout=PIPE).stdout
+            with gzip.open(fn, 'rb') as f:
+                self.data = f.read()
         else:
-            file_stream = open(fn, 'rb')
-        formail_cmd = "formail -s /bin/sh -c 'cat && echo %s'" % (SEPARATOR,)
-        self.pipe = Popen(formail_cmd, shell=True, stdin=file_stream, stdout=PIPE, stderr=PIPE)
-        # Allow self.pipe to receive a SIGPIPE if zcat exits.
-        file_stream.close()
+            self._file = open(fn, 'rb')
+            try:
+                self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self.data = self._mmap
+            except ValueError:
+                # Empty files can't be mapped
+                self.data = b''
+        self.view = memoryview(self.data)
+        self.size = len(self.data)
 
-    def returncode(self):
-        self.pipe.wait()
-        return self.pipe.returncode
+        # Offset in the file of the next message to return, and of the
+        # one most recently returned.
+        self.offset = offset
+        self.lastoffset = None
 
-    def stderr_output(self):
-        return self.pipe.stderr.read()
+    def close(self):
+        self.view.release()
+        if self._mmap:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # A message is still referenced by the caller. The map
+                # goes away when that reference does.
+                pass
+        if self._file:
+            self._file.close()
 
-    def __next__(self):
-        sio = BytesIO()
+    def _next_start(self, pos):
+        # Find the start of the next message after pos, or the end of the
+        # file if there is none.
         while True:
-            try:
-                l = next(self.pipe.stdout)
-            except StopIteration:
-                # End of file!
-                self.EOF = True
-                if sio.tell() == 0:
-                    # Nothing read yet, so return None instead of an empty
-                    # bytesio
-                    return None
-                sio.seek(0)
-                return sio
-            if l.rstrip() == bSEPARATOR:
-                # Reached a separator. Meaning we're not at end of file,
-                # but we're at end of message.
-                sio.seek(0)
-                return sio
-            # Otherwise, append it to where we are now
-            sio.write(l)
+            m = _re_candidate.search(self.data, pos)
+            if not m:
+                return self.size
+            if _re_start.match(self.data, m.start() + 2):
+                return m.start() + 2
+            pos = m.start() + 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.offset >= self.size:
+            self.EOF = True
+            raise StopIteration()
+
+        start = self.offset
+        end = self._next_start(start)
+        self.lastoffset = start
+        self.offset = end
+        if end >= self.size:
+            self.EOF = True
+        return self.view[start:end]
@@ -0,0 +1,155 @@
+from collections import OrderedDict
+
+from lib.log import opstatus
+
+
+class _LRU(object):
+    def __init__(self, size, evicted=None):
+        self.size = size
+        self.evicted = evicted
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __setitem__(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            k, v = self.entries.popitem(last=False)
+            if self.evicted:
+                self.evicted(k, v)
+
+    def pop(self, key):
+        v = self.entries.pop(key, None)
+        if v is not None and self.evicted:
+            self.evicted(key, v)
+
+    def clear(self):
+        self.entries.clear()
+
+
+class MessageCache(object):
+    # Cache of what the messages and unresolved_messages tables contain,
+    # owned by a single loader run, so that ArchivesParserStorage.store()
+    # can skip the lookups for messages it has already seen (typically the
+    # parents of a message, stored a few seconds earlier from the same
+    # mbox).
+    #
+    # This is only valid as long as nobody else modifies these tables,
+    # which is guaranteed by the advisory lock the loader holds for the
+    # duration of its transaction. Whenever that transaction ends, the
+    # cache has to be cleared.
+    #
+    # Thread merges are not applied to the cached entries, instead we keep
+    # track of which thread every merged thread went into, and resolve
+    # that when reading from the cache.
+    def __init__(self, size=10000):
+        # messageid -> (id, threadid), or None if the message is known not
+        # to exist.
+        self.messages = _LRU(size)
+        # messageid -> {message: priority}, for all unresolved entries
+        # waiting for messageid.
+        self.unresolved = _LRU(size, self._unresolved_evicted)
+        # message -> set of messageids with a cached unresolved entry for
+        # message, so they can be found when the entries are removed.
+        self.waiting = {}
+        # threadid -> threadid it was merged into
+        self.merged = {}
+
+    def clear(self):
+        self.messages.clear()
+        self.unresolved.clear()
+        self.waiting = {}
+        self.merged = {}
+
+    def thread(self, threadid):
+        while threadid in self.merged:
+            threadid = self.merged[threadid]
+        return threadid
+
+    def get_messages(self, msgids):
+        # Returns a list of (id, messageid, threadid) for the messages in
+        # msgids that exist, or None if any of them isn't in the cache.
+        if not msgids:
+            return []
+        r = []
+        for msgid in msgids:
+            if msgid not in self.messages:
+                opstatus.cachemisses += 1
+                return None
+            m = self.messages.get(msgid)
+            if m:
+                r.append((m[0], msgid, self.thread(m[1])))
+        opstatus.cachehits += 1
+        return r
+
+    def add_messages(self, msgids, rows):
+        # Register the result of looking up msgids in the database, rows
+        # being (id, messageid, threadid).
+        for msgid in msgids:
+            self.messages[msgid] = None
+        for id, msgid, threadid in rows:
+            self.messages[msgid] = (id, threadid)
+
+    def add_message(self, msgid, id, threadid):
+        self.messages[msgid] = (id, threadid)
+
+    def get_unresolved(self, msgid):
+        # Returns a list of (message, priority, threadid) waiting for msgid,
+        # ordered by threadid, or None if we don't know.
+        entries = self.unresolved.get(msgid)
+        if entries is None:
+            opstatus.cachemisses += 1
+            return None
+        rows = []
+        for message, (priority, threadid) in entries.items():
+            rows.append((message, priority, self.thread(threadid)))
+        opstatus.cachehits += 1
+        return sorted(rows, key=lambda r: r[2])
+
+    def set_unresolved(self, msgid, rows):
+        # Register the complete list of (message, priority, threadid) that
+        # is waiting for msgid.
+        self.unresolved.pop(msgid)
+        self.unresolved[msgid] = dict([(message, (priority, threadid)) for message, priority, threadid in rows])
+        for message, priority, threadid in rows:
+            self.waiting.setdefault(message, set()).add(msgid)
+
+    def add_unresolved(self, message, priority, msgid, threadid):
+        # If we know what's waiting for msgid, the new entry has to be
+        # added. If not, we'll find it in the database when needed.
+        entries = self.unresolved.get(msgid)
+        if entries is not None:
+            entries[message] = (priority, threadid)
+            self.waiting.setdefault(message, set()).add(msgid)
+
+    def remove_unresolved(self, message, priority):
+        # Mirrors DELETE FROM unresolved_messages WHERE message=message AND
+        # priority >= priority.
+        for msgid in list(self.waiting.get(message, ())):
+            entries = self.unresolved.get(msgid)
+            if entries and message in entries and entries[message][0] >= priority:
+                del entries[message]
+                self.waiting[message].discard(msgid)
+        if not self.waiting.get(message, True):
+            del self.waiting[message]
+
+    def _unresolved_evicted(self, msgid, entries):
+        for message in entries:
+            s = self.waiting.get(message)
+            if s:
+                s.discard(msgid)
+                if not s:
+                    del self.waiting[message]
+
+    def merge_threads(self, oldthreads, threadid):
+        for t in oldthreads:
+            if t != threadid:
+                self.merged[t] = threadid
@@ -0,0 +1,112 @@
+import time
+from collections import deque
+from multiprocessing import Pool
+
+from lib.storage import ArchivesParserStorage
+from lib.exception import IgnorableException
+from lib.log import log, opstatus
+from lib.charset import aliases, add_aliases
+
+
+def _init_worker(verbose, charset_aliases):
+    log.set(verbose)
+    add_aliases(charset_aliases)
+
+
+def _parse_worker(rawtxt, filter_msgid, date_override):
+    # Runs in the worker process. Returns the analyzed parser (without its
+    # MIME tree, see ArchivesParser.__getstate__), any IgnorableException
+    # raised, and the time spent.
+    start = time.time()
+    ap = ArchivesParserStorage()
+    if filter_msgid:
+        ap.parse_headers(rawtxt)
+        if not ap.is_msgid(filter_msgid):
+            return (None, None, time.time() - start)
+    ap.parse_bytes(rawtxt)
+    try:
+        ap.analyze(date_override=date_override)
+    except IgnorableException as e:
+        return (ap, e, time.time() - start)
+    return (ap, None, time.time() - start)
+
+
+class ParallelParser(object):
+    # Parse and analyze messages in a pool of worker processes, while
+    # handing the results back to the caller in the original order, so
+    # that the storing (and thereby threading) is identical to a serial
+    # load.
+    def __init__(self, workers, filter_msgid=None, date_override=None, window=None):
+        self.workers = workers
+        self.filter_msgid = filter_msgid
+        self.date_override = date_override
+        # Number of messages in flight at any time. Bounded, so we don't
+        # read the whole mbox into memory if the storing is slower than
+        # the parsing.
+        self.window = window or workers * 16
+
+        self.parsed = 0
+        self.parsebytes = 0
+        self.parsetime = 0.0
+        self.stored = 0
+        self.storetime = 0.0
+        self.walltime = 0.0
+        # Value of the position callback for the message last handed back
+        self.position = None
+
+    def parse(self, messages, position=None):
+        # messages is an iterable of raw messages (bytes). Yields tuples
+        # of (parser, exception) in the same order as the input, skipping
+        # messages removed by the msgid filter. If given, position is
+        # called after reading each message from the input, and what it
+        # returns is available in self.position while that message is
+        # being handed back.
+        start = time.time()
+        pending = deque()
+        with Pool(self.workers, initializer=_init_worker, initargs=(log.verbose, aliases)) as pool:
+            source = iter(messages)
+            while True:
+                while len(pending) < self.window:
+                    try:
+                        rawtxt = next(source)
+                    except StopIteration:
+                        break
+                    self.parsebytes += len(rawtxt)
+                    pending.append((position and position(), pool.apply_async(_parse_worker, (rawtxt, self.filter_msgid, self.date_override))))
+                if not pending:
+                    break
+
+                pos, result = pending.popleft()
+                ap, err, elapsed = result.get()
+                self.parsed += 1
+                self.parsetime += elapsed
+                if opstatus.timing:
+                    # Spent in parallel, so not part of our wall time
+                    opstatus.add_time('workers', elapsed)
+                if ap is None:
+                    continue
+                # Counted in the worker, so we have to count them again
+                for c in ap.unknown_charsets:
+                    opstatus.unknown_charsets[c] += 1
+
+                # Whatever time passes until we're resumed is spent storing
+                # the message.
+                t = time.time()
+                self.position = pos
+                yield (ap, err)
+                self.storetime += time.time() - t
+                self.stored += 1
+        self.walltime = time.time() - start
+
+    def print_status(self):
+        def _rate(num, secs):
+            return secs and num / secs or 0
+
+        print("Parse stage: %s messages (%s bytes) in %.1fs worker time, %.1f messages/second per worker, %.1f messages/second aggregate" % (
+            self.parsed, self.parsebytes, self.parsetime,
+            _rate(self.parsed, self.parsetime),
+            _rate(self.parsed, self.walltime)))
+        print("Store stage: %s messages in %.1fs, %.1f messages/second" % (
+            self.stored, self.storetime, _rate(self.stored, self.storetime)))
+        print("Total: %s messages in %.1fs wall time, %.1f messages/second" % (
+            self.parsed, self.walltime, _rate(self.parsed, self.walltime)))
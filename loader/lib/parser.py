@@ -1,8 +1,10 @@
 import re
 import datetime
+import functools
 import dateutil.parser
+import email.utils
 
-from email.parser import BytesParser
+from email.parser import BytesParser, BytesHeaderParser
 from email.header import decode_header, Header
 from email.errors import HeaderParseError
 from email.policy import compat32
@@ -11,7 +13,13 @@ import tidylib
 import io
 
 from lib.exception import IgnorableException
-from lib.log import log
+from lib.log import log, opstatus
+from lib.charset import clean_charset, lookup_codec
+
+# Version of the parsing rules, stored with each message. Increase it
+# when a change here changes the bodytxt or attachments of already stored
+# messages, and run reparse_message.py --outdated.
+PARSER_VERSION = 1
 
 _re_received = re.compile(r'^from .*;([^(]+)(\s*\(envelope-from.*)?', re.I | re.DOTALL)
 
@@ -19,11 +27,50 @@ _re_received = re.compile(r'^from .*;([^(]+)(\s*\(envelope-from.*)?', re.I | re.
 class ArchivesParser(object):
     def __init__(self):
         self.parser = BytesParser(policy=compat32)
+        self.unknown_charsets = set()
+        # Charsets (lowercase, as named in the message) used by the headers
+        # and parts decoded by analyze()
+        self.charsets = set()
+        self._payloads = {}
+        self.decodes = 0
+        self.decodes_saved = 0
+        self.decode_bytes_saved = 0
 
     def parse(self, stream):
-        self.rawtxt = stream.read()
+        self.parse_bytes(stream.read())
+
+    def parse_bytes(self, rawtxt):
+        # rawtxt can be any bytes-like object, such as a memoryview slice
+        # of an mbox file. We need our own copy of it, since the source
+        # can go away before we store the message.
+        self.rawtxt = bytes(rawtxt)
         self.msg = self.parser.parse(io.BytesIO(self.rawtxt))
 
+    def parse_headers(self, rawtxt):
+        # Parse only the headers of the message, without copying or looking
+        # at the body. This is enough for is_msgid(), get_parents() and
+        # analyze_headers(), but not to analyze() the message.
+        size = 8192
+        while True:
+            chunk = bytes(rawtxt[:size])
+            end = chunk.find(b'\n\n')
+            if end >= 0:
+                chunk = chunk[:end + 2]
+                break
+            if size >= len(rawtxt):
+                break
+            size *= 4
+        self.msg = BytesHeaderParser(policy=compat32).parsebytes(chunk)
+
+    def __getstate__(self):
+        # When passed between processes, ship only the raw text and the
+        # results of analyze(). The full MIME tree is large and not needed
+        # once the message has been analyzed.
+        state = self.__dict__.copy()
+        state.pop('msg', None)
+        state.pop('_payloads', None)
+        return state
+
     def is_msgid(self, msgid):
         # Look for a specific messageid. This means we might parse it twice,
         # but so be it. Any exception means we know it's not this one...
@@ -34,120 +81,114 @@ class ArchivesParser(object):
             return False
 
     def analyze(self, date_override=None):
+        self.charsets = set()
         self.msgid = self.clean_messageid(self.decode_mime_header(self.get_mandatory('Message-ID')))
         self._from = self.decode_mime_header(self.get_mandatory('From'), True)
         self.to = self.decode_mime_header(self.get_optional('To'), True)
         self.cc = self.decode_mime_header(self.get_optional('CC'), True)
         self.subject = self.decode_mime_header(self.get_optional('Subject'))
-        if date_override:
-            self.date = self.forgiving_date_decode(date_override)
-        else:
-            self.date = self.forgiving_date_decode(self.decode_mime_header(self.get_mandatory('Date')))
-
-            # Accept times up to 4 hours in the future, for badly synced clocks
-            maxdate = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=4)
-            if self.date > maxdate:
-                # Date is in the future, we don't trust that. Instead, let's see if we can find
-                # it in the raw text of the message.
-                def _extract_date(d):
-                    m = _re_received.match(d)
-                    if m:
-                        try:
-                            return self.forgiving_date_decode(m.group(1).strip())
-                        except IgnorableException:
-                            pass
-
-                lowdate = min((x for x in map(_extract_date, self.msg.get_all('Received')) if x and x < maxdate))
-                if lowdate:
-                    self.date = lowdate
-                # Else we're going to go with what we found
+        self.date = self.get_date(date_override)
+        # Decoded payloads are shared between finding the body and the
+        # attachments, and dropped when we're done with them.
+        self._payloads = {}
+        self.decodes = 0
+        self.decodes_saved = 0
+        self.decode_bytes_saved = 0
         self.bodytxt = self.get_body()
         self.attachments = []
         self.get_attachments()
+        self._payloads = {}
         if len(self.attachments) > 0:
             log.status("Found %s attachments" % len(self.attachments))
 
+        self.parents = self.get_parents()
+
+    def analyze_headers(self, date_override=None):
+        # The part of analyze() that only needs the headers, which is all
+        # store() needs for a message that already exists.
+        self.msgid = self.clean_messageid(self.decode_mime_header(self.get_mandatory('Message-ID')))
+        self.date = self.get_date(date_override)
+
+    def get_date(self, date_override=None):
+        if date_override:
+            return self.forgiving_date_decode(date_override)
+
+        date = self.forgiving_date_decode(self.decode_mime_header(self.get_mandatory('Date')))
+        # Accept times up to 4 hours in the future, for badly synced clocks
+        maxdate = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=4)
+        if date > maxdate:
+            # Date is in the future, we don't trust that. Instead, let's see if we can find
+            # it in the raw text of the message.
+            def _extract_date(d):
+                m = _re_received.match(d)
+                if m:
+                    try:
+                        return self.forgiving_date_decode(m.group(1).strip())
+                    except IgnorableException:
+                        pass
+
+            lowdate = min((x for x in map(_extract_date, self.msg.get_all('Received')) if x and x < maxdate))
+            if lowdate:
+                date = lowdate
+            # Else we're going to go with what we found
+        return date
+
+    def get_parents(self):
         # Build an list of the message id's we are interested in
-        self.parents = []
+        parents = []
         # The first one is in-reply-to, if it exists
         if self.get_optional('in-reply-to'):
             m = self.clean_messageid(self.decode_mime_header(self.get_optional('in-reply-to')), True)
             if m:
-                self.parents.append(m)
+                parents.append(m)
 
         # Then we add all References values, in backwards order
         if self.get_optional('references'):
             cleaned_msgids = [self.clean_messageid(x, True) for x in reversed(self.decode_mime_header(self.get_optional('references')).split())]
-            # Can't do this with a simple self.parents.extend() due to broken
+            # Can't do this with a simple parents.extend() due to broken
             # mailers that add the same reference more than once. And we can't
             # use a set() to make it unique, because order is very important
             for m in cleaned_msgids:
-                if m and m not in self.parents:
-                    self.parents.append(m)
+                if m and m not in parents:
+                    parents.append(m)
+        return parents
 
     def clean_charset(self, charset):
-        lcharset = charset.lower()
-        if lcharset == 'unknown-8bit' or lcharset == 'x-unknown' or lcharset == 'unknown':
-            # Special case where we don't know... We'll assume
-            # us-ascii and use replacements
-            return 'us-ascii'
-        if lcharset == '0' or lcharset == 'x-user-defined' or lcharset == '_autodetect_all' or lcharset == 'default_charset':
-            # Seriously broken charset definitions, map to us-ascii
-            # and throw away the rest with replacements
-            return 'us-ascii'
-        if lcharset == 'x-gbk':
-            # Some MUAs set it to x-gbk, but there is a valid
-            # declaratoin as gbk...
-            return 'gbk'
-        if lcharset == 'iso-8859-8-i':
-            # -I is a special logical version, but should be the
-            # same charset
-            return 'iso-8859-8'
-        if lcharset == 'windows-874':
-            # This is an alias for iso-8859-11
-            return 'iso-8859-11'
-        if lcharset == 'iso-88-59-1' or lcharset == 'iso-8858-1':
-            # Strange way of saying 8859....
-            return 'iso-8859-1'
-        if lcharset == 'iso885915':
-            return 'iso-8859-15'
-        if lcharset == 'iso-latin-2':
-            return 'iso-8859-2'
-        if lcharset == 'iso-850':
-            # Strange spelling of cp850 (windows charset)
-            return 'cp850'
-        if lcharset == 'koi8r':
-            return 'koi8-r'
-        if lcharset == 'cp 1252':
-            return 'cp1252'
-        if lcharset == 'iso-8859-1,iso-8859-2' or lcharset == 'iso-8859-1:utf8:us-ascii':
-            # Why did this show up more than once?!
-            return 'iso-8859-1'
-        if lcharset == 'x-windows-949':
-            return 'ms949'
-        if lcharset == 'pt_pt' or lcharset == 'de_latin' or lcharset == 'de':
-            # This is a locale, and not a charset, but most likely it's this one
-            return 'iso-8859-1'
-        if lcharset == 'iso-8858-15':
-            # How is this a *common* mistake?
-            return 'iso-8859-15'
-        if lcharset == 'macintosh':
-            return 'mac_roman'
-        if lcharset == 'cn-big5':
-            return 'big5'
-        if lcharset == 'x-unicode-2-0-utf-7':
-            return 'utf-7'
-        if lcharset == 'shift-jis' or lcharset == 'jis':
-            return 'shift_jisx0213'
-        if lcharset == 'tscii':
-            # No support for this charset :S Map it down to ascii
-            # and throw away all the rest. sucks, but we have to
-            return 'us-ascii'
-        return charset
+        return clean_charset(charset)
+
+    def decode_bytes(self, b, charset):
+        # Like str(b, charset, errors='ignore'), but with broken charset
+        # names cleaned up, and charsets we don't know about decoded as
+        # us-ascii. Those are counted, and reported at the end of the load.
+        self.charsets.add(charset.lower())
+        codec = lookup_codec(charset)
+        if codec is None:
+            if charset not in self.unknown_charsets:
+                log.status("Unknown charset '%s', decoding as us-ascii" % charset)
+                self.unknown_charsets.add(charset)
+                opstatus.unknown_charsets[charset] += 1
+            codec = lookup_codec('us-ascii')
+        return codec.decode(b, 'ignore')[0]
+
+    def _decode_payload(self, part):
+        # Same as part.get_payload(decode=True), but decoding each part of
+        # the message only once, however many times we look at it while
+        # finding the body and the attachments.
+        key = id(part)
+        if key in self._payloads:
+            b = self._payloads[key]
+            self.decodes_saved += 1
+            if b:
+                self.decode_bytes_saved += len(b)
+            return b
+        b = part.get_payload(decode=True)
+        self._payloads[key] = b
+        self.decodes += 1
+        return b
 
     def get_payload_as_unicode(self, msg):
         try:
-            b = msg.get_payload(decode=True)
+            b = self._decode_payload(msg)
         except AssertionError:
             # Badly encoded data can throw an exception here, where the python
             # libraries fail to handle it and enters a cannot-happen path.
@@ -166,10 +207,7 @@ class ArchivesParser(object):
                     charset = v
                     break
             if charset:
-                try:
-                    return str(b, self.clean_charset(charset), errors='ignore')
-                except LookupError as e:
-                    raise IgnorableException("Failed to get unicode payload: %s" % e)
+                return self.decode_bytes(b, charset)
             else:
                 # XXX: reasonable default?
                 return str(b, errors='ignore')
@@ -235,7 +273,8 @@ class ArchivesParser(object):
         # Fallback, but what can we do at this point...
         b = self.recursive_first_plaintext(self.msg, True)
         if b:
-            b = self.html_clean(b)
+            with opstatus.phase('html'):
+                b = self.html_clean(b)
             if b:
                 return b
         if b == '' or b is None:
@@ -343,7 +382,7 @@ class ArchivesParser(object):
             # For now, accept anything not text/plain
             if container.get_content_type() != 'text/plain':
                 try:
-                    self.attachments.append((self._extract_filename(container), container.get_content_type(), container.get_payload(decode=True)))
+                    self.attachments.append((self._extract_filename(container), container.get_content_type(), self._decode_payload(container)))
                 except AssertionError:
                     # Badly encoded data can throw an exception here, where the python
                     # libraries fail to handle it and enters a cannot-happen path.
@@ -359,7 +398,7 @@ class ArchivesParser(object):
                 if k == 'name' and v != '':
                     # Yes, it has a name
                     try:
-                        self.attachments.append((self._extract_filename(container), container.get_content_type(), container.get_payload(decode=True)))
+                        self.attachments.append((self._extract_filename(container), container.get_content_type(), self._decode_payload(container)))
                     except AssertionError:
                         # Badly encoded data can throw an exception here, where the python
                         # libraries fail to handle it and enters a cannot-happen path.
@@ -371,7 +410,7 @@ class ArchivesParser(object):
             # If it's content-disposition=attachment, we also want to save it
             if 'Content-Disposition' in container and container['Content-Disposition'].startswith('attachment'):
                 try:
-                    self.attachments.append((self._extract_filename(container), container.get_content_type(), container.get_payload(decode=True)))
+                    self.attachments.append((self._extract_filename(container), container.get_content_type(), self._decode_payload(container)))
                 except AssertionError:
                     # Badly encoded data can throw an exception here, where the python
                     # libraries fail to handle it and enters a cannot-happen path.
@@ -388,7 +427,7 @@ class ArchivesParser(object):
                 # we need to explicitly exclude it again.
                 # For this reason, we need it in both bytes and string format, so we can apply the regexp
                 try:
-                    b = container.get_payload(decode=True)
+                    b = self._decode_payload(container)
                     s = self.get_payload_as_unicode(container)
                 except AssertionError:
                     # Badly encoded data can throw an exception here, where the python
@@ -425,9 +464,41 @@ class ArchivesParser(object):
     _date_multiminus_re = re.compile(r' -(-\d+)$')
     _date_offsetnoplus_re = re.compile(r' (\d{4})$')
 
+    # Dates that are plain RFC 2822, with a four digit year and a numeric
+    # offset (optionally followed by a comment), which is almost all of
+    # them. These can be parsed directly by the email package, which is
+    # much faster than going through all the workarounds below and the
+    # fuzzy parser.
+    _date_rfc2822_re = re.compile(r'^\s*(?:(?:Mon|Tue|Wed|Thu|Fri|Sat|Sun),\s+)?\d{1,2} (?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) \d{4} \d{2}:\d{2}(?::\d{2})? [+-]\d{4}(?: \([^()]*\))?\s*$')
+
     def forgiving_date_decode(self, d):
+        return self._forgiving_date_decode(d)
+
+    # The same dates show up over and over again, for example in the
+    # Received headers of messages that were posted at the same time.
+    @classmethod
+    @functools.lru_cache(maxsize=4096)
+    def _forgiving_date_decode(cls, d):
         if d.strip() == '':
             raise IgnorableException("Failed to parse empty date")
+        dp = cls._parse_date_fast(d)
+        if dp is None:
+            dp = cls._parse_date_fuzzy(d)
+        return dp
+
+    @classmethod
+    def _parse_date_fast(cls, d):
+        # Returns None if the date isn't in the strict format or can't be
+        # parsed, in which case we leave it to the fuzzy parsing.
+        if not cls._date_rfc2822_re.match(d):
+            return None
+        try:
+            return cls._fix_date(email.utils.parsedate_to_datetime(d))
+        except Exception:
+            return None
+
+    @classmethod
+    def _parse_date_fuzzy(cls, d):
         # Strange timezones requiring manual adjustments
         if d.endswith('-7700 (EST)'):
             d = d.replace('-7700 (EST)', 'EST')
@@ -464,47 +535,51 @@ class ArchivesParser(object):
         if d.find(' 0 (GMT)'):
             d = d.replace(' 0 (GMT)', ' +0000')
 
-        if self._date_multiminus_re.search(d):
-            d = self._date_multiminus_re.sub(' \\1', d)
+        if cls._date_multiminus_re.search(d):
+            d = cls._date_multiminus_re.sub(' \\1', d)
 
-        if self._date_offsetnoplus_re.search(d):
-            d = self._date_offsetnoplus_re.sub('+\\1', d)
+        if cls._date_offsetnoplus_re.search(d):
+            d = cls._date_offsetnoplus_re.sub('+\\1', d)
 
         # We have a number of dates in the format
         # "<full datespace> +0200 (MET DST)"
         # or similar. The problem coming from the space within the
         # parenthesis, or if the contents of the parenthesis is
         # completely empty
-        if self._date_multi_re.search(d):
-            d = self._date_multi_re.sub('', d)
+        if cls._date_multi_re.search(d):
+            d = cls._date_multi_re.sub('', d)
 
         # If the spec is instead
         # "<full datespace> +0200 (...)"
         # of any kind, we can just remove what's in the (), because the
         # parser is just going to rely on the fixed offset anyway.
-        if self._date_multi_re2.search(d):
-            d = self._date_multi_re2.sub(' \\1', d)
+        if cls._date_multi_re2.search(d):
+            d = cls._date_multi_re2.sub(' \\1', d)
 
         try:
-            dp = dateutil.parser.parse(d, fuzzy=True)
-
-            # Some offsets are >16 hours, which postgresql will not
-            # (for good reasons) accept
-            if dp.utcoffset() and abs(dp.utcoffset().days * (24 * 60 * 60) + dp.utcoffset().seconds) > 60 * 60 * 16 - 1:
-                # Convert it to a UTC timestamp using Python. It will give
-                # us the right time, but the wrong timezone. Should be
-                # enough...
-                dp = datetime.datetime(*dp.utctimetuple()[:6])
-            if not dp.tzinfo:
-                dp = dp.replace(tzinfo=datetime.timezone.utc)
-            return dp
+            return cls._fix_date(dateutil.parser.parse(d, fuzzy=True))
         except Exception as e:
             raise IgnorableException("Failed to parse date '%s': %s" % (d, e))
 
+    @classmethod
+    def _fix_date(cls, dp):
+        # Some offsets are >16 hours, which postgresql will not
+        # (for good reasons) accept
+        if dp.utcoffset() and abs(dp.utcoffset().days * (24 * 60 * 60) + dp.utcoffset().seconds) > 60 * 60 * 16 - 1:
+            # Convert it to a UTC timestamp using Python. It will give
+            # us the right time, but the wrong timezone. Should be
+            # enough...
+            dp = datetime.datetime(*dp.utctimetuple()[:6])
+        if not dp.tzinfo:
+            dp = dp.replace(tzinfo=datetime.timezone.utc)
+        return dp
+
     def _maybe_decode(self, s, charset):
         if isinstance(s, str):
             return s.strip(' ')
-        return str(s, charset and self.clean_charset(charset) or 'us-ascii', errors='ignore').strip(' ')
+        if not charset:
+            return str(s, 'us-ascii', errors='ignore').strip(' ')
+        return self.decode_bytes(s, charset).strip(' ')
 
     # Workaround for broken quoting in some MUAs (see below)
     _re_mailworkaround = re.compile(r'"(=\?[^\?]+\?[QB]\?[^\?]+\?=)"', re.IGNORECASE)
@@ -0,0 +1,187 @@
+import os
+import select
+import time
+
+import psycopg2
+
+from lib.log import log
+from lib.varnish import VarnishPurger
+
+
+class PurgeDaemon(object):
+    # Send the purges queued in pending_purges (see lib/varnish.py) to
+    # varnish. Woken up by a notification when new purges are committed,
+    # and otherwise checks every interval seconds for purges to retry.
+    #
+    # Each round claims up to batchsize keys, by pushing their next attempt
+    # lease seconds into the future, so more than one purger can run. A
+    # round with more than threshold thread and message keys has them
+    # replaced with the keys of the months their messages are in, if that
+    # means fewer keys, at the cost of purging more pages. The keys are
+    # sent to all frontends (see VarnishPurger), and if any of them fails,
+    # they are all tried again after a backoff that doubles with each
+    # attempt, up to maxbackoff seconds.
+    def __init__(self, cfg, connstr, threshold=200, batchsize=1000, lease=300, maxbackoff=600, interval=60, statsprom=None):
+        self.purger = VarnishPurger(cfg)
+        self.connstr = connstr
+        self.threshold = threshold
+        self.batchsize = batchsize
+        self.lease = lease
+        self.maxbackoff = maxbackoff
+        self.interval = interval
+        self.statsprom = statsprom
+        self.stopping = False
+        self.conn = None
+        self.purged = 0
+        self.failed = 0
+
+    def stop(self):
+        self.stopping = True
+
+    def connect(self):
+        # Every statement we run is on its own, so there are no
+        # transactions to hold locks on the queue.
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(self.connstr)
+            self.conn.autocommit = True
+            curs = self.conn.cursor()
+            curs.execute("SET statement_timeout='30s'")
+            curs.execute("LISTEN pending_purges")
+        return self.conn
+
+    def claim(self):
+        # Returns {key: generation}. Keys queued by transactions that have
+        # not committed yet are locked, and left for later.
+        curs = self.conn.cursor()
+        curs.execute("UPDATE pending_purges p SET nextattempt=CURRENT_TIMESTAMP + %(lease)s * interval '1 second' FROM (SELECT key FROM pending_purges WHERE nextattempt <= CURRENT_TIMESTAMP ORDER BY nextattempt LIMIT %(num)s FOR UPDATE SKIP LOCKED) c WHERE c.key=p.key RETURNING p.key, p.generation", {
+            'lease': self.lease,
+            'num': self.batchsize,
+        })
+        return dict(curs.fetchall())
+
+    def collapse(self, keys):
+        # Returns {key to send: [queued keys it covers]}
+        sources = dict([(k, [k]) for k in keys])
+        threadkeys = [k for k in keys if k.startswith('pgat_') or k.startswith('pgatt_')]
+        messagekeys = [k for k in keys if k.startswith('pgamsg_')]
+        if len(threadkeys) + len(messagekeys) <= self.threshold:
+            return sources
+        threads = list(set([int(k.split('_')[1]) for k in threadkeys]))
+
+        # The pages of a thread are tagged with the month of the message
+        # they are for, and merged threads are found through their alias.
+        curs = self.conn.cursor()
+        curs.execute("SELECT DISTINCT t.threadid, extract(year FROM t.date AT TIME ZONE 'UTC')::int, extract(month FROM t.date AT TIME ZONE 'UTC')::int FROM (SELECT m.threadid, m.date FROM messages m WHERE m.threadid=ANY(%(threads)s) UNION ALL SELECT a.canonical, m.date FROM thread_aliases a INNER JOIN messages m ON m.threadid=a.threadid WHERE a.canonical=ANY(%(threads)s)) t", {
+            'threads': threads,
+        })
+        months = {}
+        for threadid, year, month in curs.fetchall():
+            months.setdefault('pgatm_%s/%s' % (year, month), set()).update(
+                [k for k in ('pgat_%s' % threadid, 'pgatt_%s' % threadid) if k in sources])
+        curs.execute("SELECT id, extract(year FROM date AT TIME ZONE 'UTC')::int, extract(month FROM date AT TIME ZONE 'UTC')::int FROM messages WHERE id=ANY(%(ids)s)", {
+            'ids': [int(k[7:]) for k in messagekeys],
+        })
+        for id, year, month in curs.fetchall():
+            months.setdefault('pgatm_%s/%s' % (year, month), set()).add('pgamsg_%s' % id)
+        covered = set().union(*months.values())
+        if len(months) >= len(covered):
+            return sources
+
+        log.status("Collapsing %s thread and message keys into %s month keys" % (len(covered), len(months)))
+        for k in covered:
+            del sources[k]
+        for k, pagekeys in months.items():
+            sources[k] = list(pagekeys)
+        return sources
+
+    def _backoff(self, keys):
+        curs = self.conn.cursor()
+        curs.execute("UPDATE pending_purges SET attempts=attempts+1, nextattempt=CURRENT_TIMESTAMP + least(5 * 2 ^ attempts, %(max)s) * interval '1 second' WHERE key IN (SELECT key FROM pending_purges WHERE key=ANY(%(keys)s) FOR UPDATE SKIP LOCKED)", {
+            'keys': keys,
+            'max': self.maxbackoff,
+        })
+
+    def _done(self, claimed, keys):
+        # Only remove keys that have not been queued again since we
+        # claimed them, and skip those that are being queued right now.
+        curs = self.conn.cursor()
+        curs.execute("DELETE FROM pending_purges p USING unnest(%(keys)s::text[], %(generations)s::int[]) d(key, generation) WHERE d.key=p.key AND d.generation=p.generation AND p.key IN (SELECT key FROM pending_purges WHERE key=ANY(%(keys)s) FOR UPDATE SKIP LOCKED)", {
+            'keys': keys,
+            'generations': [claimed[k] for k in keys],
+        })
+
+    def process(self):
+        # Send everything that is due. Returns the number of keys purged.
+        purged = 0
+        while not self.stopping:
+            claimed = self.claim()
+            if not claimed:
+                break
+            sources = self.collapse(list(claimed.keys()))
+            if not self.purger.purge_keys(sorted(sources)):
+                self._backoff(list(claimed.keys()))
+                self.failed += len(claimed)
+                log.error("Failed to purge %s keys, will retry" % len(claimed))
+                # Varnish is unlikely to be back before the next round
+                break
+            self._done(claimed, list(claimed.keys()))
+            self.purged += len(claimed)
+            purged += len(claimed)
+            log.status("Purged %s keys as %s keys" % (len(claimed), len(sources)))
+        if self.statsprom:
+            self.write_prometheus(self.statsprom)
+        return purged
+
+    def write_prometheus(self, filename):
+        # Same format as OpStatus.write_prometheus(), with the counters of
+        # each frontend.
+        lines = [
+            'pgarchives_purge_keys{job="purge_daemon"} %s' % self.purged,
+            'pgarchives_purge_failed_keys{job="purge_daemon"} %s' % self.failed,
+        ]
+        for e in self.purger.endpoints:
+            labels = 'job="purge_daemon",endpoint="%s"' % e.name
+            for k, v in sorted(e.stats().items()):
+                lines.append('pgarchives_purge_endpoint_%s{%s} %s' % (k, labels, v))
+        lines.append('pgarchives_purge_last_run_timestamp{job="purge_daemon"} %s' % int(time.time()))
+        with open(filename + '.tmp', 'w') as f:
+            f.write("\n".join(lines))
+            f.write("\n")
+        os.rename(filename + '.tmp', filename)
+
+    def _timeout(self):
+        # Seconds until the next retry is due, but no more than interval.
+        # Keys that are due but locked by uncommitted transactions will be
+        # notified about on commit, so we don't need to spin for them.
+        curs = self.conn.cursor()
+        curs.execute("SELECT extract(epoch FROM min(nextattempt) - CURRENT_TIMESTAMP) FROM pending_purges")
+        r = curs.fetchone()[0]
+        if r is None:
+            return self.interval
+        return min(max(float(r), 1), self.interval)
+
+    def run(self, once=False):
+        # Process purges until stopped, or until nothing is due if once
+        while not self.stopping:
+            try:
+                conn = self.connect()
+                self.process()
+                if once:
+                    break
+                # Wake up every second to see if we've been stopped
+                deadline = time.time() + self._timeout()
+                while not self.stopping and time.time() < deadline:
+                    if select.select([conn], [], [], min(deadline - time.time(), 1)) != ([], [], []):
+                        conn.poll()
+                        conn.notifies.clear()
+                        break
+            except psycopg2.Error as e:
+                log.error("Database error, reconnecting: %s" % e)
+                if self.conn and not self.conn.closed:
+                    self.conn.close()
+                self.conn = None
+                if once:
+                    break
+                time.sleep(5)
+        if self.conn and not self.conn.closed:
+            self.conn.close()
@@ -0,0 +1,111 @@
+import heapq
+
+from lib.parser import ArchivesParser
+from lib.threadresolver import ThreadResolver
+from lib.exception import IgnorableException
+from lib.log import log
+
+
+def scan_headers(rawtxt):
+    # Get the messageid and parents of a message, looking only at the
+    # headers. Returns (None, []) for messages we can't get a messageid
+    # for, which will fail to load anyway.
+    ap = ArchivesParser()
+    try:
+        ap.parse_headers(rawtxt)
+        return (ap.clean_messageid(ap.decode_mime_header(ap.get_mandatory('Message-ID'))), ap.get_parents())
+    except IgnorableException:
+        return (None, [])
+    except Exception as e:
+        log.status("Failed to scan headers: %s" % e)
+        return (None, [])
+
+
+class MessageOrder(object):
+    # Find an order to load a set of messages in where parents come before
+    # their children, so we don't have to create (and later remove)
+    # unresolved entries, repoint children and merge threads. Within those
+    # constraints, the original order is kept as far as possible.
+    def __init__(self):
+        # (messageid, parents) for each message, in the original order
+        self.messages = []
+
+    def add(self, msgid, parents):
+        self.messages.append((msgid, parents))
+
+    def add_raw(self, rawtxt):
+        self.add(*scan_headers(rawtxt))
+
+    def order(self):
+        # Returns a list of indexes into the original messages
+        first = {}
+        for i, (msgid, parents) in enumerate(self.messages):
+            if msgid and msgid not in first:
+                first[msgid] = i
+
+        # A message depends on all of its parents that are part of this
+        # load. Duplicates of a message are loaded after the first one.
+        waitingfor = [0] * len(self.messages)
+        dependents = {}
+        for i, (msgid, parents) in enumerate(self.messages):
+            deps = set([first[p] for p in parents if p in first and first[p] != i])
+            if msgid and first[msgid] != i:
+                deps.add(first[msgid])
+            waitingfor[i] = len(deps)
+            for d in deps:
+                dependents.setdefault(d, []).append(i)
+
+        ready = [i for i in range(len(self.messages)) if waitingfor[i] == 0]
+        heapq.heapify(ready)
+        done = [False] * len(self.messages)
+        result = []
+        remaining = len(self.messages)
+        while remaining:
+            if not ready:
+                # Broken references have created a loop. Break it by taking
+                # the earliest message that's still waiting.
+                i = done.index(False)
+                log.status("Reference loop found at message %s" % self.messages[i][0])
+                heapq.heappush(ready, i)
+            i = heapq.heappop(ready)
+            if done[i]:
+                continue
+            done[i] = True
+            remaining -= 1
+            result.append(i)
+            for d in dependents.get(i, ()):
+                waitingfor[d] -= 1
+                if waitingfor[d] == 0 and not done[d]:
+                    heapq.heappush(ready, d)
+        return result
+
+    def simulate(self, order):
+        # Return the number of thread merges and unresolved entries a load
+        # in the given order would create, not counting anything that's
+        # already in the database.
+        ids = iter(range(1, len(self.messages) + 1))
+        threadids = iter(range(1, len(self.messages) + 1))
+        resolver = ThreadResolver(lambda: next(ids), lambda: next(threadids))
+        for i in order:
+            msgid, parents = self.messages[i]
+            if msgid:
+                resolver.resolve(msgid, parents)
+        return (resolver.merges, resolver.unresolved_added)
+
+    def print_status(self, order):
+        merges, unresolved = self.simulate(range(len(self.messages)))
+        newmerges, newunresolved = self.simulate(order)
+        moved = len([n for n, i in enumerate(order) if n != i])
+        print("Reordered %s of %s messages, avoiding %s thread merges and %s unresolved entries" % (
+            moved, len(self.messages), merges - newmerges, unresolved - newunresolved))
+
+
+def reorder(items, getraw):
+    # Return items (anything getraw() can turn into a raw message) in the
+    # order they should be loaded in.
+    mo = MessageOrder()
+    for x in items:
+        mo.add_raw(getraw(x))
+    order = mo.order()
+    mo.print_status(order)
+    return [items[i] for i in order]
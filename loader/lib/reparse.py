@@ -0,0 +1,255 @@
+import codecs
+import os
+import shutil
+from io import BytesIO
+from multiprocessing import Pool
+
+import psycopg2
+
+from lib.storage import ArchivesParserStorage
+from lib.parser import PARSER_VERSION
+from lib.exception import IgnorableException
+from lib.log import log
+from lib.charset import aliases, add_aliases
+from lib.fti import defer_fti
+from lib.varnish import queue_purges
+
+
+def _init_worker(verbose, charset_aliases):
+    log.set(verbose)
+    add_aliases(charset_aliases)
+
+
+def shard_filenames(shard):
+    return ("reparse.diffs.%s" % shard, "reparse.fromonly.%s" % shard)
+
+
+def message_filter(outdated, charsets):
+    # SQL conditions and parameters selecting the messages to reparse
+    where = "hiddenstatus IS NULL"
+    if outdated:
+        where += " AND parserversion < %(version)s"
+    if charsets:
+        where += " AND charsets && %(charsets)s::text[]"
+    return (where, {
+        'version': PARSER_VERSION,
+        'charsets': charsets and list(charsets) or [],
+    })
+
+
+def _reparse_shard(connstr, run, shard, update, date_override, batchsize, outdated, charsets, deferfti):
+    # Runs in the worker process, with a connection of its own. Processes
+    # the messages of one shard in batches of batchsize, and commits each
+    # batch together with the checkpoint, so the work of a batch is either
+    # all done or all redone.
+    conn = psycopg2.connect(connstr)
+    curs = conn.cursor()
+    if deferfti:
+        defer_fti(curs)
+    curs.execute("SELECT endid, lastid, done FROM reparse_checkpoints WHERE run=%(run)s AND shard=%(shard)s", {
+        'run': run,
+        'shard': shard,
+    })
+    endid, lastid, done = curs.fetchone()
+    if done:
+        conn.close()
+        return
+
+    if not update:
+        # Appended to when resuming. The diffs of a batch that was written
+        # but not checkpointed before a crash will show up twice.
+        (diffname, fromonlyname) = shard_filenames(shard)
+        f = codecs.open(diffname, "a", "utf-8")
+        fromonlyf = open(fromonlyname, "a")
+
+    (where, params) = message_filter(outdated, charsets)
+    while True:
+        params.update({
+            'lastid': lastid,
+            'endid': endid,
+            'num': batchsize,
+        })
+        curs.execute("SELECT id, rawtxt FROM messages WHERE " + where + " AND id > %(lastid)s AND id <= %(endid)s ORDER BY id LIMIT %(num)s", params)
+        rows = curs.fetchall()
+        if not rows:
+            break
+
+        updated = 0
+        failed = 0
+        purges = set()
+        for id, rawtxt in rows:
+            ap = ArchivesParserStorage()
+            ap.parse(BytesIO(rawtxt))
+            try:
+                ap.analyze(date_override=date_override)
+            except IgnorableException as e:
+                failed += 1
+                if update:
+                    print("Exception loading {0}: {1}".format(id, e))
+                else:
+                    f.write("Exception loading %s: %s" % (id, e))
+                continue
+
+            if update:
+                # Only purge threads where something actually changed
+                if ap.store(conn, listid=-9, overwrite=True):
+                    updated += 1
+                    purges.update(ap.purges)
+            else:
+                ap.diff(conn, f, fromonlyf, id)
+
+        if not update:
+            f.flush()
+            fromonlyf.flush()
+        lastid = rows[-1][0]
+        queue_purges(curs, purges)
+        curs.execute("UPDATE reparse_checkpoints SET lastid=%(lastid)s, processed=processed+%(processed)s, updated=updated+%(updated)s, failed=failed+%(failed)s, lastupdate=CURRENT_TIMESTAMP WHERE run=%(run)s AND shard=%(shard)s", {
+            'lastid': lastid,
+            'processed': len(rows),
+            'updated': updated,
+            'failed': failed,
+            'run': run,
+            'shard': shard,
+        })
+        conn.commit()
+
+    curs.execute("UPDATE reparse_checkpoints SET done=true, lastupdate=CURRENT_TIMESTAMP WHERE run=%(run)s AND shard=%(shard)s", {
+        'run': run,
+        'shard': shard,
+    })
+    conn.commit()
+    conn.close()
+    if not update:
+        f.close()
+        fromonlyf.close()
+
+
+class ShardedReparser(object):
+    # Reparse all messages by splitting them into ranges of ids (shards)
+    # that are handled by a pool of worker processes. Progress is kept in
+    # the reparse_checkpoints table under the name of the run, so that an
+    # interrupted run can be restarted and continue where it stopped.
+    # With outdated, only messages stored by an older version of the
+    # parser are reparsed, optionally only those using one of charsets.
+    def __init__(self, conn, connstr, run, workers, batchsize, update, date_override=None, outdated=False, charsets=None, deferfti=False):
+        self.conn = conn
+        self.connstr = connstr
+        self.run = run
+        self.workers = workers
+        self.batchsize = batchsize
+        self.update = update
+        self.date_override = date_override
+        self.outdated = outdated
+        self.charsets = charsets
+        self.deferfti = deferfti
+
+    def setup(self, numshards, restart=False):
+        # Returns True if we are resuming an earlier run
+        curs = self.conn.cursor()
+        if restart:
+            curs.execute("DELETE FROM reparse_checkpoints WHERE run=%(run)s", {'run': self.run})
+        curs.execute("SELECT count(*) FROM reparse_checkpoints WHERE run=%(run)s", {'run': self.run})
+        if curs.fetchone()[0] > 0:
+            self.conn.commit()
+            return True
+
+        (where, params) = message_filter(self.outdated, self.charsets)
+        curs.execute("SELECT min(id), max(id) FROM messages WHERE " + where, params)
+        minid, maxid = curs.fetchone()
+        if minid is not None:
+            size = (maxid - minid) // numshards + 1
+            for shard in range(numshards):
+                startid = minid + shard * size
+                if startid > maxid:
+                    break
+                curs.execute("INSERT INTO reparse_checkpoints (run, shard, startid, endid, lastid) VALUES (%(run)s, %(shard)s, %(startid)s, %(endid)s, %(lastid)s)", {
+                    'run': self.run,
+                    'shard': shard,
+                    'startid': startid,
+                    'endid': min(startid + size - 1, maxid),
+                    'lastid': startid - 1,
+                })
+        self.conn.commit()
+        return False
+
+    def count(self):
+        # Number of messages left to reparse
+        curs = self.conn.cursor()
+        (where, params) = message_filter(self.outdated, self.charsets)
+        curs.execute("SELECT count(*) FROM messages WHERE " + where, params)
+        r = curs.fetchone()[0]
+        self.conn.commit()
+        return r
+
+    def progress(self):
+        # Returns (processed, updated, failed, shards done, shards)
+        curs = self.conn.cursor()
+        curs.execute("SELECT coalesce(sum(processed), 0), coalesce(sum(updated), 0), coalesce(sum(failed), 0), count(*) FILTER (WHERE done), count(*) FROM reparse_checkpoints WHERE run=%(run)s", {
+            'run': self.run,
+        })
+        r = curs.fetchone()
+        self.conn.commit()
+        return r
+
+    def shards(self):
+        curs = self.conn.cursor()
+        curs.execute("SELECT shard FROM reparse_checkpoints WHERE run=%(run)s ORDER BY shard", {
+            'run': self.run,
+        })
+        r = [s for s, in curs.fetchall()]
+        self.conn.commit()
+        return r
+
+    def reparse(self, status=None):
+        # Run all shards that are not done yet. status, if given, is called
+        # every few seconds while the workers are running.
+        shards = self.shards()
+        with Pool(self.workers, initializer=_init_worker, initargs=(log.verbose, aliases)) as pool:
+            result = pool.starmap_async(_reparse_shard, [
+                (self.connstr, self.run, shard, self.update, self.date_override, self.batchsize, self.outdated, self.charsets, self.deferfti)
+                for shard in shards])
+            while not result.ready():
+                result.wait(5)
+                if status:
+                    status()
+            # Re-raise any exception from the workers. The checkpoints
+            # of the batches that were done are kept.
+            result.get()
+
+    def merge_diffs(self, diffname, fromonlyname):
+        # Concatenate the per-shard diff files in shard order, so the result
+        # is in the same order as a serial run.
+        with open(diffname, 'wb') as f, open(fromonlyname, 'wb') as fromonlyf:
+            for shard in self.shards():
+                for fn, out in zip(shard_filenames(shard), (f, fromonlyf)):
+                    if os.path.exists(fn):
+                        with open(fn, 'rb') as sf:
+                            shutil.copyfileobj(sf, out)
+                        os.unlink(fn)
+
+    def stamp_unaffected(self, chunksize=50000):
+        # When only the messages using some charsets were reparsed, the
+        # change of the parser is known not to affect the others. Those
+        # that were up to date with the previous version are so with this
+        # one too, so just record that, a chunk of ids at a time.
+        curs = self.conn.cursor()
+        curs.execute("SELECT min(id), max(id) FROM messages WHERE hiddenstatus IS NULL")
+        minid, maxid = curs.fetchone()
+        stamped = 0
+        if minid is not None:
+            for startid in range(minid, maxid + 1, chunksize):
+                curs.execute("UPDATE messages SET parserversion=%(version)s WHERE id >= %(startid)s AND id < %(endid)s AND hiddenstatus IS NULL AND parserversion=%(version)s-1 AND NOT charsets && %(charsets)s::text[]", {
+                    'version': PARSER_VERSION,
+                    'startid': startid,
+                    'endid': startid + chunksize,
+                    'charsets': list(self.charsets),
+                })
+                stamped += curs.rowcount
+                self.conn.commit()
+        return stamped
+
+    def finish(self):
+        # The run is complete, so a new run should start from the beginning
+        curs = self.conn.cursor()
+        curs.execute("DELETE FROM reparse_checkpoints WHERE run=%(run)s", {'run': self.run})
+        self.conn.commit()
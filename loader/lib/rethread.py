@@ -0,0 +1,298 @@
+import array
+from collections import Counter
+
+from lib.parser import ArchivesParser
+from lib.threadresolver import ThreadResolver
+from lib.batchstorage import copy_rows
+from lib.storage import list_change_purges
+from lib.exception import IgnorableException
+from lib.log import log, opstatus
+
+
+# Messages of the threads to rethread, with only the headers of the raw
+# text, since that's all we need to find the parents.
+_MESSAGES_QUERY = "SELECT m.id, m.messageid, m.threadid, COALESCE(a.canonical, m.threadid), COALESCE(m.parentid, 0), CASE WHEN position('\\x0a0a'::bytea IN m.rawtxt) > 0 THEN substring(m.rawtxt FROM 1 FOR position('\\x0a0a'::bytea IN m.rawtxt) + 1) ELSE m.rawtxt END FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid"
+
+
+def get_parents(headers):
+    ap = ArchivesParser()
+    try:
+        ap.parse_headers(headers)
+        return tuple(ap.get_parents())
+    except IgnorableException:
+        return ()
+    except Exception as e:
+        log.status("Failed to scan headers: %s" % e)
+        return ()
+
+
+class Rethreader(object):
+    # Work out the threading of all messages, or all messages in the
+    # threads of one list, from scratch. The messages are replayed in id
+    # order, which is the order they were loaded in, through the same
+    # rules store() uses (see ThreadResolver), with the messageids they
+    # have as parents in their headers.
+    #
+    # For a list, the threads of any parents outside the list's threads
+    # are included as well, so all parents that exist are taken into
+    # account. Messages that are only in unrelated threads, but have one
+    # of the included messages as parent, are not found that way. Those
+    # are only handled when rethreading everything.
+    def __init__(self, conn, listid=None):
+        self.conn = conn
+        self.listid = listid
+
+        # Everything we know about the messages, one entry per message,
+        # in the order they were read. parentids are 0 for no parent.
+        self.ids = array.array('i')
+        self.msgids = []
+        self.rawthreadids = array.array('i')
+        self.threadids = array.array('i')
+        self.parentids = array.array('i')
+        self.parents = []
+        # messageid -> index
+        self.index = {}
+
+        # Results of resolve(), indexed the same way
+        self.newthreadids = array.array('i')
+        self.newparentids = array.array('i')
+        # index -> [(priority, msgid)] of the unresolved entries it ends
+        # up with, for those that have any
+        self.unresolved = {}
+
+        # threadid -> set of listids, for the current and new threads
+        self.tags = {}
+        self.newtags = {}
+
+    def _load(self, where='', params=None):
+        # Returns the messageids of the parents of the loaded messages
+        curs = self.conn.cursor('rethread')
+        curs.itersize = 10000
+        curs.execute(_MESSAGES_QUERY + where, params)
+        parents = set()
+        for id, msgid, rawthreadid, threadid, parentid, headers in curs:
+            if msgid in self.index:
+                continue
+            self.index[msgid] = len(self.ids)
+            self.ids.append(id)
+            self.msgids.append(msgid)
+            self.rawthreadids.append(rawthreadid)
+            self.threadids.append(threadid)
+            self.parentids.append(parentid)
+            p = get_parents(headers)
+            self.parents.append(p)
+            parents.update(p)
+        curs.close()
+        return parents
+
+    def load(self):
+        timer = opstatus.start()
+        curs = self.conn.cursor()
+        if self.listid is None:
+            self._load()
+        else:
+            curs.execute("SELECT threadid FROM list_threads WHERE listid=%(listid)s AND threadid NOT IN (SELECT threadid FROM thread_aliases)", {
+                'listid': self.listid,
+            })
+            threads = set([r[0] for r in curs.fetchall()])
+            pending = threads
+            while pending:
+                parents = self._load(" WHERE m.threadid IN (SELECT unnest(%(threads)s::int[]) UNION ALL SELECT threadid FROM thread_aliases WHERE canonical=ANY(%(threads)s))", {
+                    'threads': list(pending),
+                })
+                curs.execute("SELECT DISTINCT COALESCE(a.canonical, m.threadid) FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE m.messageid=ANY(%(msgids)s)", {
+                    'msgids': [p for p in parents if p not in self.index],
+                })
+                pending = set([r[0] for r in curs.fetchall()]).difference(threads)
+                threads.update(pending)
+
+        curs.execute("SELECT threadid, listid FROM list_threads WHERE threadid=ANY(%(threads)s)", {
+            'threads': list(set(self.threadids)),
+        })
+        for threadid, listid in curs.fetchall():
+            self.tags.setdefault(threadid, set()).add(listid)
+        opstatus.stop('lookup', timer)
+        log.status("Loaded %s messages in %s threads" % (len(self.ids), len(self.tags)))
+
+    def resolve(self, allocate=True):
+        # Replay all messages, with temporary thread ids. Unless allocate
+        # is set, threads that need a new id get a negative one instead of
+        # one from threadid_seq, for when we are only going to report.
+        timer = opstatus.start()
+        newthreads = iter(range(1, len(self.ids) + 1))
+        resolver = ThreadResolver(None, lambda: next(newthreads))
+        byid = dict([(id, i) for i, id in enumerate(self.ids)])
+        self.newparentids = array.array('i', [0] * len(self.ids))
+        for id in sorted(byid):
+            i = byid[id]
+            r = resolver.resolve(self.msgids[i], self.parents[i], id=id)
+            self.newparentids[i] = r.parentid or 0
+            for c in r.children:
+                self.newparentids[byid[c]] = id
+        self.unresolved = dict([(byid[m], sorted(entries.items())) for m, entries in resolver.unresolved_by_message.items()])
+
+        # Keep the current thread id for the new thread that has the most
+        # messages of it, and give the rest new ones.
+        members = {}
+        for i, id in enumerate(self.ids):
+            members.setdefault(resolver.message_thread(id), []).append(i)
+        threadmap = {}
+        taken = set()
+        needed = []
+        for t in sorted(members, key=lambda t: (-len(members[t]), t)):
+            for threadid, n in sorted(Counter([self.threadids[i] for i in members[t]]).items(), key=lambda x: (-x[1], x[0])):
+                if threadid not in taken:
+                    threadmap[t] = threadid
+                    taken.add(threadid)
+                    break
+            else:
+                needed.append(t)
+        if needed and not allocate:
+            threadmap.update(zip(needed, range(-1, -len(needed) - 1, -1)))
+        elif needed:
+            curs = self.conn.cursor()
+            curs.execute("SELECT nextval('threadid_seq') FROM generate_series(1, %(num)s)", {
+                'num': len(needed),
+            })
+            threadmap.update(zip(needed, sorted([r[0] for r in curs.fetchall()])))
+
+        self.newthreadids = array.array('i', [threadmap[resolver.message_thread(id)] for id in self.ids])
+
+        # A new thread is on all the lists that its messages were on
+        for i in range(len(self.ids)):
+            self.newtags.setdefault(self.newthreadids[i], set()).update(self.tags.get(self.threadids[i], ()))
+        opstatus.stop('resolve', timer)
+
+    def changes(self):
+        # Returns the indexes of the messages that got a different parent,
+        # and of those that are no longer in a thread with the same
+        # messages as before.
+        old = {}
+        new = {}
+        for i in range(len(self.ids)):
+            old.setdefault(self.threadids[i], set()).add(i)
+            new.setdefault(self.newthreadids[i], set()).add(i)
+        reparented = [i for i in range(len(self.ids)) if self.parentids[i] != self.newparentids[i]]
+        rethreaded = [i for i in range(len(self.ids)) if old[self.threadids[i]] != new[self.newthreadids[i]]]
+        return (reparented, rethreaded)
+
+    def moved(self):
+        # Returns (index, lists it's no longer on, lists it's now on) for
+        # the messages that end up on other lists.
+        reparented, rethreaded = self.changes()
+        moved = []
+        for i in rethreaded:
+            old = self.tags.get(self.threadids[i], set())
+            new = self.newtags[self.newthreadids[i]]
+            if old != new:
+                moved.append((i, old - new, new - old))
+        return moved
+
+    def write_diff(self, f):
+        reparented, rethreaded = self.changes()
+        byid = dict([(id, i) for i, id in enumerate(self.ids)])
+
+        def _msgid(id):
+            return id and self.msgids[byid[id]] or 'none'
+
+        for i in reparented:
+            f.write("%s: parent %s -> %s\n" % (self.msgids[i], _msgid(self.parentids[i]), _msgid(self.newparentids[i])))
+        sizes = Counter(self.threadids)
+        newsizes = Counter(self.newthreadids)
+        for i in rethreaded:
+            f.write("%s: thread %s (%s messages) -> %s (%s messages)\n" % (
+                self.msgids[i],
+                self.threadids[i], sizes[self.threadids[i]],
+                self.newthreadids[i], newsizes[self.newthreadids[i]]))
+
+    def purges(self):
+        # Threads that changed, and for the visible messages that are added
+        # to or removed from lists, the date lists and the messages next to
+        # them on those lists. Has to be called before write().
+        reparented, rethreaded = self.changes()
+        purges = set()
+        for i in reparented + rethreaded:
+            purges.add(self.threadids[i])
+            purges.add(self.newthreadids[i])
+        moved = self.moved()
+        if moved:
+            curs = self.conn.cursor()
+            curs.execute("SELECT id, date FROM messages WHERE id=ANY(%(ids)s) AND hiddenstatus IS NULL", {
+                'ids': [self.ids[i] for i, removed, added in moved],
+            })
+            dates = dict(curs.fetchall())
+            purges.update(list_change_purges(curs, [
+                (self.ids[i], listid, dates[self.ids[i]])
+                for i, removed, added in moved
+                if self.ids[i] in dates
+                for listid in removed.union(added)
+            ]))
+        return purges
+
+    def write(self):
+        # Write the new threading back, in a few set based statements.
+        # Returns the number of messages updated.
+        timer = opstatus.start()
+        curs = self.conn.cursor()
+
+        curs.execute("CREATE TEMP TABLE rethread_messages (id int NOT NULL PRIMARY KEY, parentid int, threadid int NOT NULL) ON COMMIT DROP")
+        copy_rows(curs, 'rethread_messages', ('id', 'parentid', 'threadid'), [
+            (self.ids[i], self.newparentids[i] or None, self.newthreadids[i])
+            for i in range(len(self.ids))
+            if self.parentids[i] != self.newparentids[i] or self.rawthreadids[i] != self.newthreadids[i]
+        ])
+        curs.execute("UPDATE messages m SET parentid=r.parentid, threadid=r.threadid FROM rethread_messages r WHERE r.id=m.id")
+        updated = curs.rowcount
+
+        # The unresolved entries of the messages are replaced by the ones
+        # they would have had.
+        curs.execute("SELECT message, priority, msgid FROM unresolved_messages WHERE message=ANY(%(ids)s)", {
+            'ids': list(self.ids),
+        })
+        byid = dict([(id, i) for i, id in enumerate(self.ids)])
+        current = {}
+        for message, priority, msgid in curs.fetchall():
+            current.setdefault(byid[message], []).append((priority, msgid))
+        changed = [i for i in set(current).union(self.unresolved) if sorted(current.get(i, [])) != self.unresolved.get(i, [])]
+        curs.execute("DELETE FROM unresolved_messages WHERE message=ANY(%(ids)s)", {
+            'ids': [self.ids[i] for i in changed],
+        })
+        copy_rows(curs, 'unresolved_messages', ('message', 'priority', 'msgid'), [
+            (self.ids[i], priority, msgid)
+            for i in changed
+            for priority, msgid in self.unresolved.get(i, [])
+        ])
+
+        # All messages now have their canonical thread, so the old threads
+        # and their aliases are replaced by the new ones.
+        oldthreads = list(set(self.threadids))
+        curs.execute("DELETE FROM list_threads WHERE threadid IN (SELECT unnest(%(threads)s::int[]) UNION ALL SELECT threadid FROM thread_aliases WHERE canonical=ANY(%(threads)s))", {
+            'threads': oldthreads,
+        })
+        curs.execute("DELETE FROM thread_aliases WHERE canonical=ANY(%(threads)s)", {
+            'threads': oldthreads,
+        })
+        copy_rows(curs, 'list_threads', ('threadid', 'listid'), [
+            (threadid, listid)
+            for threadid, lists in self.newtags.items()
+            for listid in lists
+        ])
+
+        # Messages that end up on other lists are removed from
+        # list_messages on the lists they're no longer on, and added on the
+        # new ones.
+        moved = self.moved()
+        removed = [(self.ids[i], listid) for i, r, a in moved for listid in r]
+        added = [(self.ids[i], listid) for i, r, a in moved for listid in a]
+        if removed:
+            curs.execute("SELECT archives_remove_list_messages(%(ids)s, %(lists)s)", {
+                'ids': [id for id, listid in removed],
+                'lists': [listid for id, listid in removed],
+            })
+        if added:
+            curs.execute("SELECT archives_add_list_messages(%(ids)s, %(lists)s)", {
+                'ids': [id for id, listid in added],
+                'lists': [listid for id, listid in added],
+            })
+        opstatus.stop('write', timer)
+        return updated
@@ -1,39 +1,261 @@
+import datetime
 import difflib
 
-from .parser import ArchivesParser
+import psycopg2.errors
+
+from .parser import ArchivesParser, PARSER_VERSION
 
 from lib.log import log, opstatus
+from lib.locks import lock_messageids, lock_threads
+
+
+def list_date_purges(listid, date, neighbours=None):
+    # The date lists of a list that a message at date shows up on. If
+    # the dates of the messages before and after it on the list are
+    # known (None if there is none), the lists reaching the start or
+    # end of the list and the links to the days of the month are only
+    # purged if they change.
+    def _day(d):
+        return d and d.astimezone(datetime.timezone.utc).date()
+
+    listid = int(listid)
+    day = _day(date)
+    prevday, nextday = neighbours and [_day(d) for d in neighbours] or (None, None)
+    purges = [(listid, day.year, day.month), ('day', listid, day.year, day.month, day.day)]
+    if not neighbours or day not in (prevday, nextday):
+        purges.append(('days', listid, day.year, day.month))
+    if not prevday:
+        purges.append(('start', listid))
+    if not nextday:
+        purges.append(('end', listid))
+    return purges
+
+
+def list_change_purges(curs, changes):
+    # Returns the purges for visible messages that are added to or
+    # removed from lists, given as (id, listid, date), before or after
+    # that happens: the date lists of those lists, and the pages of the
+    # messages before and after them on each list in list_messages (which
+    # link to them as next and previous). Messages that change along with
+    # them don't tell what the list looks like without them, so purge as
+    # if there were none.
+    purges = set()
+    if not changes:
+        return purges
+    changing = set([(id, listid) for id, listid, date in changes])
+    curs.execute("""SELECT s.listid, s.date, p.id, p.date, n.id, n.date
+FROM unnest(%(ids)s::int[], %(lists)s::int[], %(dates)s::timestamptz[]) s(id, listid, date)
+LEFT JOIN LATERAL (SELECT lm.message AS id, lm.date FROM list_messages lm WHERE lm.listid=s.listid AND lm.date<s.date ORDER BY lm.date DESC LIMIT 1) p ON true
+LEFT JOIN LATERAL (SELECT lm.message AS id, lm.date FROM list_messages lm WHERE lm.listid=s.listid AND lm.date>s.date ORDER BY lm.date LIMIT 1) n ON true""", {
+        'ids': [id for id, listid, date in changes],
+        'lists': [listid for id, listid, date in changes],
+        'dates': [date for id, listid, date in changes],
+    })
+    for listid, date, previd, prevdate, nextid, nextdate in curs.fetchall():
+        purges.update(list_date_purges(listid, date, ((previd, listid) not in changing and prevdate or None, (nextid, listid) not in changing and nextdate or None)))
+        for m in (previd, nextid):
+            if m:
+                purges.add(('message', m))
+    return purges
+
+
+def purge_affected(curs, parsers):
+    # Add the purges of the pages that show the messages just stored by
+    # the parsers, which all have id, threadid and date set: the pages of
+    # their parent and children, and those listing the messages of their
+    # thread if they have either (otherwise it's a new thread), the pages
+    # of the messages before and after them on each list their thread is
+    # on in list_messages (which link to them as next and previous), and
+    # the date lists of those lists. Pages of messages stored along with
+    # them can't have been cached yet.
+    if not parsers:
+        return
+    byid = dict([(ap.id, ap) for ap in parsers])
+    timer = opstatus.start()
+    curs.execute("""SELECT s.id, x.listid, x.previd, x.prevdate, x.nextid, x.nextdate
+FROM unnest(%(ids)s::int[], %(threads)s::int[], %(dates)s::timestamptz[]) s(id, threadid, date), LATERAL (
+  SELECT NULL::int AS listid, m.id AS previd, NULL::timestamptz AS prevdate, NULL::int AS nextid, NULL::timestamptz AS nextdate FROM messages m WHERE m.parentid=s.id
+ UNION ALL
+  SELECT NULL, m.parentid, NULL, NULL, NULL FROM messages m WHERE m.id=s.id AND m.parentid IS NOT NULL
+ UNION ALL
+  SELECT lt.listid, p.id, p.date, n.id, n.date FROM list_threads lt
+  LEFT JOIN LATERAL (SELECT lm.message AS id, lm.date FROM list_messages lm WHERE lm.listid=lt.listid AND lm.date<s.date ORDER BY lm.date DESC LIMIT 1) p ON true
+  LEFT JOIN LATERAL (SELECT lm.message AS id, lm.date FROM list_messages lm WHERE lm.listid=lt.listid AND lm.date>s.date ORDER BY lm.date LIMIT 1) n ON true
+  WHERE lt.threadid=s.threadid
+) x""", {
+        'ids': list(byid.keys()),
+        'threads': [ap.threadid for ap in byid.values()],
+        'dates': [ap.date for ap in byid.values()],
+    })
+    for id, listid, previd, prevdate, nextid, nextdate in curs.fetchall():
+        ap = byid[id]
+        if listid is None:
+            # previd is the parent or a child
+            ap.purge_thread_tree(ap.threadid)
+        else:
+            # Messages stored along with it don't tell what was there
+            # before, so purge as if there were none.
+            ap.purge_list_date(listid, ap.date, (previd not in byid and prevdate or None, nextid not in byid and nextdate or None))
+        for m in (previd, nextid):
+            if m and m not in byid:
+                ap.purge_message(m)
+    opstatus.stop('lookup', timer)
 
 
 class ArchivesParserStorage(ArchivesParser):
     def __init__(self):
         super(ArchivesParserStorage, self).__init__()
         self.purges = set()
+        # Result of find_existing(), if it has been called
+        self.existing = None
 
-    def purge_list(self, listid, year, month):
-        self.purges.add((int(listid), int(year), int(month)))
+    def purge_list_date(self, listid, date, neighbours=None):
+        self.purges.update(list_date_purges(listid, date, neighbours))
 
     def purge_thread(self, threadid):
+        # Every page of the thread
         self.purges.add(int(threadid))
 
-    def store(self, conn, listid, overwrite=False, overwrite_raw=False):
+    def purge_thread_tree(self, threadid):
+        # Only the pages listing the messages of the thread
+        self.purges.add(('tree', int(threadid)))
+
+    def purge_message(self, id):
+        self.purges.add(('message', int(id)))
+
+    def find_existing(self, conn, listid, cache=None):
+        # Look up if this message has already been stored, which only
+        # requires the messageid. Returns True if it has, in which case
+        # store() only needs the results of analyze_headers(). The result
+        # is kept for store(), so calling this first costs no extra query.
+        if cache and cache.get_messages([self.msgid]) == []:
+            # Known not to exist, so there is nothing to check
+            self.existing = []
+            return False
+
+        timer = opstatus.start()
         curs = conn.cursor()
+        curs.execute("SELECT COALESCE(a.canonical, m.threadid), EXISTS(SELECT threadid FROM list_threads lt WHERE lt.listid=%(listid)s AND lt.threadid=m.threadid), id FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE m.messageid=%(messageid)s", {
+            'messageid': self.msgid,
+            'listid': listid,
+        })
+        self.existing = curs.fetchall()
+        opstatus.stop('lookup', timer)
+        if cache and self.existing:
+            cache.add_message(self.msgid, self.existing[0][2], self.existing[0][0])
+        return len(self.existing) > 0
+
+    def _lookup_parents(self, curs, cache):
+        all_parents = None
+        if cache:
+            all_parents = cache.get_messages(self.parents)
+        if all_parents is None:
+            timer = opstatus.start()
+            curs.execute("SELECT id, messageid, COALESCE(a.canonical, m.threadid) FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE messageid=ANY(%(parents)s)", {
+                'parents': self.parents,
+            })
+            all_parents = curs.fetchall()
+            opstatus.stop('lookup', timer)
+            if cache:
+                cache.add_messages(self.parents, all_parents)
+        return all_parents
+
+    def _lookup_children(self, curs, cache):
+        childrows = None
+        if cache:
+            childrows = cache.get_unresolved(self.msgid)
+        if childrows is None:
+            timer = opstatus.start()
+            curs.execute("SELECT u.message, u.priority, COALESCE(a.canonical, m.threadid) AS threadid FROM unresolved_messages u INNER JOIN messages m ON m.id=u.message LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE u.msgid=%(msgid)s ORDER BY threadid", {
+                'msgid': self.msgid,
+            })
+            childrows = curs.fetchall()
+            opstatus.stop('lookup', timer)
+            if cache:
+                cache.set_unresolved(self.msgid, childrows)
+        return childrows
+
+    def store(self, conn, listid, overwrite=False, overwrite_raw=False, cache=None, keyedlocks=False, function=False):
+        # cache is an optional MessageCache, used to avoid looking up
+        # messages that have already been seen in this transaction.
+        #
+        # With function, the message is stored by archives_store_message()
+        # in the database instead (see _store_function()), unless it's
+        # being overwritten or only its headers were analyzed. The cache
+        # isn't kept up to date by that, so it can't be used with it.
+        #
+        # With keyedlocks, the caller holds the global loader lock shared
+        # rather than exclusively (see lib/locks.py), so we lock what this
+        # message can affect ourselves. Loaders waiting for each other's
+        # thread locks can deadlock if threads get merged while they wait,
+        # or if they hold the locks of earlier messages in the same
+        # transaction, in which case what we did is undone and we try
+        # again a few times (see lib/locks.py).
+        if function and not overwrite and hasattr(self, 'bodytxt'):
+            def _do_store(cache, keyedlocks):
+                return self._store_function(conn, listid, keyedlocks)
+        else:
+            def _do_store(cache, keyedlocks):
+                return self._store(conn, listid, overwrite, overwrite_raw, cache, keyedlocks)
+
+        if not keyedlocks:
+            return _do_store(cache, False)
+
+        curs = conn.cursor()
+        # Messages found to exist by find_existing() after only analyzing
+        # the headers have no parents, and don't need them.
+        parents = getattr(self, 'parents', [])
+        attempt = 0
+        while True:
+            curs.execute("SAVEPOINT store_message")
+            try:
+                r = _do_store(None, True)
+                curs.execute("RELEASE SAVEPOINT store_message")
+                return r
+            except psycopg2.errors.DeadlockDetected:
+                curs.execute("ROLLBACK TO SAVEPOINT store_message")
+                attempt += 1
+                if attempt >= 5:
+                    raise
+                log.status("Deadlock storing message %s, retrying" % self.msgid)
+                if parents:
+                    self.parents = parents
+                self.purges = set()
+                self.existing = None
+
+    def _store(self, conn, listid, overwrite, overwrite_raw, cache, keyedlocks):
+        curs = conn.cursor()
+        if keyedlocks:
+            lock_messageids(curs, [self.msgid] + getattr(self, 'parents', []))
+            # Anything looked up before we had the lock may have changed
+            self.existing = None
 
         # Potentially add the information that there exists a mail for
         # this month. We do that this early since we're always going to
         # make the check anyway, and this keeps the code in one place..
         if not overwrite:
-            curs.execute("INSERT INTO list_months (listid, year, month) SELECT %(listid)s, %(year)s, %(month)s WHERE NOT EXISTS (SELECT listid FROM list_months WHERE listid=%(listid)s AND year=%(year)s AND month=%(month)s)", {
+            curs.execute("INSERT INTO list_months (listid, year, month) VALUES (%(listid)s, %(year)s, %(month)s) ON CONFLICT DO NOTHING", {
                 'listid': listid,
                 'year': self.date.year,
                 'month': self.date.month,
             })
 
-        curs.execute("SELECT threadid, EXISTS(SELECT threadid FROM list_threads lt WHERE lt.listid=%(listid)s AND lt.threadid=m.threadid), id FROM messages m WHERE m.messageid=%(messageid)s", {
-            'messageid': self.msgid,
-            'listid': listid,
-        })
-        r = curs.fetchall()
+        r = self.existing
+        self.existing = None
+        if r is None:
+            self.find_existing(conn, listid, cache)
+            r = self.existing
+            self.existing = None
+        while keyedlocks and len(r) > 0:
+            # The message can be moved to another thread by a merge until
+            # we hold the lock on its thread.
+            threadid = r[0][0]
+            lock_threads(curs, [threadid])
+            self.find_existing(conn, listid)
+            r = self.existing
+            self.existing = None
+            if r[0][0] == threadid:
+                break
         if len(r) > 0:
             # Has to be 1 row, since we have a unique index on id
             if not r[0][1] and not overwrite:
@@ -42,8 +264,12 @@ class ArchivesParserStorage(ArchivesParser):
                     'threadid': r[0][0],
                     'listid': listid,
                 })
+                curs.execute("SELECT archives_add_threads(%(threads)s, %(listid)s)", {
+                    'threads': [r[0][0]],
+                    'listid': listid,
+                })
                 opstatus.tagged += 1
-                self.purge_list(listid, self.date.year, self.date.month)
+                self.purge_list_date(listid, self.date)
                 self.purge_thread(r[0][0])
             else:
                 opstatus.dupes += 1
@@ -51,6 +277,13 @@ class ArchivesParserStorage(ArchivesParser):
             if overwrite:
                 pk = r[0][2]
                 self.purge_thread(r[0][0])
+                # Record the parser version even if nothing else changed,
+                # so the message is no longer considered outdated.
+                curs.execute("UPDATE messages SET parserversion=%(version)s, charsets=%(charsets)s WHERE id=%(id)s AND NOT (parserversion=%(version)s AND charsets=%(charsets)s)", {
+                    'id': pk,
+                    'version': PARSER_VERSION,
+                    'charsets': sorted(self.charsets),
+                })
                 if overwrite_raw:
                     # For full overwrite, we also update the raw text of the message. This is an
                     # uncommon enough operation that we'll just do it as a separate command.
@@ -74,6 +307,12 @@ class ArchivesParserStorage(ArchivesParser):
                     'bodytxt': self.bodytxt,
                 })
                 rc = curs.rowcount
+                # A new date moves the message in list_messages
+                curs.execute("SELECT archives_remove_messages(ARRAY[id]) FROM messages WHERE id=%(id)s AND date!=%(date)s", {
+                    'id': pk,
+                    'date': self.date,
+                })
+                newdate = curs.rowcount == 1
                 curs.execute("UPDATE messages SET _from=%(from)s, _to=%(to)s, cc=%(cc)s, subject=%(subject)s, date=%(date)s, has_attachment=%(has_attachment)s WHERE id=%(id)s AND NOT (_from=%(from)s AND _to=%(to)s AND cc=%(cc)s AND subject=%(subject)s AND date=%(date)s AND has_attachment=%(has_attachment)s) RETURNING id", {
                     'id': pk,
                     'from': self._from,
@@ -84,6 +323,10 @@ class ArchivesParserStorage(ArchivesParser):
                     'has_attachment': len(self.attachments) > 0,
                 })
                 rc += curs.rowcount
+                if newdate:
+                    curs.execute("SELECT archives_add_messages(%(ids)s)", {
+                        'ids': [pk],
+                    })
                 if rc == 0:
                     log.status("Message %s unchanged" % self.msgid)
                     return False
@@ -106,14 +349,25 @@ class ArchivesParserStorage(ArchivesParser):
 
         if overwrite:
             raise Exception("Attempt to overwrite message (%s) that doesn't exist on list %s!" % (self.msgid, listid))
-        # Always purge the primary list for this thread
-        self.purge_list(listid, self.date.year, self.date.month)
+
+        # Find our parents, and messages we are the parent of
+        all_parents = self._lookup_parents(curs, cache)
+        childrows = self._lookup_children(curs, cache)
+        if keyedlocks:
+            # Lock all threads we can end up in or merge. Since they can
+            # be merged into others until we hold the lock, look again
+            # until there are no threads we don't have the lock on.
+            locked = set()
+            while True:
+                threads = set([p[2] for p in all_parents] + [c[2] for c in childrows])
+                if threads.issubset(locked):
+                    break
+                lock_threads(curs, threads.difference(locked))
+                locked.update(threads)
+                all_parents = self._lookup_parents(curs, None)
+                childrows = self._lookup_children(curs, None)
 
         # Resolve own thread
-        curs.execute("SELECT id, messageid, threadid FROM messages WHERE messageid=ANY(%(parents)s)", {
-            'parents': self.parents,
-        })
-        all_parents = curs.fetchall()
         if len(all_parents):
             # At least one of the parents exist. Now try to figure out which one
             best_parent = len(self.parents) + 1
@@ -142,10 +396,6 @@ class ArchivesParserStorage(ArchivesParser):
             self.threadid = None
 
         # Now see if we are somebody elses *parent*...
-        curs.execute("SELECT message, priority, threadid FROM unresolved_messages INNER JOIN messages ON messages.id=unresolved_messages.message WHERE unresolved_messages.msgid=%(msgid)s ORDER BY threadid", {
-            'msgid': self.msgid,
-        })
-        childrows = curs.fetchall()
         if len(childrows):
             # We are some already existing message's parent (meaning the
             # messages arrived out of order)
@@ -167,22 +417,21 @@ class ArchivesParserStorage(ArchivesParser):
             if len(mergethreads):
                 # We have one or more merge threads
                 log.status("Merging threads %s into thread %s" % (",".join(str(s) for s in mergethreads), self.threadid))
-                curs.execute("UPDATE messages SET threadid=%(threadid)s WHERE threadid=ANY(%(oldthreadids)s)", {
+                # The messages in them are left alone, and moved over later
+                # by compact_threads.py (see thread_aliases).
+                timer = opstatus.start()
+                curs.execute("SELECT archives_merge_threads(%(oldthreadids)s, %(threadid)s)", {
                     'threadid': self.threadid,
                     'oldthreadids': list(mergethreads),
                 })
-                # Insert any lists that were tagged on the merged threads
-                curs.execute("INSERT INTO list_threads (threadid, listid) SELECT DISTINCT %(threadid)s,listid FROM list_threads lt2 WHERE lt2.threadid=ANY(%(oldthreadids)s) AND listid NOT IN (SELECT listid FROM list_threads lt3 WHERE lt3.threadid=%(threadid)s)", {
-                    'threadid': self.threadid,
-                    'oldthreadids': list(mergethreads),
-                })
-                # Remove all old leftovers
-                curs.execute("DELETE FROM list_threads WHERE threadid=ANY(%(oldthreadids)s)", {
-                    'oldthreadids': list(mergethreads),
-                })
-                # Purge varnish records for all the threads we just removed
+                opstatus.stop('merge', timer)
+                # Purge varnish records for all the threads we just removed,
+                # and all of ours since it can be on more lists now
                 for t in mergethreads:
                     self.purge_thread(t)
+                self.purge_thread(self.threadid)
+                if cache:
+                    cache.merge_threads(mergethreads, self.threadid)
 
             # Batch all the children for repointing. We can't do the actual
             # repointing until later, since we don't know our own id yet.
@@ -197,19 +446,20 @@ class ArchivesParserStorage(ArchivesParser):
                 'msg': msg,
                 'prio': prio,
             } for msg, prio, tid in childrows])
+            if cache:
+                for msg, prio, tid in childrows:
+                    cache.remove_unresolved(msg, prio)
         else:
             self.children = []
 
-        if not self.threadid:
+        newthread = not self.threadid
+        if newthread:
             # No parent and no child exists - create a new threadid, just for us!
             curs.execute("SELECT nextval('threadid_seq')")
             self.threadid = curs.fetchall()[0][0]
             log.status("Message %s resolved to no parent (out of %s) and no child, new thread %s" % (self.msgid, len(self.parents), self.threadid))
-        else:
-            # We have a threadid already, so we're not a new thread. Thus,
-            # we need to purge the old thread
-            self.purge_thread(self.threadid)
 
+        timer = opstatus.start()
         # Insert a thread tag if we're on a new list
         curs.execute("INSERT INTO list_threads (threadid, listid) SELECT %(threadid)s, %(listid)s WHERE NOT EXISTS (SELECT * FROM list_threads t2 WHERE t2.threadid=%(threadid)s AND t2.listid=%(listid)s) RETURNING threadid", {
             'threadid': self.threadid,
@@ -217,8 +467,15 @@ class ArchivesParserStorage(ArchivesParser):
         })
         if len(curs.fetchall()):
             log.status("Tagged thread %s with listid %s" % (self.threadid, listid))
+            if not newthread:
+                # Every page of the thread shows the lists it is on
+                self.purge_thread(self.threadid)
+                curs.execute("SELECT archives_add_threads(%(threads)s, %(listid)s)", {
+                    'threads': [self.threadid],
+                    'listid': listid,
+                })
 
-        curs.execute("INSERT INTO messages (parentid, threadid, _from, _to, cc, subject, date, has_attachment, messageid, bodytxt, rawtxt) VALUES (%(parentid)s, %(threadid)s, %(from)s, %(to)s, %(cc)s, %(subject)s, %(date)s, %(has_attachment)s, %(messageid)s, %(bodytxt)s, %(rawtxt)s) RETURNING id", {
+        curs.execute("INSERT INTO messages (parentid, threadid, _from, _to, cc, subject, date, has_attachment, messageid, bodytxt, rawtxt, parserversion, charsets) VALUES (%(parentid)s, %(threadid)s, %(from)s, %(to)s, %(cc)s, %(subject)s, %(date)s, %(has_attachment)s, %(messageid)s, %(bodytxt)s, %(rawtxt)s, %(parserversion)s, %(charsets)s) RETURNING id", {
             'parentid': self.parentid,
             'threadid': self.threadid,
             'from': self._from,
@@ -230,8 +487,15 @@ class ArchivesParserStorage(ArchivesParser):
             'messageid': self.msgid,
             'bodytxt': self.bodytxt,
             'rawtxt': bytearray(self.rawtxt),
+            'parserversion': PARSER_VERSION,
+            'charsets': sorted(self.charsets),
         })
         id = curs.fetchall()[0][0]
+        curs.execute("SELECT archives_add_messages(%(ids)s)", {
+            'ids': [id],
+        })
+        if cache:
+            cache.add_message(self.msgid, id, self.threadid)
         log.status("Message %s, got id %s, set thread %s, parent %s" % (
             self.msgid, id, self.threadid, self.parentid))
         if len(self.attachments):
@@ -252,10 +516,68 @@ class ArchivesParserStorage(ArchivesParser):
             # properly threaded - so store them in the db.
             curs.executemany("INSERT INTO unresolved_messages (message, priority, msgid) VALUES (%(id)s, %(priority)s, %(msgid)s)",
                              [{'id': id, 'priority': i, 'msgid': self.parents[i]} for i in range(0, len(self.parents))])
+            if cache:
+                for i in range(0, len(self.parents)):
+                    cache.add_unresolved(id, i, self.parents[i], self.threadid)
+        opstatus.stop('write', timer)
+
+        self.id = id
+        purge_affected(curs, [self])
 
         opstatus.stored += 1
         return True
 
+    def _store_function(self, conn, listid, keyedlocks):
+        # Store a new message like _store() does, but resolving the thread
+        # in archives_store_message() in the database, with a single round
+        # trip instead of one for each step.
+        curs = conn.cursor()
+        timer = opstatus.start()
+        curs.execute("SELECT status, id, threadid, parentid, mergedthreads, purgethreads FROM archives_store_message(%(listid)s, %(messageid)s, %(parents)s::text[], %(year)s, %(month)s, %(from)s, %(to)s, %(cc)s, %(subject)s, %(date)s, %(bodytxt)s, %(rawtxt)s, %(parserversion)s, %(charsets)s::text[], %(filenames)s::text[], %(contenttypes)s::text[], %(attachments)s::bytea[], %(keyedlocks)s)", {
+            'listid': listid,
+            'messageid': self.msgid,
+            'parents': self.parents,
+            'year': self.date.year,
+            'month': self.date.month,
+            'from': self._from,
+            'to': self.to or '',
+            'cc': self.cc or '',
+            'subject': self.subject or '',
+            'date': self.date,
+            'bodytxt': self.bodytxt,
+            'rawtxt': bytearray(self.rawtxt),
+            'parserversion': PARSER_VERSION,
+            'charsets': sorted(self.charsets),
+            'filenames': [a[0] or 'unknown_filename' for a in self.attachments],
+            'contenttypes': [a[1] for a in self.attachments],
+            'attachments': [bytearray(a[2]) for a in self.attachments],
+            'keyedlocks': keyedlocks,
+        })
+        status, id, self.threadid, self.parentid, mergethreads, purgethreads = curs.fetchone()
+        opstatus.stop('write', timer)
+
+        for t in purgethreads:
+            self.purge_thread(t)
+        if status == 'dupe':
+            log.status("Message %s already stored" % self.msgid)
+            opstatus.dupes += 1
+            return True
+        if status == 'tagged':
+            log.status("Tagging message %s with list %s" % (self.msgid, listid))
+            opstatus.tagged += 1
+            self.purge_list_date(listid, self.date)
+            return True
+
+        self.id = id
+        purge_affected(curs, [self])
+
+        if mergethreads:
+            log.status("Merged threads %s into thread %s" % (",".join(str(s) for s in mergethreads), self.threadid))
+        log.status("Message %s, got id %s, set thread %s, parent %s" % (
+            self.msgid, id, self.threadid, self.parentid))
+        opstatus.stored += 1
+        return True
+
     def diff(self, conn, f, fromonlyf, oldid):
         curs = conn.cursor()
 
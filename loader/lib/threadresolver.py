@@ -0,0 +1,164 @@
+class Resolution(object):
+    def __init__(self, status):
+        # One of 'stored', 'tagged' or 'dupe'
+        self.status = status
+        self.id = None
+        self.parentid = None
+        self.threadid = None
+        self.newthread = False
+        # Messages that now have this message as their parent
+        self.children = []
+        # Threads that were merged into self.threadid
+        self.mergethreads = set()
+        # (message, priority) pairs, where all unresolved entries for the
+        # message with priority >= the given one were removed.
+        self.removed_unresolved = []
+        # (priority, msgid) of the unresolved entries added for this message
+        self.unresolved = []
+        # True if the thread got tagged with our list
+        self.newtag = False
+
+
+class ThreadResolver(object):
+    # In-memory implementation of the threading rules applied by
+    # ArchivesParserStorage.store() for a single list, used when we need
+    # to resolve many messages without a database roundtrip for each of
+    # them. Any messages, unresolved entries and thread tags that already
+    # exist in the database and can affect the resolution have to be
+    # registered with add_existing(), add_unresolved() and add_tag()
+    # before resolving.
+    #
+    # newid and newthreadid are functions returning a new message and
+    # thread id. Thread ids are compared when picking which thread to
+    # merge into, so new thread ids must sort after all existing ones,
+    # like they do when coming out of threadid_seq.
+    def __init__(self, newid, newthreadid):
+        self.newid = newid
+        self.newthreadid = newthreadid
+
+        # messageid -> id
+        self.messages = {}
+        # id -> threadid, as set when the message was added. Threads merged
+        # after that are resolved through self.merged.
+        self.threads = {}
+        # threadid -> threadid it was merged into
+        self.merged = {}
+        # messageid we're waiting for -> {message: priority}
+        self.unresolved = {}
+        # message -> {priority: messageid}
+        self.unresolved_by_message = {}
+        # Threads tagged with the list we're resolving for
+        self.tagged = set()
+
+        self.stored = 0
+        self.merges = 0
+        self.unresolved_added = 0
+
+    def thread(self, threadid):
+        # Find the thread that threadid has been merged into, if any
+        root = threadid
+        while root in self.merged:
+            root = self.merged[root]
+        while threadid != root:
+            next = self.merged[threadid]
+            self.merged[threadid] = root
+            threadid = next
+        return root
+
+    def message_thread(self, id):
+        return self.thread(self.threads[id])
+
+    def add_existing(self, msgid, id, threadid):
+        self.messages[msgid] = id
+        self.threads[id] = threadid
+
+    def add_unresolved(self, message, priority, msgid):
+        self.unresolved.setdefault(msgid, {})[message] = priority
+        self.unresolved_by_message.setdefault(message, {})[priority] = msgid
+
+    def add_tag(self, threadid):
+        self.tagged.add(threadid)
+
+    def is_tagged(self, threadid):
+        return self.thread(threadid) in self.tagged
+
+    def _remove_unresolved(self, message, priority):
+        # Remove all unresolved entries for message with a priority value
+        # of at least priority (meaning they are less important).
+        entries = self.unresolved_by_message.get(message, {})
+        for p in [p for p in entries if p >= priority]:
+            waiting = self.unresolved[entries[p]]
+            del waiting[message]
+            if not waiting:
+                del self.unresolved[entries[p]]
+            del entries[p]
+        if not entries:
+            self.unresolved_by_message.pop(message, None)
+
+    def resolve(self, msgid, parents, id=None):
+        # Resolve one message, given the list of message-ids we would like
+        # to have as parent in order of preference. Returns a Resolution
+        # describing what store() would have done.
+        if msgid in self.messages:
+            threadid = self.message_thread(self.messages[msgid])
+            if threadid not in self.tagged:
+                r = Resolution('tagged')
+                self.tagged.add(threadid)
+                r.newtag = True
+            else:
+                r = Resolution('dupe')
+            r.id = self.messages[msgid]
+            r.threadid = threadid
+            return r
+
+        r = Resolution('stored')
+        parents = list(parents)
+
+        # Resolve own thread, using the best parent that exists
+        for i, p in enumerate(parents):
+            if p in self.messages:
+                r.parentid = self.messages[p]
+                r.threadid = self.message_thread(r.parentid)
+                parents = parents[:i]
+                break
+
+        # Now see if we are somebody elses *parent*...
+        childrows = sorted(
+            ((message, priority, self.message_thread(message)) for message, priority in self.unresolved.get(msgid, {}).items()),
+            key=lambda c: c[2],
+        )
+        if childrows:
+            if not r.threadid:
+                # Merge into the first thread in the list
+                r.threadid = childrows[0][2]
+            r.mergethreads = set([c[2] for c in childrows]).difference(set((r.threadid, )))
+            for t in r.mergethreads:
+                self.merged[t] = r.threadid
+                if t in self.tagged:
+                    self.tagged.discard(t)
+                    self.tagged.add(r.threadid)
+            self.merges += len(r.mergethreads)
+            r.children = [c[0] for c in childrows]
+            for message, priority, threadid in childrows:
+                self._remove_unresolved(message, priority)
+                r.removed_unresolved.append((message, priority))
+
+        if not r.threadid:
+            r.threadid = self.newthreadid()
+            r.newthread = True
+
+        if r.threadid not in self.tagged:
+            self.tagged.add(r.threadid)
+            r.newtag = True
+
+        if id is None:
+            id = self.newid()
+        r.id = id
+        self.add_existing(msgid, r.id, r.threadid)
+
+        r.unresolved = list(enumerate(parents))
+        for priority, p in r.unresolved:
+            self.add_unresolved(r.id, priority, p)
+        self.unresolved_added += len(r.unresolved)
+        self.stored += 1
+        return r
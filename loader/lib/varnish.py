@@ -1,33 +1,182 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from requests.adapters import HTTPAdapter
+
+from lib.log import log, opstatus
+
+
+def purge_key(p):
+    # The keys the pages are tagged with in xkey by the views:
+    #  pgat_<thread>            every page of a thread
+    #  pgatt_<thread>           pages listing the messages of a thread (the
+    #                           thread tree and the flat view)
+    #  pgamsg_<id>              the page of a single message
+    #  pgam_<list>/<y>/<m>      date lists of a month
+    #  pgad_<list>/<y>/<m>/<d>  date lists showing a day
+    #  pgamd_<list>/<y>/<m>     date lists linking to the days of a month
+    #  pgals_<list>             date lists reaching the start of a list
+    #  pgale_<list>             date lists reaching the end of a list
+    if isinstance(p, tuple):
+        if p[0] == 'tree':
+            return 'pgatt_%s' % p[1]
+        elif p[0] == 'message':
+            return 'pgamsg_%s' % p[1]
+        elif p[0] == 'day':
+            return 'pgad_%s/%s/%s/%s' % p[1:]
+        elif p[0] == 'days':
+            return 'pgamd_%s/%s/%s' % p[1:]
+        elif p[0] == 'start':
+            return 'pgals_%s' % p[1]
+        elif p[0] == 'end':
+            return 'pgale_%s' % p[1]
+        # Purging a list
+        return 'pgam_%s/%s/%s' % p
+    else:
+        # Purging individual thread
+        return 'pgat_%s' % p
+
+
+def queue_purges(curs, purges):
+    # Queue purges in pending_purges, to be sent by purge_daemon.py once
+    # the transaction commits. This should be done right before the
+    # commit: the rows stay locked until then, which keeps the purger from
+    # sending them before the changes they are for can be seen, and a key
+    # that is already queued gets its generation bumped so the purger
+    # sends it again if it was in the middle of sending it. Keys are
+    # queued in order, so transactions queueing the same keys at the same
+    # time don't deadlock.
+    keys = sorted(set([purge_key(p) for p in purges]))
+    if not keys:
+        return
+    with opstatus.phase('purge'):
+        curs.execute("INSERT INTO pending_purges (key) SELECT unnest(%(keys)s::text[]) ORDER BY 1 ON CONFLICT (key) DO UPDATE SET generation=pending_purges.generation+1", {
+            'keys': keys,
+        })
+
+
+class PurgeEndpoint(object):
+    # One cache frontend to purge, through a keep-alive session of its
+    # own. Keys are sent at most maxkeys to a request, with up to
+    # connections requests at the same time.
+    def __init__(self, name, url, maxkeys=100, connections=2, timeout=30, host='www.postgresql.org'):
+        self.name = name
+        self.url = url
+        self.maxkeys = maxkeys
+        self.connections = connections
+        self.timeout = timeout
+        self.host = host
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.pool = None
+
+        # Counters, updated from the threads sending requests
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.failures = 0
+        self.keys = 0
+        self.seconds = 0.0
+        self.maxseconds = 0.0
 
-from lib.log import log
+    def _post(self, keys):
+        purgedict = dict(list(zip(['x%s' % n for n in range(0, len(keys))], keys)))
+        purgedict['n'] = len(keys)
+        start = time.time()
+        try:
+            r = self.session.post(self.url, data=purgedict, headers={
+                'Content-type': 'application/x-www-form-urlencoded',
+                'Host': self.host,
+            }, timeout=self.timeout)
+            ok = r.status_code == 200
+            if not ok:
+                log.error("Failed to send purge request to %s: status %s" % (self.name, r.status_code))
+        except requests.exceptions.RequestException as e:
+            log.error("Failed to send purge request to %s: %s" % (self.name, e))
+            ok = False
+        seconds = time.time() - start
+        with self.lock:
+            self.requests += 1
+            self.seconds += seconds
+            self.maxseconds = max(self.maxseconds, seconds)
+            if ok:
+                self.keys += len(keys)
+            else:
+                self.failures += 1
+        return ok
+
+    def purge_keys(self, keys):
+        # Returns True if all keys were purged
+        chunks = [keys[i:i + self.maxkeys] for i in range(0, len(keys), self.maxkeys)]
+        if len(chunks) == 1 or self.connections == 1:
+            # Stop at the first failure, the rest will be retried anyway
+            for c in chunks:
+                if not self._post(c):
+                    return False
+            return True
+        if not self.pool:
+            self.pool = ThreadPoolExecutor(self.connections)
+        return all(list(self.pool.map(self._post, chunks)))
+
+    def stats(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'failures': self.failures,
+                'keys': self.keys,
+                'seconds': self.seconds,
+                'maxseconds': self.maxseconds,
+            }
 
 
 class VarnishPurger(object):
+    # Purge all the cache frontends configured: the purgeurl in the
+    # [varnish] section, and the purgeurl of each [varnish:<name>]
+    # section. The frontends are purged at the same time. maxkeys,
+    # connections, timeout and host can be set in each section, and
+    # default to what is set in [varnish].
     def __init__(self, cfg):
         self.cfg = cfg
+        self.endpoints = []
+        for section in ['varnish'] + sorted([s for s in cfg.sections() if s.startswith('varnish:')]):
+            if not cfg.has_option(section, 'purgeurl'):
+                continue
+
+            def _get(option, default):
+                if cfg.has_option(section, option):
+                    return cfg.get(section, option)
+                if cfg.has_option('varnish', option):
+                    return cfg.get('varnish', option)
+                return default
+
+            self.endpoints.append(PurgeEndpoint(
+                section == 'varnish' and 'default' or section[8:],
+                cfg.get(section, 'purgeurl'),
+                int(_get('maxkeys', 100)),
+                int(_get('connections', 2)),
+                float(_get('timeout', 30)),
+                _get('host', 'www.postgresql.org'),
+            ))
+        self.pool = None
+
+    def enabled(self):
+        return len(self.endpoints) > 0
 
     def purge(self, purges):
-        if not len(purges):
-            return
-
-        if not self.cfg.has_option('varnish', 'purgeurl'):
-            return
-
-        purgeurl = self.cfg.get('varnish', 'purgeurl')
-        exprlist = []
-        for p in purges:
-            if isinstance(p, tuple):
-                # Purging a list
-                exprlist.append('pgam_%s/%s/%s' % p)
-            else:
-                # Purging individual thread
-                exprlist.append('pgat_%s' % p)
-        purgedict = dict(list(zip(['x%s' % n for n in range(0, len(exprlist))], exprlist)))
-        purgedict['n'] = len(exprlist)
-        r = requests.post(purgeurl, data=purgedict, headers={
-            'Content-type': 'application/x-www-form-urlencoded',
-            'Host': 'www.postgresql.org',
-        }, timeout=30)
-        if r.status_code != 200:
-            log.error("Failed to send purge request!")
+        return self.purge_keys([purge_key(p) for p in purges])
+
+    def purge_keys(self, keys):
+        # Returns True if the keys were purged on all frontends, or there
+        # was nothing to do
+        if not len(keys) or not self.endpoints:
+            return True
+
+        with opstatus.phase('purge'):
+            if len(self.endpoints) == 1:
+                return self.endpoints[0].purge_keys(keys)
+            if not self.pool:
+                self.pool = ThreadPoolExecutor(len(self.endpoints))
+            return all(list(self.pool.map(lambda e: e.purge_keys(keys), self.endpoints)))
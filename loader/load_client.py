@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+#
+# load_client.py - hand a single email on stdin to load_daemon.py,
+# and exit the same way load_message.py would have. Meant to be run by
+# the MTA instead of load_message.py, so it only uses the standard
+# library. If the daemon isn't running, load_message.py is run instead.
+#
+
+import os
+import sys
+import socket
+import subprocess
+
+from optparse import OptionParser
+from configparser import ConfigParser
+
+# Exit code for when we don't know if the message was loaded, making the
+# MTA try again later. Loading it twice does no harm.
+EX_TEMPFAIL = 75
+
+
+if __name__ == "__main__":
+    optparser = OptionParser()
+    optparser.add_option('-l', '--list', dest='list', help='Name of list to load message for')
+    optparser.add_option('--socket', dest='socket', help='UNIX socket of load_daemon.py (default from archives.ini)')
+    optparser.add_option('--timeout', dest='timeout', type='int', default=300, help='Seconds to wait for the message to be loaded (default 300)')
+
+    (opt, args) = optparser.parse_args()
+
+    if (len(args)):
+        print("No bare arguments accepted")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if not opt.list:
+        print("List must be specified")
+        optparser.print_usage()
+        sys.exit(1)
+
+    mydir = os.path.realpath(os.path.dirname(sys.argv[0]))
+    cfg = ConfigParser()
+    cfg.read('%s/archives.ini' % mydir)
+    if opt.socket:
+        socketpath = opt.socket
+    elif cfg.has_option('daemon', 'socket'):
+        socketpath = cfg.get('daemon', 'socket')
+    else:
+        socketpath = '/tmp/.pgarchives_loader'
+
+    rawtxt = sys.stdin.buffer.read()
+
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(socketpath)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # Daemon not running, so do it the slow way
+        s.close()
+        r = subprocess.run([sys.executable, os.path.join(mydir, 'load_message.py'), '-l', opt.list], input=rawtxt)
+        sys.exit(r.returncode)
+
+    try:
+        s.settimeout(opt.timeout)
+        s.sendall(opt.list.encode('utf8') + b'\n' + rawtxt)
+        s.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            b = s.recv(4096)
+            if not b:
+                break
+            chunks.append(b)
+        s.close()
+    except (OSError, socket.timeout) as e:
+        print("Failed to talk to loader daemon: %s" % e)
+        sys.exit(EX_TEMPFAIL)
+
+    (code, sep, message) = b''.join(chunks).decode('utf8', errors='ignore').strip().partition(' ')
+    if not code.isdigit():
+        print("No result from loader daemon")
+        sys.exit(EX_TEMPFAIL)
+    if message:
+        print(message)
+    sys.exit(int(code))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#
+# load_daemon.py - keep running and load messages handed to it by
+# load_client.py over a UNIX socket, delivered over LMTP, or dropped in
+# a spool directory, instead of starting a new load_message.py for each
+# of them.
+#
+
+import os
+import sys
+import signal
+import threading
+
+from optparse import OptionParser
+from configparser import ConfigParser
+
+from lib.daemon import LoaderDaemon, SocketListener, SpoolWatcher
+from lib.lmtp import LmtpListener
+from lib.log import log, opstatus
+from lib.charset import load_aliases
+
+
+if __name__ == "__main__":
+    optparser = OptionParser()
+    optparser.add_option('--socket', dest='socket', help='UNIX socket to listen on (default from archives.ini)')
+    optparser.add_option('--socket-mode', dest='socketmode', default='660', help='Permissions of the socket (default 660)')
+    optparser.add_option('--spool', dest='spool', help='Also load messages from <spool>/<listname>/')
+    optparser.add_option('--lmtp', dest='lmtp', help='Also accept messages for <listname>@ over LMTP on [<address>:]<port>')
+    optparser.add_option('--max-connections', dest='maxconnections', type='int', default=20, help='Maximum number of LMTP connections at once (default 20)')
+    optparser.add_option('--max-pending', dest='maxpending', type='int', default=100, help='Maximum number of LMTP messages waiting to be loaded (default 100)')
+    optparser.add_option('--queue-timeout', dest='queuetimeout', type='int', default=60, help='Seconds an LMTP message can wait for room in the queue before being temporarily rejected (default 60)')
+    optparser.add_option('--load-timeout', dest='loadtimeout', type='int', default=300, help='Seconds to wait for an LMTP message to be loaded before temporarily rejecting it (default 300)')
+    optparser.add_option('--max-size', dest='maxsize', type='int', default=50, help='Maximum size of LMTP messages in MB (default 50)')
+    optparser.add_option('--no-socket', dest='nosocket', action='store_true', help='Don\'t listen on a UNIX socket, only use LMTP and/or the spool directory')
+    optparser.add_option('--window', dest='window', type='int', default=50, help='Milliseconds to wait for more messages to load in the same transaction (default 50)')
+    optparser.add_option('--max-batch', dest='maxbatch', type='int', default=100, help='Maximum number of messages to load in one transaction (default 100)')
+    optparser.add_option('--store-function', dest='function', action='store_true', help='Resolve threads and store messages using the archives_store_message() database function')
+    optparser.add_option('-v', '--verbose', dest='verbose', action='store_true', help='Verbose output')
+    optparser.add_option('--timing', dest='timing', action='store_true', help='Collect time spent in each phase, and print it on exit')
+    optparser.add_option('--stats-prometheus', dest='statsprom', help='Write statistics to file in Prometheus textfile format after each batch')
+
+    (opt, args) = optparser.parse_args()
+
+    if (len(args)):
+        print("No bare arguments accepted")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if opt.nosocket and not (opt.spool or opt.lmtp):
+        print("Nothing to do without socket, LMTP or spool directory")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if opt.spool and not os.path.isdir(opt.spool):
+        print("Spool directory %s does not exist" % opt.spool)
+        sys.exit(1)
+
+    log.set(opt.verbose)
+    opstatus.set_timing(opt.timing or opt.statsprom)
+
+    cfg = ConfigParser()
+    cfg.read('%s/archives.ini' % os.path.realpath(os.path.dirname(sys.argv[0])))
+    try:
+        connstr = cfg.get('db', 'connstr')
+    except Exception:
+        connstr = 'need_connstr'
+    load_aliases(cfg)
+
+    daemon = LoaderDaemon(cfg, connstr, opt.window / 1000.0, opt.maxbatch, opt.statsprom, opt.function)
+    # Fail right away if we can't connect, rather than on the first message
+    daemon.connect()
+
+    threads = []
+    if not opt.nosocket:
+        if opt.socket:
+            socketpath = opt.socket
+        elif cfg.has_option('daemon', 'socket'):
+            socketpath = cfg.get('daemon', 'socket')
+        else:
+            socketpath = '/tmp/.pgarchives_loader'
+        listener = SocketListener(daemon, socketpath, int(opt.socketmode, 8))
+        threads.append(threading.Thread(target=listener.run))
+        log.log("Listening on %s" % socketpath)
+    if opt.lmtp:
+        (host, sep, port) = opt.lmtp.rpartition(':')
+        lmtp = LmtpListener(daemon, host or 'localhost', int(port), opt.maxconnections, opt.maxpending, opt.queuetimeout, opt.maxsize * 1024 * 1024, opt.loadtimeout)
+        threads.append(threading.Thread(target=lmtp.run))
+        log.log("Accepting LMTP on %s:%s" % (host or 'localhost', port))
+    if opt.spool:
+        threads.append(threading.Thread(target=SpoolWatcher(daemon, opt.spool).run))
+        log.log("Watching %s" % opt.spool)
+
+    def _stop(signum, frame):
+        log.log("Stopping after loading the messages already received")
+        daemon.stop()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    for t in threads:
+        t.start()
+    daemon.run()
+    for t in threads:
+        t.join()
+
+    opstatus.print_status()
+    if opt.timing:
+        opstatus.print_timing()
@@ -13,10 +13,17 @@ from configparser import ConfigParser
 import psycopg2
 
 from lib.storage import ArchivesParserStorage
+from lib.batchstorage import ArchivesBatchStorage
+from lib.msgcache import MessageCache
 from lib.mbox import MailboxBreakupParser
+from lib.parallel import ParallelParser
+from lib.reorder import reorder
 from lib.exception import IgnorableException
 from lib.log import log, opstatus
-from lib.varnish import VarnishPurger
+from lib.varnish import queue_purges
+from lib.charset import load_aliases
+from lib.locks import lock_loader
+from lib.fti import defer_fti
 
 
 def log_failed_message(listid, srctype, src, msg, err):
@@ -37,6 +44,129 @@ def log_failed_message(listid, srctype, src, msg, err):
     })
 
 
+def parse_message(listid, rawtxt, srctype, src, prescan):
+    # Parse and analyze a message, unless it's filtered out or fails. The
+    # headers are looked at first, so we don't have to build the full MIME
+    # tree of messages that are skipped by the filter, or (if prescan is
+    # set) of messages that are already stored and at most need to be
+    # tagged with our list.
+    opstatus.bytes += len(rawtxt)
+    ap = ArchivesParserStorage()
+    with opstatus.phase('headers'):
+        ap.parse_headers(rawtxt)
+    if opt.filter_msgid and not ap.is_msgid(opt.filter_msgid):
+        return None
+
+    if prescan:
+        try:
+            ap.analyze_headers(date_override=opt.force_date)
+            if ap.find_existing(conn, listid, cache):
+                log.status("Message %s already stored, not parsing body" % ap.msgid)
+                opstatus.headeronly += 1
+                return ap
+        except IgnorableException:
+            # Leave it to the full analysis to report what's wrong
+            pass
+
+    with opstatus.phase('parse'):
+        ap.parse_bytes(rawtxt)
+    try:
+        with opstatus.phase('analyze'):
+            ap.analyze(date_override=opt.force_date)
+    except IgnorableException as e:
+        log_failed_message(listid, srctype, src, ap, e)
+        opstatus.failed += 1
+        return None
+    return ap
+
+
+def store_message(ap, listid, srctype, src):
+    # Returns True if the message was stored. With commit_every, a message
+    # that fails to store is recorded in loaderrors and skipped, rather
+    # than failing the whole load.
+    with opstatus.phase('store'):
+        if not opt.commit_every:
+            ap.store(conn, listid, opt.overwrite, opt.overwrite, cache, keyedlocks, opt.function)
+            return True
+
+        curs.execute("SAVEPOINT load_message")
+        try:
+            ap.store(conn, listid, opt.overwrite, opt.overwrite, cache, keyedlocks, opt.function)
+        except Exception as e:
+            if conn.closed:
+                # Nothing more can be loaded, so fail like without savepoints
+                raise
+            curs.execute("ROLLBACK TO SAVEPOINT load_message")
+            if cache:
+                # May contain what was rolled back
+                cache.clear()
+            log_failed_message(listid, srctype, src, ap, e)
+            opstatus.failed += 1
+            return False
+        curs.execute("RELEASE SAVEPOINT load_message")
+        return True
+
+
+class MboxCheckpoint(object):
+    # Commit every n messages read from an mbox, along with the offset in
+    # the mbox to continue from if the load is restarted, and queue the
+    # purges of what was changed with it.
+    def __init__(self, mbox, listid, n):
+        self.mbox = os.path.realpath(mbox)
+        self.listid = listid
+        self.n = n
+        self.count = 0
+        self.processed = 0
+
+    def resume(self):
+        # Returns the offset to start from
+        curs.execute("SELECT mboxoffset, processed FROM load_checkpoints WHERE mbox=%(mbox)s AND listid=%(listid)s", {
+            'mbox': self.mbox,
+            'listid': self.listid,
+        })
+        r = curs.fetchall()
+        if not r:
+            log.log("No checkpoint found for %s, starting from the beginning" % self.mbox)
+            return 0
+        (offset, self.processed) = r[0]
+        log.log("Resuming at offset %s, after %s messages" % (offset, self.processed))
+        return offset
+
+    def message(self, offset):
+        # Called before loading each message, with its offset
+        if self.count >= self.n:
+            self.commit(offset)
+        self.count += 1
+        self.processed += 1
+
+    def commit(self, offset):
+        curs.execute("INSERT INTO load_checkpoints (mbox, listid, mboxoffset, processed) VALUES (%(mbox)s, %(listid)s, %(offset)s, %(processed)s) ON CONFLICT (mbox, listid) DO UPDATE SET mboxoffset=excluded.mboxoffset, processed=excluded.processed, lastupdate=CURRENT_TIMESTAMP", {
+            'mbox': self.mbox,
+            'listid': self.listid,
+            'offset': offset,
+            'processed': self.processed,
+        })
+        queue_purges(curs, purges)
+        with opstatus.phase('commit'):
+            conn.commit()
+        log.status("Committed %s messages, continuing at offset %s" % (self.processed, offset))
+        purges.clear()
+        self.count = 0
+
+        lock_loader(curs, not keyedlocks)
+        if cache:
+            # Others may have loaded messages while we didn't have the
+            # lock, so we can't trust what we cached.
+            cache.clear()
+
+    def finish(self):
+        # The whole mbox is loaded, so there is nothing to resume
+        curs.execute("DELETE FROM load_checkpoints WHERE mbox=%(mbox)s AND listid=%(listid)s", {
+            'mbox': self.mbox,
+            'listid': self.listid,
+        })
+
+
 if __name__ == "__main__":
     optparser = OptionParser()
     optparser.add_option('-l', '--list', dest='list', help='Name of list to load message for')
@@ -47,6 +177,18 @@ if __name__ == "__main__":
     optparser.add_option('--force-date', dest='force_date', help='Override date (used for dates that can\'t be parsed)')
     optparser.add_option('--filter-msgid', dest='filter_msgid', help='Only process message with given msgid')
     optparser.add_option('--overwrite', dest='overwrite', action='store_true', help='Overwrite full contents of message')
+    optparser.add_option('--parallel', dest='parallel', type='int', help='Parse messages in mbox using <n> worker processes')
+    optparser.add_option('--batch', dest='batch', type='int', help='Store messages from mbox in batches of <n>')
+    optparser.add_option('--reorder', dest='reorder', action='store_true', help='Scan headers first, and load parents before their children')
+    optparser.add_option('--commit-every', dest='commit_every', type='int', help='Commit after every <n> messages from mbox, skipping messages that fail to store')
+    optparser.add_option('--resume', dest='resume', action='store_true', help='Continue an mbox load with commit-every from its last commit')
+    optparser.add_option('--keyed-locks', dest='keyedlocks', action='store_true', help='Only lock the messages and threads loaded from directory or mbox, instead of all loading (disables the cache, use with commit-every for large mboxes)')
+    optparser.add_option('--store-function', dest='function', action='store_true', help='Resolve threads and store messages using the archives_store_message() database function (disables the cache)')
+    optparser.add_option('--defer-fti', dest='deferfti', action='store_true', help='Mark stored messages as pending full text indexing instead of indexing them, for fill_fti.py to do later')
+    optparser.add_option('--cache-size', dest='cachesize', type='int', default=10000, help='Number of message-ids to cache while loading, 0 to disable')
+    optparser.add_option('--timing', dest='timing', action='store_true', help='Collect and print time spent in each phase of the load')
+    optparser.add_option('--stats-json', dest='statsjson', help='Write load statistics as JSON to file')
+    optparser.add_option('--stats-prometheus', dest='statsprom', help='Write load statistics to file in Prometheus textfile format')
 
     (opt, args) = optparser.parse_args()
 
@@ -75,7 +217,48 @@ if __name__ == "__main__":
         optparser.print_usage()
         sys.exit(1)
 
+    if opt.parallel and not opt.mbox:
+        print("parallel can only be used with mbox")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if opt.reorder and not (opt.directory or opt.mbox):
+        print("reorder makes no sense without directory or mbox!")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if opt.batch and not opt.mbox:
+        print("batch can only be used with mbox")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if opt.batch and opt.overwrite:
+        print("Can't use batch with overwrite")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if opt.batch and (opt.keyedlocks or opt.function):
+        print("Can't use batch with keyed locks or store function")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if opt.commit_every and not opt.mbox:
+        print("commit-every can only be used with mbox")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if opt.commit_every and (opt.batch or opt.reorder):
+        print("Can't use commit-every with batch or reorder")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if opt.resume and not opt.commit_every:
+        print("resume can only be used with commit-every")
+        optparser.print_usage()
+        sys.exit(1)
+
     log.set(opt.verbose)
+    opstatus.set_timing(opt.timing or opt.statsjson or opt.statsprom)
 
     cfg = ConfigParser()
     cfg.read('%s/archives.ini' % os.path.realpath(os.path.dirname(sys.argv[0])))
@@ -83,16 +266,23 @@ if __name__ == "__main__":
         connstr = cfg.get('db', 'connstr')
     except Exception:
         connstr = 'need_connstr'
+    load_aliases(cfg)
 
     conn = psycopg2.connect(connstr)
     curs = conn.cursor()
 
-    # Take an advisory lock to force serialization.
-    # We could do this "properly" by reordering operations and using ON CONFLICT,
-    # but concurrency is not that important and this is easier...
+    # Take the loader lock. A single message only locks what it affects,
+    # so deliveries can be loaded at the same time as each other. Loading
+    # a directory or mbox keeps everybody else out, unless asked not to:
+    # it can then cache what it has seen, and doesn't pile up keyed locks
+    # for every message until it commits, which can run out of room in
+    # the lock table. See lib/locks.py.
+    keyedlocks = opt.keyedlocks or not (opt.directory or opt.mbox)
     try:
         curs.execute("SET statement_timeout='30s'")
-        curs.execute("SELECT pg_advisory_xact_lock(8059944559669076)")
+        if opt.deferfti:
+            defer_fti(curs)
+        lock_loader(curs, not keyedlocks)
     except Exception as e:
         print(("Failed to wait on advisory lock: %s" % e))
         sys.exit(1)
@@ -110,26 +300,36 @@ if __name__ == "__main__":
 
     purges = set()
 
+    if opt.cachesize > 0 and not (keyedlocks or opt.function):
+        cache = MessageCache(opt.cachesize)
+    else:
+        cache = None
+
     if opt.directory:
         # Parse all files in directory
-        for x in os.listdir(opt.directory):
+        files = os.listdir(opt.directory)
+        if opt.reorder:
+            def _read_file(x):
+                with open(os.path.join(opt.directory, x), 'rb') as f:
+                    return f.read()
+            files = reorder(files, _read_file)
+        for x in files:
             log.status("Parsing file %s" % x)
-            with open(os.path.join(opt.directory, x)) as f:
-                ap = ArchivesParserStorage()
-                ap.parse(f)
-                if opt.filter_msgid and not ap.is_msgid(opt.filter_msgid):
+            with open(os.path.join(opt.directory, x), 'rb') as f:
+                ap = parse_message(listid, f.read(), "directory", os.path.join(opt.directory, x), not opt.overwrite)
+                if not ap:
                     continue
-                try:
-                    ap.analyze(date_override=opt.force_date)
-                except IgnorableException as e:
-                    log_failed_message(listid, "directory", os.path.join(opt.directory, x), ap, e)
-                    opstatus.failed += 1
-                    continue
-                ap.store(conn, listid, opt.overwrite, opt.overwrite)
-                purges.update(ap.purges)
+                if store_message(ap, listid, "directory", os.path.join(opt.directory, x)):
+                    purges.update(ap.purges)
             if opt.interactive:
                 print("Interactive mode, committing transaction")
-                conn.commit()
+                with opstatus.phase('commit'):
+                    conn.commit()
+                lock_loader(curs, not keyedlocks)
+                if cache:
+                    # Others may have loaded messages while we didn't
+                    # have the lock, so we can't trust what we cached.
+                    cache.clear()
                 print("Proceed to next message with Enter, or input a period (.) to stop processing")
                 x = input()
                 if x == '.':
@@ -140,44 +340,84 @@ if __name__ == "__main__":
         if not os.path.isfile(opt.mbox):
             print("File %s does not exist" % opt.mbox)
             sys.exit(1)
-        mboxparser = MailboxBreakupParser(opt.mbox)
-        while not mboxparser.EOF:
-            ap = ArchivesParserStorage()
-            msg = next(mboxparser)
-            if not msg:
-                break
-            ap.parse(msg)
-            if opt.filter_msgid and not ap.is_msgid(opt.filter_msgid):
-                continue
-            try:
-                ap.analyze(date_override=opt.force_date)
-            except IgnorableException as e:
-                log_failed_message(listid, "mbox", opt.mbox, ap, e)
-                opstatus.failed += 1
-                continue
-            ap.store(conn, listid, opt.overwrite, opt.overwrite)
-            purges.update(ap.purges)
-        if mboxparser.returncode():
-            log.error("Failed to parse mbox:")
-            log.error(mboxparser.stderr_output())
-            sys.exit(1)
+        if opt.commit_every:
+            checkpoint = MboxCheckpoint(opt.mbox, listid, opt.commit_every)
+            mboxparser = MailboxBreakupParser(opt.mbox, opt.resume and checkpoint.resume() or 0)
+        else:
+            checkpoint = None
+            mboxparser = MailboxBreakupParser(opt.mbox)
+        if opt.reorder:
+            messages = reorder(list(mboxparser), lambda m: m)
+        else:
+            messages = mboxparser
+        if opt.batch:
+            batchstorage = ArchivesBatchStorage(conn, listid, opt.batch)
+        else:
+            batchstorage = None
+
+        if opt.parallel:
+            pp = ParallelParser(opt.parallel, opt.filter_msgid, opt.force_date)
+            for ap, err in pp.parse((bytes(msg) for msg in messages), lambda: mboxparser.lastoffset):
+                if checkpoint:
+                    checkpoint.message(pp.position)
+                if err:
+                    log_failed_message(listid, "mbox", opt.mbox, ap, err)
+                    opstatus.failed += 1
+                    continue
+                opstatus.bytes += len(ap.rawtxt)
+                if batchstorage:
+                    batchstorage.add(ap)
+                    continue
+                if store_message(ap, listid, "mbox", opt.mbox):
+                    purges.update(ap.purges)
+            pp.print_status()
+        else:
+            for msg in messages:
+                if checkpoint:
+                    checkpoint.message(mboxparser.lastoffset)
+                # The batch storage looks up all messages in a batch at
+                # once, so checking them one by one first would only cost
+                # more.
+                ap = parse_message(listid, msg, "mbox", opt.mbox, not (opt.overwrite or batchstorage))
+                if not ap:
+                    continue
+                if batchstorage:
+                    batchstorage.add(ap)
+                    continue
+                if store_message(ap, listid, "mbox", opt.mbox):
+                    purges.update(ap.purges)
+        messages = None
+        mboxparser.close()
+        if batchstorage:
+            batchstorage.flush()
+            purges.update(batchstorage.purges)
+        if checkpoint:
+            checkpoint.finish()
     else:
         # Parse single message on stdin
         ap = ArchivesParserStorage()
         ap.parse(sys.stdin.buffer)
+        opstatus.bytes += len(ap.rawtxt)
         try:
             ap.analyze(date_override=opt.force_date)
         except IgnorableException as e:
             log_failed_message(listid, "stdin", "", ap, e)
             conn.close()
             sys.exit(1)
-        ap.store(conn, listid, opt.overwrite, opt.overwrite)
+        ap.store(conn, listid, opt.overwrite, opt.overwrite, keyedlocks=keyedlocks, function=opt.function)
         purges.update(ap.purges)
         if opstatus.stored:
             log.log("Stored message with message-id %s" % ap.msgid)
 
-    conn.commit()
+    queue_purges(curs, purges)
+    with opstatus.phase('commit'):
+        conn.commit()
     conn.close()
     opstatus.print_status()
 
-    VarnishPurger(cfg).purge(purges)
+    if opt.timing:
+        opstatus.print_timing()
+    if opt.statsjson:
+        opstatus.write_json(opt.statsjson)
+    if opt.statsprom:
+        opstatus.write_prometheus(opt.statsprom, 'load_message')
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+#
+# purge_daemon.py - send the varnish purges queued by the loaders and
+# other tools in pending_purges, retrying those that fail.
+#
+
+import os
+import sys
+import signal
+
+from optparse import OptionParser
+from configparser import ConfigParser
+
+from lib.purger import PurgeDaemon
+from lib.log import log
+
+
+if __name__ == "__main__":
+    optparser = OptionParser()
+    optparser.add_option('--once', dest='once', action='store_true', help='Send what is due and exit, instead of waiting for more')
+    optparser.add_option('--threshold', dest='threshold', type='int', default=200, help='Replace thread and message keys with month keys when sending more than <n> at once (default 200)')
+    optparser.add_option('--batch-size', dest='batchsize', type='int', default=1000, help='Maximum number of queued keys to handle in one round (default 1000)')
+    optparser.add_option('--max-backoff', dest='maxbackoff', type='int', default=600, help='Maximum seconds to wait before retrying a failed purge (default 600)')
+    optparser.add_option('--stats-prometheus', dest='statsprom', help='Write statistics, including those of each frontend, to file in Prometheus textfile format after each round')
+    optparser.add_option('-v', '--verbose', dest='verbose', action='store_true', help='Verbose output')
+
+    (opt, args) = optparser.parse_args()
+
+    if (len(args)):
+        print("No bare arguments accepted")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if opt.batchsize < 1:
+        print("Batch size must be at least 1")
+        sys.exit(1)
+
+    log.set(opt.verbose)
+
+    cfg = ConfigParser()
+    cfg.read('%s/archives.ini' % os.path.realpath(os.path.dirname(sys.argv[0])))
+    try:
+        connstr = cfg.get('db', 'connstr')
+    except Exception:
+        connstr = 'need_connstr'
+
+    daemon = PurgeDaemon(cfg, connstr, opt.threshold, opt.batchsize, maxbackoff=opt.maxbackoff, statsprom=opt.statsprom)
+    if not daemon.purger.enabled():
+        log.log("No varnish purgeurl configured, queued purges will be discarded")
+
+    def _stop(signum, frame):
+        log.log("Stopping")
+        daemon.stop()
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+
+    daemon.run(opt.once)
+    log.log("Purged %s keys, %s failed attempts" % (daemon.purged, daemon.failed))
+    for e in daemon.purger.endpoints:
+        s = e.stats()
+        log.log("%s: %s requests, %s failed, %s keys, %.3fs average, %.3fs max" % (
+            e.name, s['requests'], s['failures'], s['keys'], s['requests'] and s['seconds'] / s['requests'] or 0, s['maxseconds']))
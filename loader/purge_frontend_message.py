@@ -1,7 +1,8 @@
 #!/usr/bin/env python3
 #
-# purge_frontend_message.py - issue varnish purge for the message
+# purge_frontend_message.py - queue a varnish purge for the message
 # in question, to for example force an expire of a hidden message.
+# The purge is sent by purge_daemon.py.
 #
 
 import os
@@ -12,7 +13,7 @@ from configparser import ConfigParser
 
 import psycopg2
 
-from lib.varnish import VarnishPurger
+from lib.varnish import queue_purges
 
 if __name__ == "__main__":
     optparser = OptionParser()
@@ -40,10 +41,11 @@ if __name__ == "__main__":
     conn = psycopg2.connect(connstr)
     curs = conn.cursor()
 
-    curs.execute("SELECT id, threadid FROM messages WHERE messageid=%(msgid)s", {
+    curs.execute("SELECT id, COALESCE(a.canonical, m.threadid) FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE messageid=%(msgid)s", {
         'msgid': opt.msgid,
     })
     id, threadid = curs.fetchone()
 
-    VarnishPurger(cfg).purge([int(threadid), ])
+    queue_purges(curs, [int(threadid), ])
+    conn.commit()
     conn.close()
@@ -4,6 +4,11 @@
 # redo the parsing of it and overwrite it with itself. Used when
 # parsing rules have changed.
 #
+# With --all, the messages are split into id ranges that are reparsed
+# by a pool of workers, committing as they go. An interrupted run is
+# resumed by running the same command again. --outdated does the same,
+# but only for messages stored by an older version of the parser.
+#
 
 import os
 import sys
@@ -19,7 +24,11 @@ import psycopg2
 from lib.storage import ArchivesParserStorage
 from lib.exception import IgnorableException
 from lib.log import log, opstatus
-from lib.varnish import VarnishPurger
+from lib.varnish import queue_purges
+from lib.charset import load_aliases
+from lib.parser import PARSER_VERSION
+from lib.reparse import ShardedReparser
+from lib.fti import defer_fti
 
 
 def ResultIter(cursor):
@@ -33,15 +42,83 @@ def ResultIter(cursor):
             yield r
 
 
+def reparse_all(conn, connstr, cfg, opt):
+    # Reparse all (or all outdated) messages in a pool of workers, each
+    # committing its progress as it goes. If a run with the same name was
+    # interrupted, continue it.
+    run = opt.update and 'update' or 'diff'
+    if opt.outdated:
+        run = 'outdated-' + run
+    reparser = ShardedReparser(conn, connstr, opt.run or run,
+                               opt.workers, opt.batchsize, opt.update, opt.force_date,
+                               opt.outdated, opt.charsets, opt.deferfti)
+    if reparser.setup(opt.shards or opt.workers * 4, opt.restart):
+        print("Resuming run '%s'" % reparser.run)
+
+    totalcount = reparser.count()
+    if opt.outdated and opt.update:
+        # Messages already reparsed in this run are no longer outdated
+        totalcount += reparser.progress()[0]
+
+    firststatus = datetime.now()
+
+    def _status():
+        num, updated, failed, done, shards = reparser.progress()
+        elapsed = (datetime.now() - firststatus).seconds
+        sys.stdout.write("%s messages parsed (%s%%, %s / second), %s updated, %s/%s shards done\r" % (
+            num, totalcount and num * 100 / totalcount or 0, elapsed and num / elapsed or 0, updated, done, shards))
+        sys.stdout.flush()
+
+    with opstatus.phase('workers'):
+        reparser.reparse(_status)
+    print("")
+
+    num, updated, failed, done, shards = reparser.progress()
+    opstatus.failed = failed
+    opstatus.overwritten = updated
+    print("%s messages parsed, %s updated, %s failed" % (num, updated, failed))
+
+    if opt.update:
+        if opt.charsets:
+            print("%s messages not using %s marked as parsed by version %s" % (reparser.stamp_unaffected(), ", ".join(opt.charsets), PARSER_VERSION))
+    else:
+        reparser.merge_diffs('reparse.diffs', 'reparse.fromonly')
+        if os.path.getsize('reparse.diffs') == 0:
+            os.unlink('reparse.diffs')
+        if os.path.getsize('reparse.fromonly') == 0:
+            os.unlink('reparse.fromonly')
+    reparser.finish()
+
+
+def print_stats(opt):
+    if opt.timing:
+        opstatus.print_timing()
+    if opt.statsjson:
+        opstatus.write_json(opt.statsjson)
+    if opt.statsprom:
+        opstatus.write_prometheus(opt.statsprom, 'reparse_message')
+
+
 if __name__ == "__main__":
     optparser = OptionParser()
     optparser.add_option('-m', '--msgid', dest='msgid', help='Messageid to load')
     optparser.add_option('--all', dest='all', action='store_true', help='Load *all* messages currently in the db')
+    optparser.add_option('--outdated', dest='outdated', action='store_true', help='Load all messages stored by an older version of the parser')
+    optparser.add_option('--charset', dest='charsets', action='append', help='With --outdated, only load messages using this charset, and consider the rest up to date (can be given multiple times)')
     optparser.add_option('--sample', dest='sample', help='Load a sample of <n> messages')
     optparser.add_option('-v', '--verbose', dest='verbose', action='store_true', help='Verbose output')
     optparser.add_option('--force-date', dest='force_date', help='Override date (used for dates that can\'t be parsed)')
     optparser.add_option('--update', dest='update', action='store_true', help='Actually update, not just diff (default is diff)')
+    optparser.add_option('--defer-fti', dest='deferfti', action='store_true', help='With --update, mark updated messages as pending full text indexing instead of indexing them, for fill_fti.py to do later')
     optparser.add_option('--commit', dest='commit', action='store_true', help='Commit the transaction without asking')
+    optparser.add_option('--workers', dest='workers', type='int', default=4, help='With --all or --outdated, number of worker processes (default 4)')
+    optparser.add_option('--shards', dest='shards', type='int', help='With --all or --outdated, number of id ranges to split the messages into (default 4 per worker)')
+    optparser.add_option('--batch-size', dest='batchsize', type='int', default=1000, help='With --all or --outdated, commit progress every <n> messages (default 1000)')
+    optparser.add_option('--run', dest='run', help='With --all or --outdated, name of the run to resume (default "update" or "diff")')
+    optparser.add_option('--restart', dest='restart', action='store_true', help='With --all or --outdated, start over instead of resuming an interrupted run')
+    optparser.add_option('--timing', dest='timing', action='store_true', help='Collect and print time spent in each phase')
+    optparser.add_option('--stats-json', dest='statsjson', help='Write statistics as JSON to file')
+    optparser.add_option('--stats-prometheus', dest='statsprom', help='Write statistics to file in Prometheus textfile format')
 
     (opt, args) = optparser.parse_args()
 
@@ -50,8 +127,26 @@ if __name__ == "__main__":
         optparser.print_usage()
         sys.exit(1)
 
-    if sum([1 for x in [opt.all, opt.sample, opt.msgid] if x]) != 1:
-        print("Must specify exactly one of --msgid, --all and --sample")
+    if sum([1 for x in [opt.all, opt.outdated, opt.sample, opt.msgid] if x]) != 1:
+        print("Must specify exactly one of --msgid, --all, --outdated and --sample")
+        sys.exit(1)
+
+    if opt.charsets and not opt.outdated:
+        print("--charset can only be used with --outdated")
+        sys.exit(1)
+    if opt.charsets:
+        opt.charsets = [c.lower() for c in opt.charsets]
+
+    if (opt.all or opt.outdated) and opt.update and not opt.commit:
+        print("--all and --outdated commit in batches as they go, so --update requires --commit")
+        sys.exit(1)
+
+    if opt.deferfti and not opt.update:
+        print("--defer-fti can only be used with --update")
+        sys.exit(1)
+
+    if opt.workers < 1 or opt.batchsize < 1:
+        print("Workers and batch size must be at least 1")
         sys.exit(1)
 
     if not opt.update and os.path.exists('reparse.diffs'):
@@ -59,6 +154,7 @@ if __name__ == "__main__":
         sys.exit(1)
 
     log.set(opt.verbose)
+    opstatus.set_timing(opt.timing or opt.statsjson or opt.statsprom)
 
     cfg = ConfigParser()
     cfg.read('%s/archives.ini' % os.path.realpath(os.path.dirname(sys.argv[0])))
@@ -66,17 +162,22 @@ if __name__ == "__main__":
         connstr = cfg.get('db', 'connstr')
     except Exception:
         connstr = 'need_connstr'
+    load_aliases(cfg)
 
     conn = psycopg2.connect(connstr)
 
+    if opt.all or opt.outdated:
+        reparse_all(conn, connstr, cfg, opt)
+        conn.close()
+        print_stats(opt)
+        sys.exit(0)
+
+    if opt.deferfti:
+        defer_fti(conn.cursor())
+
     # Get messages
     curs = conn.cursor('msglist')
-    if opt.all:
-        curs2 = conn.cursor()
-        curs2.execute("SELECT count(*) FROM messages WHERE hiddenstatus IS NULL")
-        totalcount, = curs2.fetchone()
-        curs.execute("SELECT id, rawtxt FROM messages WHERE hiddenstatus IS NULL ORDER BY id")
-    elif opt.sample:
+    if opt.sample:
         totalcount = int(opt.sample)
         curs.execute("SELECT id, rawtxt FROM messages WHERE hiddenstatus IS NULL ORDER BY id DESC LIMIT %(num)s", {
             'num': int(opt.sample),
@@ -97,10 +198,13 @@ if __name__ == "__main__":
     updated = 0
     for id, rawtxt in ResultIter(curs):
         num += 1
+        opstatus.bytes += len(rawtxt)
         ap = ArchivesParserStorage()
-        ap.parse(BytesIO(rawtxt))
+        with opstatus.phase('parse'):
+            ap.parse(BytesIO(rawtxt))
         try:
-            ap.analyze(date_override=opt.force_date)
+            with opstatus.phase('analyze'):
+                ap.analyze(date_override=opt.force_date)
         except IgnorableException as e:
             if opt.update:
                 print("Exception loading {0}: {1}".format(id, e))
@@ -109,10 +213,12 @@ if __name__ == "__main__":
             continue
 
         if opt.update:
-            if ap.store(conn, listid=-9, overwrite=True):
-                updated += 1
+            with opstatus.phase('store'):
+                if ap.store(conn, listid=-9, overwrite=True):
+                    updated += 1
         else:
-            ap.diff(conn, f, fromonlyf, id)
+            with opstatus.phase('diff'):
+                ap.diff(conn, f, fromonlyf, id)
         if datetime.now() - laststatus > timedelta(seconds=5):
             sys.stdout.write("%s messages parsed (%s%%, %s / second), %s updated\r" % (num,
                                                                                        num * 100 / totalcount,
@@ -136,8 +242,9 @@ if __name__ == "__main__":
                     print("Aborting and rolling back")
                     conn.rollback()
                     sys.exit(1)
-        conn.commit()
-        VarnishPurger(cfg).purge(ap.purges)
+        queue_purges(conn.cursor(), ap.purges)
+        with opstatus.phase('commit'):
+            conn.commit()
     else:
         fromonlyf.close()
         f.close()
@@ -149,3 +256,5 @@ if __name__ == "__main__":
         # Just in case
         conn.rollback()
     conn.close()
+
+    print_stats(opt)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+#
+# rethread.py - redo the threading of all messages of a list, or of the
+# whole archive, from the headers stored in the database. Used to fix
+# historical threading, without replaying all messages through store().
+#
+# The threading is computed in memory and written back in a single
+# transaction. Without --update, only the differences are reported.
+#
+
+import os
+import sys
+
+from optparse import OptionParser
+from configparser import ConfigParser
+
+import psycopg2
+
+from lib.log import log, opstatus
+from lib.locks import lock_loader
+from lib.varnish import queue_purges
+from lib.rethread import Rethreader
+
+
+if __name__ == "__main__":
+    optparser = OptionParser()
+    optparser.add_option('-l', '--list', dest='list', help='Name of list to rethread')
+    optparser.add_option('--all', dest='all', action='store_true', help='Rethread *all* messages currently in the db')
+    optparser.add_option('--update', dest='update', action='store_true', help='Actually update, not just diff (default is diff)')
+    optparser.add_option('--diff', dest='diff', default='rethread.diffs', help='File to write the differences to (default rethread.diffs)')
+    optparser.add_option('-v', '--verbose', dest='verbose', action='store_true', help='Verbose output')
+    optparser.add_option('--timing', dest='timing', action='store_true', help='Collect and print time spent in each phase')
+
+    (opt, args) = optparser.parse_args()
+
+    if (len(args)):
+        print("No bare arguments accepted")
+        optparser.print_usage()
+        sys.exit(1)
+
+    if bool(opt.list) == bool(opt.all):
+        print("Must specify exactly one of --list and --all")
+        sys.exit(1)
+
+    if os.path.exists(opt.diff):
+        print("File %s already exists. Remove or rename and try again." % opt.diff)
+        sys.exit(1)
+
+    log.set(opt.verbose)
+    opstatus.set_timing(opt.timing)
+
+    cfg = ConfigParser()
+    cfg.read('%s/archives.ini' % os.path.realpath(os.path.dirname(sys.argv[0])))
+    try:
+        connstr = cfg.get('db', 'connstr')
+    except Exception:
+        connstr = 'need_connstr'
+
+    conn = psycopg2.connect(connstr)
+    curs = conn.cursor()
+
+    listid = None
+    if opt.list:
+        curs.execute("SELECT listid FROM lists WHERE listname=%(list)s", {
+            'list': opt.list,
+        })
+        r = curs.fetchall()
+        if len(r) != 1:
+            log.error("List %s not found" % opt.list)
+            conn.close()
+            sys.exit(1)
+        listid = r[0][0]
+
+    if opt.update:
+        # Nothing can be loaded while we work out the threading, or it
+        # would be written back based on an outdated view.
+        lock_loader(curs)
+    else:
+        conn.rollback()
+        conn.set_session(isolation_level='REPEATABLE READ', readonly=True)
+
+    rethreader = Rethreader(conn, listid)
+    rethreader.load()
+    rethreader.resolve(opt.update)
+
+    reparented, rethreaded = rethreader.changes()
+    with open(opt.diff, 'w') as f:
+        rethreader.write_diff(f)
+    if os.path.getsize(opt.diff) == 0:
+        os.unlink(opt.diff)
+
+    if opt.update:
+        purges = rethreader.purges()
+        updated = rethreader.write()
+        queue_purges(curs, purges)
+        conn.commit()
+        print("%s messages rethreaded, %s got a new parent, %s moved to another thread, %s updated, %s pages purged" % (
+            len(rethreader.ids), len(reparented), len(rethreaded), updated, len(purges)))
+    else:
+        conn.rollback()
+        print("%s messages rethreaded, %s would get a new parent, %s would move to another thread" % (
+            len(rethreader.ids), len(reparented), len(rethreaded)))
+
+    conn.close()
+    if opt.timing:
+        opstatus.print_timing()
@@ -0,0 +1,12 @@
+\set ON_ERROR_STOP
+BEGIN;
+
+TRUNCATE TABLE list_days;
+
+INSERT INTO list_days(listid, day, message_count)
+SELECT listid, (date AT TIME ZONE 'UTC')::date, count(*)
+FROM messages INNER JOIN list_threads ON messages.threadid=list_threads.threadid
+WHERE hiddenstatus IS NULL
+GROUP BY 1, 2;
+
+COMMIT;
@@ -0,0 +1,11 @@
+\set ON_ERROR_STOP
+BEGIN;
+
+TRUNCATE TABLE list_messages;
+
+INSERT INTO list_messages(listid, date, message)
+SELECT listid, date, id
+FROM messages INNER JOIN list_threads ON messages.threadid=list_threads.threadid
+WHERE hiddenstatus IS NULL;
+
+COMMIT;
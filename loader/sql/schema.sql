@@ -17,12 +17,18 @@ CREATE TABLE messages (
    messageid text NOT NULL,
    bodytxt text NOT NULL,
    rawtxt bytea NOT NULL,
-   fti tsvector NOT NULL
+   fti tsvector NOT NULL,
+   fti_pending boolean NOT NULL DEFAULT false, /* fti not filled in yet, see fill_fti.py */
+   parserversion int NOT NULL DEFAULT 0, /* PARSER_VERSION in lib/parser.py */
+   charsets text[] NOT NULL DEFAULT '{}'
 );
 CREATE INDEX idx_messages_threadid ON messages(threadid);
 CREATE UNIQUE INDEX idx_messages_msgid ON messages(messageid);
 CREATE INDEX idx_messages_date ON messages(date);
 CREATE INDEX idx_messages_parentid ON messages(parentid);
+CREATE INDEX idx_messages_parserversion ON messages(parserversion);
+CREATE INDEX idx_messages_charsets ON messages USING gin(charsets);
+CREATE INDEX idx_messages_fti_pending ON messages(id) WHERE fti_pending;
 
 CREATE TABLE message_hide_reasons (
    message int NOT NULL PRIMARY KEY REFERENCES messages,
@@ -65,6 +71,33 @@ CREATE TABLE list_months(
    CONSTRAINT list_months_pk PRIMARY KEY (listid, year, month)
 );
 
+/*
+ * Number of visible messages on each day (in UTC) that a list has any,
+ * for the month and day navigation. Kept up to date along with
+ * list_messages, and can be rebuilt with materialize_all_days.sql.
+ */
+CREATE TABLE list_days(
+   listid int NOT NULL REFERENCES lists(listid),
+   day date NOT NULL,
+   message_count int NOT NULL,
+   CONSTRAINT list_days_pk PRIMARY KEY (listid, day)
+);
+
+/*
+ * The visible messages on each list, which are those in a thread on the
+ * list, for the date lists and the next and previous links without going
+ * through list_threads. Kept up to date by the loader and hide_message(),
+ * see archives_add_list_messages() and archives_remove_list_messages(),
+ * and can be rebuilt with materialize_all_list_messages.sql.
+ */
+CREATE TABLE list_messages(
+   listid int NOT NULL REFERENCES lists(listid),
+   date timestamptz NOT NULL,
+   message int NOT NULL REFERENCES messages,
+   CONSTRAINT list_messages_pk PRIMARY KEY (message, listid)
+);
+CREATE INDEX idx_list_messages_listid_date ON list_messages(listid, date);
+
 CREATE TABLE list_threads(
    threadid int NOT NULL, /* comes from threadid_seq */
    listid int NOT NULL REFERENCES lists(listid),
@@ -72,6 +105,21 @@ CREATE TABLE list_threads(
 );
 CREATE INDEX list_threads_listid_idx ON list_threads(listid);
 
+/*
+ * Threads that have been merged into another one by the loader. Rather than
+ * moving all the messages of a merged thread when the merge happens, which can
+ * be a lot of large rows, it's recorded here, and compact_threads.py moves them
+ * later. Until then, the threadid of a message can be that of a merged thread,
+ * and canonical is the thread it's now part of. canonical is never itself
+ * merged. A merged thread has the same rows in list_threads as its canonical
+ * one, so joining messages to list_threads works either way.
+ */
+CREATE TABLE thread_aliases(
+   threadid int NOT NULL PRIMARY KEY,
+   canonical int NOT NULL
+);
+CREATE INDEX idx_thread_aliases_canonical ON thread_aliases(canonical);
+
 CREATE TABLE attachments(
    id serial not null primary key,
    message int not null references messages(id),
@@ -91,6 +139,66 @@ CREATE TABLE loaderrors(
    err text NOT NULL
 );
 
+/*
+ * Progress of reparse_message.py --all and --outdated, one row per id range (shard) of
+ * messages. Updated in the same transaction as the messages, so a rerun
+ * continues after lastid.
+ */
+CREATE TABLE reparse_checkpoints(
+   run text NOT NULL,
+   shard int NOT NULL,
+   startid int NOT NULL,
+   endid int NOT NULL,
+   lastid int NOT NULL,
+   done boolean NOT NULL DEFAULT false,
+   processed int NOT NULL DEFAULT 0,
+   updated int NOT NULL DEFAULT 0,
+   failed int NOT NULL DEFAULT 0,
+   lastupdate timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+   CONSTRAINT reparse_checkpoints_pk PRIMARY KEY (run, shard)
+);
+
+/*
+ * Progress of load_message.py --mbox --commit-every, with the offset in the
+ * mbox of the first message not yet committed. Updated in the same transaction
+ * as the messages, so --resume continues from there. Removed when the whole
+ * mbox has been loaded.
+ */
+CREATE TABLE load_checkpoints(
+   mbox text NOT NULL,
+   listid int NOT NULL,
+   mboxoffset bigint NOT NULL,
+   processed int NOT NULL DEFAULT 0,
+   lastupdate timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+   CONSTRAINT load_checkpoints_pk PRIMARY KEY (mbox, listid)
+);
+
+/*
+ * Varnish purges waiting to be sent by purge_daemon.py. Loaders queue them
+ * in the same transaction as the changes they are for (see queue_purges()
+ * in lib/varnish.py), so they are not lost if sending them fails, and the
+ * daemon is woken up by a notification on commit.
+ */
+CREATE TABLE pending_purges(
+   key text NOT NULL PRIMARY KEY,
+   queued timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP,
+   generation int NOT NULL DEFAULT 0, /* bumped when queued again */
+   attempts int NOT NULL DEFAULT 0,
+   nextattempt timestamptz NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX idx_pending_purges_nextattempt ON pending_purges(nextattempt);
+
+CREATE FUNCTION pending_purges_notify_func() RETURNS trigger AS $$
+BEGIN
+   PERFORM pg_notify('pending_purges', '');
+   RETURN NULL;
+END
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER pending_purges_notify
+ AFTER INSERT ON pending_purges
+ FOR EACH STATEMENT EXECUTE PROCEDURE pending_purges_notify_func();
+
 /* textsearch configs */
 CREATE TEXT SEARCH CONFIGURATION pg (PARSER=tsparser);
 
@@ -115,10 +223,23 @@ ALTER TEXT SEARCH CONFIGURATION pg
 ALTER TEXT SEARCH CONFIGURATION pg
    DROP MAPPING FOR email, url, url_path, sfloat, float;
 
+CREATE FUNCTION archives_message_fti(subject text, bodytxt text) RETURNS tsvector AS $$
+   SELECT setweight(to_tsvector('public.pg', coalesce(subject, '')), 'A') ||
+          setweight(to_tsvector('public.pg', coalesce(bodytxt, '')), 'D')
+$$ LANGUAGE 'sql' STABLE;
+
+-- Bulk loads and reparses can set archives.defer_fti to on, to skip the
+-- expensive indexing and only mark the messages as pending. fill_fti.py
+-- fills them in later, and searches match pending messages on the fly.
 CREATE FUNCTION messages_fti_trigger_func() RETURNS trigger AS $$
 BEGIN
-   NEW.fti = setweight(to_tsvector('public.pg', coalesce(new.subject, '')), 'A') ||
-             setweight(to_tsvector('public.pg', coalesce(new.bodytxt, '')), 'D');
+   IF current_setting('archives.defer_fti', true) = 'on' THEN
+      NEW.fti = ''::tsvector;
+      NEW.fti_pending = true;
+   ELSE
+      NEW.fti = archives_message_fti(NEW.subject, NEW.bodytxt);
+      NEW.fti_pending = false;
+   END IF;
    RETURN NEW;
 END
 $$ LANGUAGE 'plpgsql';
@@ -137,6 +258,142 @@ CREATE TABLE legacymap(
 CONSTRAINT legacymap_pk PRIMARY KEY (listid, year, month, msgnum)
 );
 
+/*
+ * Add messages ids to list_messages on the lists in listids (paired with
+ * ids), if they're visible and not there yet, and count them on their
+ * days in list_days.
+ */
+CREATE OR REPLACE FUNCTION archives_add_list_messages(ids int[], listids int[])
+  RETURNS void AS
+$BODY$
+BEGIN
+    WITH added AS (
+        INSERT INTO list_messages (listid, date, message)
+          SELECT p.listid, m.date, m.id FROM unnest(ids, listids) p(id, listid) INNER JOIN messages m ON m.id=p.id
+           WHERE m.hiddenstatus IS NULL
+          ON CONFLICT DO NOTHING
+          RETURNING listid, date
+    )
+    INSERT INTO list_days (listid, day, message_count)
+      SELECT listid, (date AT TIME ZONE 'UTC')::date, count(*) FROM added GROUP BY 1, 2 ORDER BY 1, 2
+      ON CONFLICT (listid, day) DO UPDATE SET message_count=list_days.message_count+excluded.message_count;
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE;
+
+/*
+ * Remove messages ids from list_messages on the lists in listids (paired
+ * with ids), and from the count of their days in list_days. Days that end
+ * up without messages are removed.
+ */
+CREATE OR REPLACE FUNCTION archives_remove_list_messages(ids int[], listids int[])
+  RETURNS void AS
+$BODY$
+BEGIN
+    WITH removed AS (
+        DELETE FROM list_messages lm USING unnest(ids, listids) p(id, listid)
+         WHERE lm.message=p.id AND lm.listid=p.listid
+        RETURNING lm.listid, lm.date
+    )
+    UPDATE list_days d SET message_count=d.message_count-r.n
+      FROM (SELECT listid, (date AT TIME ZONE 'UTC')::date AS day, count(*) AS n FROM removed GROUP BY 1, 2) r
+     WHERE d.listid=r.listid AND d.day=r.day;
+    DELETE FROM list_days WHERE listid=ANY(listids) AND message_count <= 0;
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE;
+
+/*
+ * Add messages to list_messages on every list their thread is on, once
+ * they're stored or shown again.
+ */
+CREATE OR REPLACE FUNCTION archives_add_messages(ids int[])
+  RETURNS void AS
+$BODY$
+DECLARE
+    msgs int[];
+    lists int[];
+BEGIN
+    SELECT array_agg(m.id), array_agg(lt.listid) INTO msgs, lists
+      FROM messages m INNER JOIN list_threads lt ON lt.threadid=m.threadid WHERE m.id=ANY(ids);
+    PERFORM archives_add_list_messages(msgs, lists);
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE;
+
+/*
+ * Remove messages from list_messages on all lists, before they're hidden
+ * or get another date.
+ */
+CREATE OR REPLACE FUNCTION archives_remove_messages(ids int[])
+  RETURNS void AS
+$BODY$
+DECLARE
+    msgs int[];
+    lists int[];
+BEGIN
+    SELECT array_agg(lm.message), array_agg(lm.listid) INTO msgs, lists
+      FROM list_messages lm WHERE lm.message=ANY(ids);
+    PERFORM archives_remove_list_messages(msgs, lists);
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE;
+
+/*
+ * Add the messages of threads, and of the threads merged into them, to
+ * list_messages on a list the threads were just tagged with.
+ */
+CREATE OR REPLACE FUNCTION archives_add_threads(threads int[], listid_in int)
+  RETURNS void AS
+$BODY$
+DECLARE
+    msgs int[];
+    lists int[];
+BEGIN
+    SELECT array_agg(m.id), array_agg(listid_in) INTO msgs, lists FROM messages m
+     WHERE m.threadid=ANY(threads) OR m.threadid IN (SELECT a.threadid FROM thread_aliases a WHERE a.canonical=ANY(threads));
+    PERFORM archives_add_list_messages(msgs, lists);
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE;
+
+/* Merge threads into canonical_in, see thread_aliases */
+CREATE OR REPLACE FUNCTION archives_merge_threads(mergethreads int[], canonical_in int)
+  RETURNS void AS
+$BODY$
+DECLARE
+    msgs int[];
+    lists int[];
+BEGIN
+    UPDATE thread_aliases SET canonical=canonical_in WHERE canonical=ANY(mergethreads);
+    INSERT INTO thread_aliases (threadid, canonical) SELECT unnest(mergethreads), canonical_in;
+
+    -- Tag the thread with the lists of the merged ones, and all of them
+    -- with the lists of the thread. Their messages show up on the lists
+    -- they weren't on before from now on, so add them there first.
+    SELECT array_agg(m.id), array_agg(l.listid) INTO msgs, lists
+      FROM messages m, (SELECT DISTINCT lt.listid FROM list_threads lt WHERE lt.threadid=canonical_in OR lt.threadid IN (SELECT a.threadid FROM thread_aliases a WHERE a.canonical=canonical_in)) l
+     WHERE (m.threadid=canonical_in OR m.threadid IN (SELECT a.threadid FROM thread_aliases a WHERE a.canonical=canonical_in))
+       AND NOT EXISTS (SELECT 1 FROM list_threads lt WHERE lt.threadid=m.threadid AND lt.listid=l.listid);
+    PERFORM archives_add_list_messages(msgs, lists);
+    INSERT INTO list_threads (threadid, listid) SELECT DISTINCT canonical_in, lt.listid FROM list_threads lt WHERE lt.threadid=ANY(mergethreads) ON CONFLICT DO NOTHING;
+    INSERT INTO list_threads (threadid, listid) SELECT a.threadid, lt.listid FROM thread_aliases a INNER JOIN list_threads lt ON lt.threadid=a.canonical WHERE a.canonical=canonical_in ON CONFLICT DO NOTHING;
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE;
+
+/* Keep merged threads tagged with the same lists as their canonical thread */
+CREATE FUNCTION list_threads_alias_trigger_func() RETURNS trigger AS $$
+BEGIN
+   INSERT INTO list_threads (threadid, listid) SELECT a.threadid, NEW.listid FROM thread_aliases a WHERE a.canonical=NEW.threadid ON CONFLICT DO NOTHING;
+   RETURN NULL;
+END
+$$ LANGUAGE 'plpgsql';
+
+CREATE TRIGGER list_threads_alias_trigger
+ AFTER INSERT ON list_threads
+ FOR EACH ROW EXECUTE PROCEDURE list_threads_alias_trigger_func();
+
 /* Simple API for hiding messages */
 CREATE OR REPLACE FUNCTION hide_message(msgid_txt text, reason_code integer, user_txt text, reason_txt text)
   RETURNS integer AS
@@ -144,12 +401,16 @@ $BODY$
 DECLARE
     returned_id integer;
 BEGIN
-    UPDATE messages SET hiddenstatus = reason_code WHERE messageid = msgid_txt RETURNING id INTO returned_id;
+    SELECT id INTO returned_id FROM messages WHERE messageid = msgid_txt FOR UPDATE;
 
     IF NOT FOUND THEN
 	RAISE EXCEPTION 'The specified message (%) could not be found.', msgid_txt;
     END IF;
 
+    PERFORM archives_remove_messages(ARRAY[returned_id]);
+    UPDATE messages SET hiddenstatus = reason_code WHERE id = returned_id;
+    PERFORM archives_add_messages(ARRAY[returned_id]);
+
     INSERT INTO message_hide_reasons (message, dt, reason, by) VALUES (returned_id, now(), reason_txt, user_txt);
 
     RETURN returned_id;
@@ -158,4 +419,157 @@ $BODY$
   LANGUAGE plpgsql VOLATILE
   COST 100;
 
+/*
+ * Store a new message for a list, resolving its thread the same way as
+ * ArchivesParserStorage._store() in the loader, in a single call. Used by
+ * load_message.py --store-function. If the message already exists, it's
+ * only tagged with the list. status is 'stored', 'tagged' or 'dupe', and
+ * purgethreads the threads to purge every page of from varnish: those
+ * merged, and the thread itself if it's on more lists than before. The
+ * other pages affected by a stored message are found by the loader.
+ *
+ * With keyedlocks, the messageid and thread locks described in
+ * lib/locks.py are taken, using the same keys.
+ */
+CREATE OR REPLACE FUNCTION archives_store_message(listid_in int, msgid_in text, parents_in text[],
+       year_in int, month_in int, from_in text, to_in text, cc_in text, subject_in text,
+       date_in timestamptz, bodytxt_in text, rawtxt_in bytea, parserversion_in int, charsets_in text[],
+       filenames_in text[], contenttypes_in text[], attachments_in bytea[], keyedlocks_in boolean,
+       OUT status text, OUT id int, OUT threadid int, OUT parentid int,
+       OUT mergedthreads int[], OUT purgethreads int[])
+AS
+$BODY$
+#variable_conflict use_column
+DECLARE
+    existing_id integer;
+    thread_id integer;
+    current_thread integer;
+    parent_id integer;
+    parent_pos integer;
+    new_id integer;
+    child_ids integer[];
+    child_priorities integer[];
+    child_threads integer[];
+    locked integer[] := '{}';
+    lockthreads integer[];
+    merge integer[] := '{}';
+    newthread boolean := false;
+    tagged boolean;
+BEGIN
+    IF keyedlocks_in THEN
+        PERFORM pg_advisory_xact_lock(1, h) FROM (SELECT DISTINCT hashtext(m) AS h FROM unnest(msgid_in || parents_in) m ORDER BY 1) s;
+    END IF;
+
+    INSERT INTO list_months (listid, year, month) VALUES (listid_in, year_in, month_in) ON CONFLICT DO NOTHING;
+
+    SELECT m.id, COALESCE(a.canonical, m.threadid) INTO existing_id, thread_id FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE m.messageid=msgid_in;
+    IF FOUND THEN
+        -- The message can be moved to another thread by a merge until we
+        -- hold the lock on its thread.
+        WHILE keyedlocks_in LOOP
+            PERFORM pg_advisory_xact_lock(2, thread_id);
+            SELECT COALESCE(a.canonical, m.threadid) INTO current_thread FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE m.id=existing_id;
+            EXIT WHEN current_thread = thread_id;
+            thread_id := current_thread;
+        END LOOP;
+
+        id := existing_id;
+        threadid := thread_id;
+        mergedthreads := '{}';
+        IF EXISTS (SELECT 1 FROM list_threads lt WHERE lt.threadid=thread_id AND lt.listid=listid_in) THEN
+            status := 'dupe';
+            purgethreads := '{}';
+        ELSE
+            INSERT INTO list_threads (threadid, listid) VALUES (thread_id, listid_in);
+            PERFORM archives_add_threads(ARRAY[thread_id], listid_in);
+            status := 'tagged';
+            purgethreads := ARRAY[thread_id];
+        END IF;
+        RETURN;
+    END IF;
+
+    -- Lock all threads we can end up in or merge. Since they can be merged
+    -- into others until we hold the lock, look again until there are no
+    -- threads we don't have the lock on.
+    WHILE keyedlocks_in LOOP
+        lockthreads := ARRAY(
+            SELECT COALESCE(a.canonical, m.threadid) FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE m.messageid=ANY(parents_in)
+            UNION
+            SELECT COALESCE(a.canonical, m.threadid) FROM unresolved_messages u INNER JOIN messages m ON m.id=u.message LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE u.msgid=msgid_in
+            EXCEPT
+            SELECT unnest(locked)
+        );
+        EXIT WHEN cardinality(lockthreads) = 0;
+        PERFORM pg_advisory_xact_lock(2, t) FROM (SELECT t FROM unnest(lockthreads) t ORDER BY 1) s;
+        locked := locked || lockthreads;
+    END LOOP;
+
+    -- The best parent is the first one in the list that exists. Any better
+    -- ones are waited for in unresolved_messages.
+    SELECT p.pos, m.id, COALESCE(a.canonical, m.threadid) INTO parent_pos, parent_id, thread_id
+      FROM unnest(parents_in) WITH ORDINALITY p(msgid, pos)
+     INNER JOIN messages m ON m.messageid=p.msgid
+      LEFT JOIN thread_aliases a ON a.threadid=m.threadid
+     ORDER BY p.pos LIMIT 1;
+    IF NOT FOUND THEN
+        parent_pos := cardinality(parents_in) + 1;
+    END IF;
+
+    -- Messages already stored that are waiting for us as their parent. If
+    -- they are in different threads, we're the glue between them, and the
+    -- threads are merged into ours, or the first one if we have none.
+    SELECT array_agg(u.message), array_agg(u.priority), array_agg(COALESCE(a.canonical, m.threadid)) INTO child_ids, child_priorities, child_threads
+      FROM unresolved_messages u INNER JOIN messages m ON m.id=u.message LEFT JOIN thread_aliases a ON a.threadid=m.threadid WHERE u.msgid=msgid_in;
+    IF child_ids IS NOT NULL THEN
+        IF thread_id IS NULL THEN
+            SELECT min(t) INTO thread_id FROM unnest(child_threads) t;
+        END IF;
+        merge := ARRAY(SELECT DISTINCT t FROM unnest(child_threads) t WHERE t != thread_id ORDER BY 1);
+        IF cardinality(merge) > 0 THEN
+            PERFORM archives_merge_threads(merge, thread_id);
+        END IF;
+        -- Remove all the pending parents that were less important than us
+        DELETE FROM unresolved_messages u USING unnest(child_ids, child_priorities) c(message, priority) WHERE u.message=c.message AND u.priority >= c.priority;
+    END IF;
+
+    IF thread_id IS NULL THEN
+        thread_id := nextval('threadid_seq');
+        newthread := true;
+    END IF;
+
+    INSERT INTO list_threads (threadid, listid) VALUES (thread_id, listid_in) ON CONFLICT DO NOTHING;
+    tagged := FOUND;
+    IF tagged AND NOT newthread THEN
+        PERFORM archives_add_threads(ARRAY[thread_id], listid_in);
+    END IF;
+    -- Every page of a thread shows the lists it is on, which merging can
+    -- also change
+    IF NOT newthread AND (tagged OR cardinality(merge) > 0) THEN
+        purgethreads := merge || thread_id;
+    ELSE
+        purgethreads := merge;
+    END IF;
+
+    INSERT INTO messages (parentid, threadid, _from, _to, cc, subject, date, has_attachment, messageid, bodytxt, rawtxt, parserversion, charsets)
+      VALUES (parent_id, thread_id, from_in, to_in, cc_in, subject_in, date_in, cardinality(attachments_in) > 0, msgid_in, bodytxt_in, rawtxt_in, parserversion_in, charsets_in)
+      RETURNING messages.id INTO new_id;
+    PERFORM archives_add_messages(ARRAY[new_id]);
+
+    INSERT INTO attachments (message, filename, contenttype, attachment)
+      SELECT new_id, a.filename, a.contenttype, a.attachment FROM unnest(filenames_in, contenttypes_in, attachments_in) WITH ORDINALITY a(filename, contenttype, attachment, pos) ORDER BY a.pos;
+
+    UPDATE messages SET parentid=new_id WHERE messages.id=ANY(child_ids);
+
+    INSERT INTO unresolved_messages (message, priority, msgid)
+      SELECT new_id, p.pos - 1, p.msgid FROM unnest(parents_in[1:parent_pos - 1]) WITH ORDINALITY p(msgid, pos);
+
+    status := 'stored';
+    id := new_id;
+    threadid := thread_id;
+    parentid := parent_id;
+    mergedthreads := merge;
+END;
+$BODY$
+  LANGUAGE plpgsql VOLATILE;
+
 \echo Dont forget to commit!
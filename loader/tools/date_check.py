@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+#
+# date_check.py - verify that the RFC 2822 fast path for parsing dates
+# gives the same results as the fuzzy parsing that used to handle all of
+# them, and benchmark the two.
+#
+# Dates are taken from the Date and Received headers of the messages in
+# the given mbox files, and/or from text files with one date per line.
+#
+
+import os
+import sys
+import time
+
+from optparse import OptionParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from lib.parser import ArchivesParser, _re_received
+from lib.mbox import MailboxBreakupParser
+from lib.exception import IgnorableException
+
+
+def old_decode(d):
+    if d.strip() == '':
+        raise IgnorableException("Failed to parse empty date")
+    return ArchivesParser._parse_date_fuzzy(d)
+
+
+def new_decode(d):
+    # Without the cache
+    return ArchivesParser._forgiving_date_decode.__wrapped__(ArchivesParser, d)
+
+
+def result(f, d):
+    try:
+        dp = f(d)
+        return (dp, dp.utcoffset())
+    except IgnorableException:
+        return None
+
+
+def dates_from_mbox(fn):
+    ap = ArchivesParser()
+    p = MailboxBreakupParser(fn)
+    for m in p:
+        ap.parse_headers(m)
+        if ap.get_optional('Date'):
+            yield ap.decode_mime_header(ap.get_optional('Date'))
+        for r in ap.msg.get_all('Received') or []:
+            m = _re_received.match(r)
+            if m:
+                yield m.group(1).strip()
+    p.close()
+
+
+if __name__ == "__main__":
+    optparser = OptionParser(usage="usage: %prog [options] mbox [mbox ...]")
+    optparser.add_option('-f', '--file', dest='files', action='append', default=[], help='Also read dates from file, one per line')
+    optparser.add_option('-v', '--verbose', dest='verbose', action='store_true', help='Show the dates that differ')
+
+    (opt, args) = optparser.parse_args()
+
+    if not args and not opt.files:
+        optparser.print_usage()
+        sys.exit(1)
+
+    dates = []
+    for fn in args:
+        dates.extend(dates_from_mbox(fn))
+    for fn in opt.files:
+        with open(fn) as f:
+            dates.extend([l.rstrip('\n') for l in f if l.strip()])
+    unique = list(set(dates))
+    print("%s dates, %s unique" % (len(dates), len(unique)))
+
+    different = 0
+    fast = 0
+    for d in unique:
+        if ArchivesParser._parse_date_fast(d) is not None:
+            fast += 1
+        o = result(old_decode, d)
+        n = result(new_decode, d)
+        if o != n:
+            different += 1
+            if opt.verbose:
+                print("'%s': fuzzy %s, new %s" % (d, o, n))
+    print("%s unique dates (%.1f%%) handled by the fast path, %s differ" % (fast, 100.0 * fast / max(len(unique), 1), different))
+
+    for name, f in (('fuzzy', old_decode), ('fast path', new_decode), ('fast path with cache', ArchivesParser().forgiving_date_decode)):
+        t = time.time()
+        for d in dates:
+            try:
+                f(d)
+            except IgnorableException:
+                pass
+        secs = time.time() - t
+        print("%s: %.3fs, %.0f dates/second" % (name, secs, secs and len(dates) / secs or 0))
+
+    if different:
+        sys.exit(1)
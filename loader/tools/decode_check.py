@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+#
+# decode_check.py - verify that analyzing messages with each MIME part
+# decoded only once gives exactly the same body and attachments as
+# decoding the parts every time they are looked at, and report how much
+# decoding that saves.
+#
+
+import os
+import sys
+import time
+
+from optparse import OptionParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from lib.parser import ArchivesParser
+from lib.mbox import MailboxBreakupParser
+from lib.exception import IgnorableException
+
+
+class UncachedParser(ArchivesParser):
+    # Decode parts every time, like the parser used to
+    def _decode_payload(self, part):
+        self.decodes += 1
+        return part.get_payload(decode=True)
+
+
+def analyze(cls, rawtxt):
+    ap = cls()
+    ap.parse_bytes(rawtxt)
+    try:
+        ap.analyze()
+    except IgnorableException as e:
+        return (ap, str(e))
+    except Exception as e:
+        # Would make the loader fail, but should fail the same way
+        return (ap, repr(e))
+    return (ap, None)
+
+
+if __name__ == "__main__":
+    optparser = OptionParser(usage="usage: %prog [options] mbox [mbox ...]")
+    optparser.add_option('-v', '--verbose', dest='verbose', action='store_true', help='Show the messages that differ')
+
+    (opt, args) = optparser.parse_args()
+
+    if not args:
+        optparser.print_usage()
+        sys.exit(1)
+
+    messages = []
+    for fn in args:
+        p = MailboxBreakupParser(fn)
+        messages.extend([bytes(m) for m in p])
+        p.close()
+
+    different = 0
+    totals = {'uncached': [0, 0.0], 'cached': [0, 0.0]}
+    saved = 0
+    savedbytes = 0
+    for m in messages:
+        t = time.time()
+        old, olderr = analyze(UncachedParser, m)
+        totals['uncached'][1] += time.time() - t
+        totals['uncached'][0] += old.decodes
+
+        t = time.time()
+        new, newerr = analyze(ArchivesParser, m)
+        totals['cached'][1] += time.time() - t
+        totals['cached'][0] += new.decodes
+        saved += new.decodes_saved
+        savedbytes += new.decode_bytes_saved
+
+        if olderr or newerr:
+            same = (olderr == newerr)
+        else:
+            same = (old.bodytxt == new.bodytxt and old.attachments == new.attachments)
+        if not same:
+            different += 1
+            if opt.verbose:
+                print("Message %s differs" % getattr(new, 'msgid', '<unknown>'))
+
+    print("%s messages, %s differ" % (len(messages), different))
+    for k, (decodes, secs) in totals.items():
+        print("%s: %s decodes, %.2fs" % (k, decodes, secs))
+    print("Decodes saved: %s (%s bytes)" % (saved, savedbytes))
+
+    if different:
+        sys.exit(1)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+#
+# list_messages_bench.py - compare the queries the date lists, the next
+# and previous links and the latest messages API used to run, which find
+# the messages of a list through list_threads, with the ones on top of
+# list_messages, on a generated archive of a few million messages.
+#
+# With --generate, an empty archives database (created with schema.sql)
+# is filled with messages in threads spread over a number of lists of
+# very different sizes over 20 years, some of them cross-posted and a few
+# hidden, along with list_threads, list_messages and list_days. Only
+# what the queries look at is realistic, the texts are just filler.
+#
+# The date lists have to return the same messages both ways. The next
+# and previous links and the latest messages used to include hidden
+# messages, which they no longer do.
+#
+
+import os
+import sys
+import time
+import random
+import datetime
+
+from optparse import OptionParser
+
+import psycopg2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from lib.log import log
+
+
+START = datetime.datetime(2004, 1, 1, tzinfo=datetime.timezone.utc)
+YEARS = 20
+
+
+def generate(conn, messages, lists):
+    curs = conn.cursor()
+    curs.execute("SELECT EXISTS (SELECT 1 FROM messages)")
+    if curs.fetchone()[0]:
+        print("Database already has messages, not generating")
+        sys.exit(1)
+
+    curs.execute("INSERT INTO listgroups (groupid, groupname, sortkey) VALUES (1, 'bench', 1) ON CONFLICT DO NOTHING")
+    curs.execute("INSERT INTO lists (listid, listname, shortdesc, description, active, subscriber_access, groupid) SELECT n, 'bench' || n, 'bench', 'bench', true, false, 1 FROM generate_series(1, %(lists)s) n ON CONFLICT DO NOTHING", {
+        'lists': lists,
+    })
+
+    # Five messages to a thread on average, each thread on a list picked
+    # with a skew so the first lists are much bigger than the last ones,
+    # and one in ten on a second list as well.
+    threads = max(messages // 5, 1)
+    curs.execute("SELECT setval('threadid_seq', %(threads)s)", {'threads': threads})
+    curs.execute("INSERT INTO list_threads (threadid, listid) SELECT t, 1 + floor(%(lists)s * power(random(), 3))::int FROM generate_series(1, %(threads)s) t", {
+        'lists': lists,
+        'threads': threads,
+    })
+    curs.execute("INSERT INTO list_threads (threadid, listid) SELECT t, 1 + floor(%(lists)s * random())::int FROM generate_series(1, %(threads)s) t WHERE random() < 0.1 ON CONFLICT DO NOTHING", {
+        'lists': lists,
+        'threads': threads,
+    })
+    conn.commit()
+
+    # Messages are in date order, with the threads they're in spread
+    # around them. The full text index is filled in later, if ever.
+    curs.execute("SET archives.defer_fti=on")
+    chunk = 250000
+    seconds = YEARS * 365 * 86400
+    for start in range(0, messages, chunk):
+        end = min(start + chunk, messages)
+        curs.execute("""INSERT INTO messages (threadid, _from, _to, cc, subject, date, has_attachment, hiddenstatus, messageid, bodytxt, rawtxt)
+SELECT greatest(1, least(%(threads)s, (n::bigint * %(threads)s / %(messages)s)::int + floor(random() * 50)::int - 25)),
+  'Someone <someone@example.com>', 'list@example.com', '', 'Message ' || n,
+  %(start)s + make_interval(secs => n::float8 * %(seconds)s / %(messages)s),
+  false, CASE WHEN random() < 0.001 THEN 1 END, 'bench' || n || '@example.com', 'Body', '\\x00'::bytea
+FROM generate_series(%(first)s, %(last)s) n""", {
+            'threads': threads,
+            'messages': messages,
+            'start': START,
+            'seconds': seconds,
+            'first': start,
+            'last': end - 1,
+        })
+        conn.commit()
+        log.status("Generated %s of %s messages" % (end, messages))
+
+    # Same as the materialize_all_*.sql scripts
+    curs.execute("INSERT INTO list_months (listid, year, month) SELECT DISTINCT listid, EXTRACT(year FROM date), EXTRACT(month FROM date) FROM messages INNER JOIN list_threads ON messages.threadid=list_threads.threadid")
+    curs.execute("INSERT INTO list_days (listid, day, message_count) SELECT listid, (date AT TIME ZONE 'UTC')::date, count(*) FROM messages INNER JOIN list_threads ON messages.threadid=list_threads.threadid WHERE hiddenstatus IS NULL GROUP BY 1, 2")
+    curs.execute("INSERT INTO list_messages (listid, date, message) SELECT listid, date, id FROM messages INNER JOIN list_threads ON messages.threadid=list_threads.threadid WHERE hiddenstatus IS NULL")
+    conn.commit()
+    conn.autocommit = True
+    curs.execute("VACUUM ANALYZE")
+    conn.autocommit = False
+
+
+# (name, query before, query after). The queries get the list as
+# %(listid)s and a date as %(date)s, and return message ids.
+QUERIES = [
+    ('since', """SELECT id FROM messages WHERE date >= %(date)s AND hiddenstatus IS NULL AND threadid IN (SELECT threadid FROM list_threads WHERE listid=%(listid)s) ORDER BY date LIMIT 200""",
+     """SELECT messages.id FROM messages, list_messages WHERE list_messages.message=messages.id AND list_messages.listid=%(listid)s AND list_messages.date >= %(date)s ORDER BY list_messages.date LIMIT 200"""),
+    ('before', """SELECT id FROM messages WHERE date <= %(date)s AND hiddenstatus IS NULL AND threadid IN (SELECT threadid FROM list_threads WHERE listid=%(listid)s) ORDER BY date DESC LIMIT 200""",
+     """SELECT messages.id FROM messages, list_messages WHERE list_messages.message=messages.id AND list_messages.listid=%(listid)s AND list_messages.date <= %(date)s ORDER BY list_messages.date DESC LIMIT 200"""),
+    ('month', """SELECT id FROM messages WHERE date >= %(date)s AND date < %(date)s + interval '1 month' AND hiddenstatus IS NULL AND threadid IN (SELECT threadid FROM list_threads WHERE listid=%(listid)s) ORDER BY date LIMIT 200""",
+     """SELECT messages.id FROM messages, list_messages WHERE list_messages.message=messages.id AND list_messages.listid=%(listid)s AND list_messages.date >= %(date)s AND list_messages.date < %(date)s + interval '1 month' ORDER BY list_messages.date LIMIT 200"""),
+    ('next/prev', """SELECT (SELECT m.id FROM messages m INNER JOIN list_threads lt ON lt.threadid=m.threadid WHERE m.date>%(date)s AND lt.listid=%(listid)s ORDER BY m.date LIMIT 1)
+UNION ALL SELECT (SELECT m.id FROM messages m INNER JOIN list_threads lt ON lt.threadid=m.threadid WHERE m.date<%(date)s AND lt.listid=%(listid)s ORDER BY m.date DESC LIMIT 1)""",
+     """SELECT (SELECT m.id FROM list_messages lm INNER JOIN messages m ON m.id=lm.message WHERE lm.date>%(date)s AND lm.listid=%(listid)s ORDER BY lm.date LIMIT 1)
+UNION ALL SELECT (SELECT m.id FROM list_messages lm INNER JOIN messages m ON m.id=lm.message WHERE lm.date<%(date)s AND lm.listid=%(listid)s ORDER BY lm.date DESC LIMIT 1)"""),
+    ('latest', """SELECT id FROM messages WHERE threadid IN (SELECT threadid FROM list_threads WHERE listid=%(listid)s) ORDER BY date DESC LIMIT 50""",
+     """SELECT messages.id FROM messages, list_messages WHERE list_messages.message=messages.id AND list_messages.listid=%(listid)s ORDER BY list_messages.date DESC LIMIT 50"""),
+]
+
+# Queries that have to return the same messages both ways
+SAME = ('since', 'before', 'month')
+
+
+def run(curs, query, listid, dates):
+    # Returns (seconds per query, results)
+    results = []
+    t = time.time()
+    for d in dates:
+        curs.execute(query, {'listid': listid, 'date': d})
+        results.append([r[0] for r in curs.fetchall()])
+    return ((time.time() - t) / len(dates), results)
+
+
+if __name__ == "__main__":
+    optparser = OptionParser()
+    optparser.add_option('-c', '--connstr', dest='connstr', help='Connection string of an archives database to use')
+    optparser.add_option('--generate', dest='generate', action='store_true', help='Fill the (empty) database with a generated archive first')
+    optparser.add_option('--messages', dest='messages', type='int', default=3000000, help='Number of messages to generate (default 3000000)')
+    optparser.add_option('--lists', dest='lists', type='int', default=30, help='Number of lists to generate (default 30)')
+    optparser.add_option('--rounds', dest='rounds', type='int', default=20, help='Number of dates to run each query for (default 20)')
+    optparser.add_option('-v', '--verbose', dest='verbose', action='store_true', help='Verbose output')
+
+    (opt, args) = optparser.parse_args()
+
+    if args or not opt.connstr:
+        optparser.print_usage()
+        sys.exit(1)
+
+    log.set(opt.verbose)
+
+    conn = psycopg2.connect(opt.connstr)
+    curs = conn.cursor()
+    if opt.generate:
+        t = time.time()
+        generate(conn, opt.messages, opt.lists)
+        print("Generated %s messages on %s lists in %.1fs" % (opt.messages, opt.lists, time.time() - t))
+
+    # The biggest and the smallest list, and one in between
+    curs.execute("SELECT listid, count(*) FROM list_messages GROUP BY listid ORDER BY 2 DESC")
+    sizes = curs.fetchall()
+    if not sizes:
+        print("No messages in list_messages")
+        sys.exit(1)
+    picked = sorted(set([sizes[0], sizes[len(sizes) // 2], sizes[-1]]), key=lambda s: -s[1])
+    curs.execute("SELECT min(date), max(date) FROM messages")
+    first, last = curs.fetchone()
+
+    random.seed(0)
+    dates = [first + (last - first) * random.random() for n in range(opt.rounds)]
+
+    ok = True
+    print("%-10s %-10s %12s %12s %8s" % ('list', 'query', 'before (ms)', 'after (ms)', 'speedup'))
+    for listid, count in picked:
+        for name, before, after in QUERIES:
+            # Once to get the caches warm
+            run(curs, before, listid, dates[:1])
+            run(curs, after, listid, dates[:1])
+            tb, rb = run(curs, before, listid, dates)
+            ta, ra = run(curs, after, listid, dates)
+            print("%-10s %-10s %12.2f %12.2f %7.1fx" % ('%s (%s)' % (listid, count), name, tb * 1000, ta * 1000, tb / max(ta, 1e-9)))
+            if name in SAME and rb != ra:
+                print("Different messages returned by %s on list %s!" % (name, listid))
+                ok = False
+    conn.close()
+
+    if not ok:
+        sys.exit(1)
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+#
+# lock_stress.py - load the messages in one or more mbox files into an
+# empty database from many processes at once, one message per
+# transaction like live deliveries, using the keyed locks. Then verify
+# that the threads ended up consistent, and the same as loading the
+# messages one by one would have made them.
+#
+# Every message is delivered to every list given, in random order, to
+# also exercise the tagging of threads with lists.
+#
+
+import os
+import sys
+import random
+import time
+
+from optparse import OptionParser
+from multiprocessing import Pool
+
+import psycopg2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from lib.storage import ArchivesParserStorage
+from lib.mbox import MailboxBreakupParser
+from lib.exception import IgnorableException
+from lib.locks import lock_loader
+from lib.varnish import queue_purges
+from lib.threadresolver import ThreadResolver
+
+
+def load(connstr, deliveries, function):
+    # Runs in the worker processes
+    conn = psycopg2.connect(connstr)
+    curs = conn.cursor()
+    failed = 0
+    for listid, rawtxt in deliveries:
+        ap = ArchivesParserStorage()
+        ap.parse_bytes(rawtxt)
+        try:
+            ap.analyze()
+        except IgnorableException:
+            failed += 1
+            continue
+        lock_loader(curs, False)
+        ap.store(conn, listid, keyedlocks=True, function=function)
+        queue_purges(curs, ap.purges)
+        conn.commit()
+    conn.close()
+    return failed
+
+
+def expected_threads(messages):
+    # Thread each message the way store() would, loading them in order.
+    # Returns {msgid: (parent msgid, thread)}, where thread is the set of
+    # msgids in the same thread.
+    ids = iter(range(1, len(messages) + 1))
+    threadids = iter(range(1, len(messages) + 1))
+    resolver = ThreadResolver(lambda: next(ids), lambda: next(threadids))
+    bymsgid = {}
+    parentof = {}
+    for msgid, parents in messages:
+        if msgid in bymsgid:
+            continue
+        r = resolver.resolve(msgid, parents)
+        bymsgid[msgid] = r.id
+        parentof[r.id] = r.parentid
+        for c in r.children:
+            parentof[c] = r.id
+    return _threads([(msgid, id, parentof[id], resolver.message_thread(id)) for msgid, id in bymsgid.items()])
+
+
+def _threads(rows):
+    # rows are (msgid, id, parentid, threadid)
+    msgids = dict([(id, msgid) for msgid, id, parentid, threadid in rows])
+    members = {}
+    for msgid, id, parentid, threadid in rows:
+        members.setdefault(threadid, set()).add(msgid)
+    return dict([(msgid, (msgids.get(parentid), frozenset(members[threadid]))) for msgid, id, parentid, threadid in rows])
+
+
+def analyze(rawtxt):
+    # Returns (msgid, parents), or None if the message won't load
+    ap = ArchivesParserStorage()
+    ap.parse_bytes(rawtxt)
+    try:
+        ap.analyze()
+    except IgnorableException:
+        return None
+    return (ap.msgid, ap.parents)
+
+
+def check(conn, deliveries, messages):
+    # messages is {rawtxt: (msgid, parents)} for the messages that load.
+    # Returns a list of problems found.
+    problems = []
+    curs = conn.cursor()
+
+    curs.execute("SELECT count(*) FROM messages m INNER JOIN messages p ON p.id=m.parentid LEFT JOIN thread_aliases ma ON ma.threadid=m.threadid LEFT JOIN thread_aliases pa ON pa.threadid=p.threadid WHERE COALESCE(pa.canonical, p.threadid) != COALESCE(ma.canonical, m.threadid)")
+    n, = curs.fetchone()
+    if n:
+        problems.append("%s messages are not in the same thread as their parent" % n)
+
+    curs.execute("SELECT count(*) FROM unresolved_messages u INNER JOIN messages m ON m.messageid=u.msgid")
+    n, = curs.fetchone()
+    if n:
+        problems.append("%s unresolved entries are waiting for messages that are stored" % n)
+
+    curs.execute("SELECT messageid, id, parentid, COALESCE(a.canonical, m.threadid) FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid")
+    rows = curs.fetchall()
+    threads = _threads(rows)
+    expected = expected_threads(list(messages.values()))
+    wrong = [m for m in expected if threads.get(m) != expected[m]]
+    if len(threads) != len(expected) or wrong:
+        problems.append("%s stored, %s expected, %s threaded differently than when loaded one by one" % (len(threads), len(expected), len(wrong)))
+
+    # Each thread should be tagged with exactly the lists its messages
+    # were delivered to.
+    threadof = dict([(msgid, threadid) for msgid, id, parentid, threadid in rows])
+    tags = set()
+    for listid, rawtxt in deliveries:
+        if rawtxt in messages and messages[rawtxt][0] in threadof:
+            tags.add((threadof[messages[rawtxt][0]], listid))
+    curs.execute("SELECT threadid, listid FROM list_threads WHERE threadid NOT IN (SELECT threadid FROM thread_aliases)")
+    if set(curs.fetchall()) != tags:
+        problems.append("Threads are not tagged with the right lists")
+    curs.execute("SELECT count(*) FROM thread_aliases a WHERE ARRAY(SELECT listid FROM list_threads WHERE threadid=a.threadid ORDER BY 1) != ARRAY(SELECT listid FROM list_threads WHERE threadid=a.canonical ORDER BY 1)")
+    n, = curs.fetchone()
+    if n:
+        problems.append("%s merged threads are not tagged with the same lists as the thread they were merged into" % n)
+    return problems
+
+
+if __name__ == "__main__":
+    optparser = OptionParser(usage="usage: %prog [options] mbox [mbox ...]")
+    optparser.add_option('-c', '--connstr', dest='connstr', help='Connection string of an empty archives database')
+    optparser.add_option('-l', '--list', dest='lists', action='append', help='Name of list to load messages for (can be given multiple times)')
+    optparser.add_option('-p', '--processes', dest='processes', type='int', default=8, help='Number of loader processes (default 8)')
+    optparser.add_option('--store-function', dest='function', action='store_true', help='Store messages using the archives_store_message() database function')
+    optparser.add_option('--seed', dest='seed', type='int', help='Random seed for the order of the deliveries')
+
+    (opt, args) = optparser.parse_args()
+
+    if not args or not opt.connstr or not opt.lists:
+        optparser.print_usage()
+        sys.exit(1)
+
+    conn = psycopg2.connect(opt.connstr)
+    curs = conn.cursor()
+    curs.execute("SELECT count(*) FROM messages")
+    if curs.fetchone()[0] != 0:
+        print("Database is not empty")
+        sys.exit(1)
+    curs.execute("SELECT listname, listid FROM lists WHERE listname=ANY(%(lists)s)", {'lists': opt.lists})
+    listids = dict(curs.fetchall())
+    if len(listids) != len(set(opt.lists)):
+        print("Lists not found: %s" % ", ".join(set(opt.lists).difference(listids)))
+        sys.exit(1)
+    conn.commit()
+
+    raw = []
+    for fn in args:
+        p = MailboxBreakupParser(fn)
+        raw.extend([bytes(m) for m in p])
+        p.close()
+    messages = dict([(r, a) for r, a in [(r, analyze(r)) for r in raw] if a])
+
+    deliveries = [(listids[l], r) for l in set(opt.lists) for r in raw]
+    random.seed(opt.seed)
+    random.shuffle(deliveries)
+
+    start = time.time()
+    with Pool(opt.processes) as pool:
+        failed = sum(pool.starmap(load, [(opt.connstr, deliveries[i::opt.processes], opt.function) for i in range(opt.processes)]))
+    secs = time.time() - start
+    print("%s deliveries of %s messages from %s processes in %.1fs, %s failed to parse" % (len(deliveries), len(raw), opt.processes, secs, failed))
+
+    problems = check(conn, deliveries, messages)
+    for p in problems:
+        print(p)
+    if problems:
+        sys.exit(1)
+    print("Threads are consistent")
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+#
+# mbox_split_check.py - verify that the in-process mbox splitter splits
+# a corpus of mbox files exactly like formail does, and report the
+# throughput of both.
+#
+
+import os
+import sys
+import time
+from subprocess import Popen, PIPE
+
+from optparse import OptionParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from lib.mbox import MailboxBreakupParser
+
+SEPARATOR = b"ABCARCHBREAK123" * 50
+
+
+def formail_split(fn):
+    # This is how the loader used to split mboxes
+    if fn.endswith(".gz"):
+        file_stream = Popen(['zcat', fn], stdout=PIPE).stdout
+    else:
+        file_stream = open(fn, 'rb')
+    pipe = Popen("formail -s /bin/sh -c 'cat && echo %s'" % SEPARATOR.decode('ascii'), shell=True, stdin=file_stream, stdout=PIPE, stderr=PIPE)
+    file_stream.close()
+
+    messages = []
+    current = []
+    for l in pipe.stdout:
+        if l.rstrip() == SEPARATOR:
+            messages.append(b''.join(current))
+            current = []
+        else:
+            current.append(l)
+    if current:
+        messages.append(b''.join(current))
+    pipe.wait()
+    if pipe.returncode:
+        raise Exception("formail failed: %s" % pipe.stderr.read())
+    return messages
+
+
+def inprocess_split(fn):
+    p = MailboxBreakupParser(fn)
+    messages = [bytes(m) for m in p]
+    p.close()
+    return messages
+
+
+if __name__ == "__main__":
+    optparser = OptionParser(usage="usage: %prog [options] mbox [mbox ...]")
+    optparser.add_option('-v', '--verbose', dest='verbose', action='store_true', help='Show the messages that differ')
+    optparser.add_option('--no-formail', dest='noformail', action='store_true', help='Only benchmark the in-process splitter')
+
+    (opt, args) = optparser.parse_args()
+
+    if not args:
+        optparser.print_usage()
+        sys.exit(1)
+
+    totals = {'formail': [0, 0.0], 'inprocess': [0, 0.0]}
+    failed = 0
+    for fn in args:
+        t = time.time()
+        new = inprocess_split(fn)
+        totals['inprocess'][0] += len(new)
+        totals['inprocess'][1] += time.time() - t
+
+        if opt.noformail:
+            print("%s: %s messages" % (fn, len(new)))
+            continue
+
+        t = time.time()
+        old = formail_split(fn)
+        totals['formail'][0] += len(old)
+        totals['formail'][1] += time.time() - t
+
+        if old == new:
+            print("%s: %s messages, identical" % (fn, len(new)))
+            continue
+
+        failed += 1
+        print("%s: DIFFERENT, %s messages from formail, %s in-process" % (fn, len(old), len(new)))
+        if opt.verbose:
+            for i in range(max(len(old), len(new))):
+                o = i < len(old) and old[i] or b''
+                n = i < len(new) and new[i] or b''
+                if o != n:
+                    print("First difference at message %s:" % i)
+                    print("---- formail ----")
+                    print(o[:500].decode('utf8', errors='replace'))
+                    print("---- in-process ----")
+                    print(n[:500].decode('utf8', errors='replace'))
+                    break
+
+    for k, (num, secs) in totals.items():
+        if num:
+            print("%s: %s messages in %.2fs, %.0f messages/second" % (k, num, secs, secs and num / secs or 0))
+
+    if failed:
+        print("%s of %s files differ" % (failed, len(args)))
+        sys.exit(1)
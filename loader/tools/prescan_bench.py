@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+#
+# prescan_bench.py - measure what the loader saves by looking at only the
+# headers of messages that are already stored (such as messages
+# cross-posted to a list that has already been loaded) or that are
+# skipped by --filter-msgid, compared to fully parsing them.
+#
+# No database is needed, the loader does the same lookups either way.
+#
+
+import os
+import sys
+import time
+
+from optparse import OptionParser
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from lib.storage import ArchivesParserStorage
+from lib.mbox import MailboxBreakupParser
+from lib.exception import IgnorableException
+
+
+def full(rawtxt):
+    ap = ArchivesParserStorage()
+    ap.parse_bytes(rawtxt)
+    try:
+        ap.analyze()
+    except IgnorableException:
+        pass
+    return ap
+
+
+def headers(rawtxt):
+    ap = ArchivesParserStorage()
+    ap.parse_headers(rawtxt)
+    try:
+        ap.analyze_headers()
+    except IgnorableException:
+        pass
+    return ap
+
+
+def filter_full(rawtxt):
+    ap = ArchivesParserStorage()
+    ap.parse_bytes(rawtxt)
+    return ap.is_msgid('nonexistent@example.com')
+
+
+def filter_headers(rawtxt):
+    ap = ArchivesParserStorage()
+    ap.parse_headers(rawtxt)
+    return ap.is_msgid('nonexistent@example.com')
+
+
+if __name__ == "__main__":
+    optparser = OptionParser(usage="usage: %prog [options] mbox [mbox ...]")
+    optparser.add_option('--rounds', dest='rounds', type='int', default=1, help='Number of times to process each mbox')
+
+    (opt, args) = optparser.parse_args()
+
+    if not args:
+        optparser.print_usage()
+        sys.exit(1)
+
+    messages = []
+    for fn in args:
+        p = MailboxBreakupParser(fn)
+        messages.extend([bytes(m) for m in p])
+        p.close()
+    print("%s messages, %s bytes" % (len(messages), sum([len(m) for m in messages])))
+
+    # Make sure both ways agree on what we need from the headers
+    mismatch = 0
+    for m in messages:
+        a = full(m)
+        b = headers(m)
+        if getattr(a, 'msgid', None) != getattr(b, 'msgid', None) or getattr(a, 'date', None) != getattr(b, 'date', None):
+            mismatch += 1
+    if mismatch:
+        print("%s messages differ between full and header-only parsing!" % mismatch)
+
+    results = {}
+    for name, f in (('tag-only, full parse', full),
+                    ('tag-only, headers only', headers),
+                    ('filter-msgid, full parse', filter_full),
+                    ('filter-msgid, headers only', filter_headers)):
+        t = time.time()
+        for i in range(opt.rounds):
+            for m in messages:
+                f(m)
+        results[name] = time.time() - t
+        num = len(messages) * opt.rounds
+        print("%s: %.2fs, %.0f messages/second" % (name, results[name], num / results[name]))
+
+    print("Speedup for already stored messages: %.1fx" % (results['tag-only, full parse'] / results['tag-only, headers only']))
+    print("Speedup for filtered messages: %.1fx" % (results['filter-msgid, full parse'] / results['filter-msgid, headers only']))
+
+    if mismatch:
+        sys.exit(1)
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+#
+# purge_bench.py - purge a number of keys from several stub cache
+# frontends, running as local HTTP servers with a configurable latency,
+# through VarnishPurger, and compare that to sending the requests one by
+# one over new connections like it used to be done.
+#
+# Checks that every frontend got every key, that connections are reused,
+# and that a frontend that fails makes the purge fail.
+#
+
+import os
+import sys
+import threading
+import time
+
+from optparse import OptionParser
+from configparser import ConfigParser
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+
+import requests
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from lib.varnish import VarnishPurger
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super(StubHandler, self).setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_POST(self):
+        data = parse_qs(self.rfile.read(int(self.headers['Content-Length'])).decode('utf8'))
+        time.sleep(self.server.latency)
+        keys = [data['x%s' % n][0] for n in range(int(data['n'][0]))]
+        with self.server.lock:
+            self.server.requests += 1
+            self.server.maxkeys = max(self.server.maxkeys, len(keys))
+            if not self.server.failing:
+                self.server.keys.update(keys)
+        self.send_response(self.server.failing and 500 or 200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubFrontend(object):
+    def __init__(self, latency):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.latency = latency
+        self.server.failing = False
+        self.reset()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def reset(self):
+        self.server.connections = 0
+        self.server.requests = 0
+        self.server.maxkeys = 0
+        self.server.keys = set()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%s/' % self.server.server_address[1]
+
+
+def baseline(frontends, keys, maxkeys):
+    # One request at a time, each on a new connection
+    for f in frontends:
+        for i in range(0, len(keys), maxkeys):
+            chunk = keys[i:i + maxkeys]
+            purgedict = dict(list(zip(['x%s' % n for n in range(0, len(chunk))], chunk)))
+            purgedict['n'] = len(chunk)
+            requests.post(f.url, data=purgedict, headers={'Connection': 'close'}, timeout=30)
+
+
+def check(name, frontends, keys, seconds):
+    ok = True
+    for n, f in enumerate(frontends):
+        s = f.server
+        print("%s: frontend %s got %s of %s keys in %s requests (at most %s keys) over %s connections" % (
+            name, n, len(s.keys), len(keys), s.requests, s.maxkeys, s.connections))
+        if s.keys != set(keys):
+            ok = False
+    print("%s: %.2fs, %.0f keys/second" % (name, seconds, len(keys) * len(frontends) / seconds))
+    return ok
+
+
+if __name__ == "__main__":
+    optparser = OptionParser()
+    optparser.add_option('--frontends', dest='frontends', type='int', default=3, help='Number of stub frontends (default 3)')
+    optparser.add_option('--keys', dest='keys', type='int', default=20000, help='Number of keys to purge (default 20000)')
+    optparser.add_option('--latency', dest='latency', type='float', default=20, help='Latency of each request to a frontend in ms (default 20)')
+    optparser.add_option('--maxkeys', dest='maxkeys', type='int', default=100, help='Maximum number of keys in one request (default 100)')
+    optparser.add_option('--connections', dest='connections', type='int', default=4, help='Number of requests to send to each frontend at once (default 4)')
+
+    (opt, args) = optparser.parse_args()
+
+    frontends = [StubFrontend(opt.latency / 1000.0) for n in range(opt.frontends)]
+    keys = ['pgat_%s' % n for n in range(opt.keys)]
+
+    cfg = ConfigParser()
+    cfg.add_section('varnish')
+    cfg.set('varnish', 'maxkeys', str(opt.maxkeys))
+    cfg.set('varnish', 'connections', str(opt.connections))
+    for n, f in enumerate(frontends):
+        cfg.add_section('varnish:stub%s' % n)
+        cfg.set('varnish:stub%s' % n, 'purgeurl', f.url)
+
+    ok = True
+    t = time.time()
+    baseline(frontends, keys, opt.maxkeys)
+    ok = check('one by one', frontends, keys, time.time() - t) and ok
+
+    for f in frontends:
+        f.reset()
+    purger = VarnishPurger(cfg)
+    t = time.time()
+    if not purger.purge_keys(keys):
+        print("Purge failed!")
+        ok = False
+    ok = check('pooled', frontends, keys, time.time() - t) and ok
+    for f in frontends:
+        if f.server.connections > opt.connections or f.server.maxkeys > opt.maxkeys:
+            print("Too many connections or keys in a request!")
+            ok = False
+
+    # A purge only succeeds if all frontends succeed
+    frontends[-1].server.failing = True
+    if purger.purge_keys(keys[:10]):
+        print("Purge with a failing frontend succeeded!")
+        ok = False
+    for e in purger.endpoints:
+        s = e.stats()
+        print("%s: %s requests, %s failed, %s keys, %.3fs average, %.3fs max" % (
+            e.name, s['requests'], s['failures'], s['keys'], s['seconds'] / s['requests'], s['maxseconds']))
+
+    if not ok:
+        sys.exit(1)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+#
+# purge_report.py - replay loading one or more mbox files into an archives
+# database, in a transaction that is rolled back, and report how many of
+# the pages that could be cached for what was already in the database
+# would be purged by the keys the loader queues. This is compared to the
+# thread and month keys alone, which is all the pages used to be tagged
+# with, with the thread tree both inline in the message pages and
+# included with ESI (see THREAD_TREE_ESI in the django settings).
+#
+# The pages are the message and flat pages of every message, the month
+# lists, and the since and before lists of every day with messages, with
+# the same keys as the views give them. Keys are counted before the purge
+# daemon collapses them into month keys.
+#
+
+import os
+import sys
+import bisect
+import datetime
+
+from optparse import OptionParser
+
+import psycopg2
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from lib.storage import ArchivesParserStorage
+from lib.mbox import MailboxBreakupParser
+from lib.exception import IgnorableException
+from lib.varnish import purge_key
+
+# Number of messages on a date list page, see views.render_datelist_from()
+DATELIST_SIZE = 200
+
+
+def range_keys(listid, start, end, atstart, atend):
+    # Same as views._datelist_range_keys()
+    keys = []
+    if (end.date() - start.date()).days > 62:
+        year, month = start.year, start.month
+        while (year, month) <= (end.year, end.month):
+            keys.append('pgam_{0}/{1}/{2}'.format(listid, year, month))
+            year, month = month == 12 and (year + 1, 1) or (year, month + 1)
+    else:
+        day = start.date()
+        while day <= end.date():
+            keys.append('pgad_{0}/{1}/{2}/{3}'.format(listid, day.year, day.month, day.day))
+            day += datetime.timedelta(days=1)
+    if atstart:
+        keys.append('pgals_{0}'.format(listid))
+    if atend:
+        keys.append('pgale_{0}'.format(listid))
+    return keys
+
+
+def month_keys(listid, dates):
+    return set(['pgam_{0}/{1}/{2}'.format(listid, d.year, d.month) for d in dates])
+
+
+def datelist_keys(listid, start, end, shown, since):
+    # Returns (old keys, new keys) of a since or before list from start to
+    # end, showing the messages at the dates in shown.
+    full = len(shown) == DATELIST_SIZE
+    new = set(range_keys(listid, start, end, not since and not full, since and not full))
+    if len(month_keys(listid, shown)) <= 1:
+        # Links to the days of the month
+        d = (shown or [start])[0]
+        new.add('pgamd_{0}/{1}/{2}'.format(listid, d.year, d.month))
+    return (month_keys(listid, shown), new)
+
+
+def cached_pages(curs):
+    # Returns {scheme: [(kind, keys)]} for the pages that could be cached
+    schemes = {
+        'before': [],
+        'after': [],
+        'after, ESI': [],
+    }
+
+    def _add(kind, old, new, esi=None):
+        schemes['before'].append((kind, old))
+        schemes['after'].append((kind, new))
+        schemes['after, ESI'].append((kind, esi or new))
+
+    curs.execute("SELECT m.id, COALESCE(a.canonical, m.threadid), m.date AT TIME ZONE 'UTC', m.hiddenstatus IS NULL, ARRAY(SELECT listid FROM list_threads lt WHERE lt.threadid=m.threadid) FROM messages m LEFT JOIN thread_aliases a ON a.threadid=m.threadid")
+    dates = {}
+    for id, threadid, date, visible, lists in curs.fetchall():
+        thread = 'pgat_%s' % threadid
+        tree = 'pgatt_%s' % threadid
+        message = 'pgamsg_%s' % id
+        _add('message', set([thread]), set([thread, message, tree]), set([thread, message]))
+        schemes['after, ESI'].append(('thread tree', set([thread, tree])))
+        _add('flat', set([thread]), set([thread, tree]))
+        if visible:
+            for listid in lists:
+                dates.setdefault(listid, []).append(date)
+
+    for listid, l in dates.items():
+        l.sort()
+        for k in month_keys(listid, l):
+            _add('month list', set([k]), set([k]))
+        for day in sorted(set([d.date() for d in l])):
+            start = datetime.datetime(day.year, day.month, day.day)
+            i = bisect.bisect_left(l, start)
+            shown = l[i:i + DATELIST_SIZE]
+            _add('since list', *datelist_keys(listid, start, shown and shown[-1] or start, shown, True))
+            i = bisect.bisect_right(l, start)
+            if i:
+                shown = l[max(i - DATELIST_SIZE, 0):i]
+                _add('before list', *datelist_keys(listid, shown[0], start, shown, False))
+    return schemes
+
+
+def old_key(p):
+    # The key the loader used to queue for a purge, if any: every change
+    # to a thread purged all its pages, and messages before and after a
+    # new one were not purged at all.
+    if isinstance(p, tuple):
+        if p[0] == 'tree':
+            return 'pgat_%s' % p[1]
+        elif isinstance(p[0], str):
+            return None
+    return purge_key(p)
+
+
+def purged(pages, keys):
+    # Returns {kind: [number of pages purged, number of pages]}
+    r = {}
+    for kind, pagekeys in pages:
+        c = r.setdefault(kind, [0, 0])
+        c[1] += 1
+        if not pagekeys.isdisjoint(keys):
+            c[0] += 1
+    return r
+
+
+if __name__ == "__main__":
+    optparser = OptionParser(usage="usage: %prog [options] mbox [mbox ...]")
+    optparser.add_option('-c', '--connstr', dest='connstr', help='Connection string of an archives database')
+    optparser.add_option('-l', '--list', dest='list', help='Name of list to load messages for')
+
+    (opt, args) = optparser.parse_args()
+
+    if not args or not opt.connstr or not opt.list:
+        optparser.print_usage()
+        sys.exit(1)
+
+    conn = psycopg2.connect(opt.connstr)
+    curs = conn.cursor()
+    curs.execute("SELECT listid FROM lists WHERE listname=%(list)s", {'list': opt.list})
+    r = curs.fetchall()
+    if len(r) != 1:
+        print("List %s not found" % opt.list)
+        sys.exit(1)
+    listid = r[0][0]
+
+    schemes = cached_pages(curs)
+
+    purges = set()
+    stored = 0
+    for fn in args:
+        p = MailboxBreakupParser(fn)
+        for rawtxt in p:
+            ap = ArchivesParserStorage()
+            ap.parse_bytes(bytes(rawtxt))
+            try:
+                ap.analyze()
+            except IgnorableException:
+                continue
+            ap.store(conn, listid)
+            purges.update(ap.purges)
+            stored += 1
+        p.close()
+    conn.rollback()
+    conn.close()
+
+    oldkeys = set([old_key(p) for p in purges if old_key(p)])
+    newkeys = set([purge_key(p) for p in purges])
+    print("Replayed %s messages: %s keys before, %s keys after" % (stored, len(oldkeys), len(newkeys)))
+
+    results = dict([(scheme, purged(pages, scheme == 'before' and oldkeys or newkeys)) for scheme, pages in schemes.items()])
+    names = ['before', 'after', 'after, ESI']
+    print("%-12s %s" % ('', ''.join(['%22s' % n for n in names])))
+    for kind in ['message', 'thread tree', 'flat', 'month list', 'since list', 'before list']:
+        print("%-12s %s" % (kind, ''.join([
+            kind in results[n] and '%22s' % ('%s / %s' % tuple(results[n][kind])) or '%22s' % '-'
+            for n in names])))
+    print("%-12s %s" % ('total', ''.join([
+        '%22s' % ('%s / %s' % (sum([c[0] for c in results[n].values()]), sum([c[1] for c in results[n].values()])))
+        for n in names])))
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+#
+# store_bench.py - compare the latency of storing messages one by one,
+# like deliveries, with the threading resolved in python and with the
+# archives_store_message() database function, at different network round
+# trip times to the database.
+#
+# The round trip time is simulated by sleeping before each statement sent
+# to the server. Each run is done in a transaction that is rolled back,
+# so the database is still empty afterwards. Both ways of storing have
+# to leave the database in the same state.
+#
+
+import os
+import sys
+import time
+
+from optparse import OptionParser
+
+import psycopg2
+import psycopg2.extensions
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from lib.storage import ArchivesParserStorage
+from lib.mbox import MailboxBreakupParser
+from lib.exception import IgnorableException
+
+
+class RttCursor(psycopg2.extensions.cursor):
+    # Count the round trips to the server, and delay each of them
+    def execute(self, query, vars=None):
+        self.connection.roundtrips += 1
+        if self.connection.rtt:
+            time.sleep(self.connection.rtt)
+        return super(RttCursor, self).execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        # psycopg2 sends one statement for each set of parameters
+        for v in vars_list:
+            self.execute(query, v)
+
+
+class RttConnection(psycopg2.extensions.connection):
+    def __init__(self, *args, **kwargs):
+        super(RttConnection, self).__init__(*args, **kwargs)
+        self.cursor_factory = RttCursor
+        self.roundtrips = 0
+        self.rtt = 0
+
+
+def analyze(messages):
+    # Store() changes the parser, so each run needs its own
+    r = []
+    for rawtxt in messages:
+        ap = ArchivesParserStorage()
+        ap.parse_bytes(rawtxt)
+        try:
+            ap.analyze()
+        except IgnorableException:
+            continue
+        r.append(ap)
+    return r
+
+
+def snapshot(curs):
+    # The threading of what's stored, independent of ids
+    curs.execute("SELECT m.messageid, p.messageid, COALESCE(a.canonical, m.threadid) FROM messages m LEFT JOIN messages p ON p.id=m.parentid LEFT JOIN thread_aliases a ON a.threadid=m.threadid")
+    rows = curs.fetchall()
+    members = {}
+    for msgid, parent, threadid in rows:
+        members.setdefault(threadid, set()).add(msgid)
+    threads = dict([(msgid, (parent, frozenset(members[threadid]))) for msgid, parent, threadid in rows])
+    curs.execute("SELECT m.messageid, u.priority, u.msgid FROM unresolved_messages u INNER JOIN messages m ON m.id=u.message")
+    unresolved = set(curs.fetchall())
+    curs.execute("SELECT m.messageid, lt.listid FROM messages m INNER JOIN list_threads lt ON lt.threadid=m.threadid")
+    tags = set(curs.fetchall())
+    return (threads, unresolved, tags)
+
+
+def run(conn, listid, messages, function, rtt):
+    # Returns the latency of each message, round trips per message, and
+    # the resulting database state
+    aps = analyze(messages)
+    conn.rtt = rtt
+    conn.roundtrips = 0
+    latency = []
+    for ap in aps:
+        t = time.time()
+        ap.store(conn, listid, function=function)
+        latency.append(time.time() - t)
+    roundtrips = conn.roundtrips
+    conn.rtt = 0
+    state = snapshot(conn.cursor())
+    conn.rollback()
+    return (latency, roundtrips / len(aps), state)
+
+
+if __name__ == "__main__":
+    optparser = OptionParser(usage="usage: %prog [options] mbox [mbox ...]")
+    optparser.add_option('-c', '--connstr', dest='connstr', help='Connection string of an empty archives database')
+    optparser.add_option('-l', '--list', dest='list', help='Name of list to load messages for')
+    optparser.add_option('--rtt', dest='rtt', type='float', action='append', help='Round trip time in ms to simulate (can be given multiple times, default 0, 0.5 and 2)')
+
+    (opt, args) = optparser.parse_args()
+
+    if not args or not opt.connstr or not opt.list:
+        optparser.print_usage()
+        sys.exit(1)
+
+    conn = psycopg2.connect(opt.connstr, connection_factory=RttConnection)
+    curs = conn.cursor()
+    curs.execute("SELECT count(*) FROM messages")
+    if curs.fetchone()[0] != 0:
+        print("Database is not empty")
+        sys.exit(1)
+    curs.execute("SELECT listid FROM lists WHERE listname=%(list)s", {'list': opt.list})
+    r = curs.fetchall()
+    if len(r) != 1:
+        print("List %s not found" % opt.list)
+        sys.exit(1)
+    listid = r[0][0]
+    conn.rollback()
+
+    messages = []
+    for fn in args:
+        p = MailboxBreakupParser(fn)
+        messages.extend([bytes(m) for m in p])
+        p.close()
+    print("%s messages" % len(messages))
+
+    mismatch = False
+    for rtt in (opt.rtt or [0, 0.5, 2]):
+        states = []
+        for name, function in (('python', False), ('function', True)):
+            latency, roundtrips, state = run(conn, listid, messages, function, rtt / 1000.0)
+            states.append(state)
+            latency.sort()
+            print("RTT %.1fms, %s: %.1f round trips/message, median %.2fms, 95th percentile %.2fms, %.0f messages/second" % (
+                rtt, name, roundtrips,
+                latency[len(latency) // 2] * 1000,
+                latency[int(len(latency) * 0.95)] * 1000,
+                len(latency) / sum(latency)))
+        if states[0] != states[1]:
+            print("Threading differs between python and function!")
+            mismatch = True
+
+    conn.close()
+    if mismatch:
+        sys.exit(1)